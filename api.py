@@ -1,14 +1,173 @@
+import asyncio
+import configparser
 import datetime
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
 
-from fastapi import FastAPI, Request
-from fastapi.responses import RedirectResponse
-from starlette.responses import PlainTextResponse
+from fastapi import FastAPI, HTTPException, Query, Request
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
 
+from streamer.ArchiveEncryptor import ArchiveEncryptor
+from streamer.ChannelNotifier import ChannelNotifier
+from streamer.ClipExporter import ClipExporter, ClipResponse, RangeNotSatisfiable, parse_range, slice_pieces
+from streamer.Db import DbManager
+from streamer.EncryptedSegmentCache import EncryptedSegmentCache
+from streamer.KeyManager import KeyManager
+from streamer.Metrics import CONTENT_TYPE, REGISTRY, Counter, Histogram
+from streamer.PlaylistCache import PlaylistCache
 from streamer.PlaylistGenerator import PlaylistGenerator
+from streamer.SegmentIndex import SegmentIndex
+from streamer.SegmentTail import SegmentTail
+from streamer.logs import configure_logging
 
 API_PREFIX = 'streamer'
 
-app = FastAPI()
+API_REQUEST_SECONDS = Histogram('api_request_seconds', 'API request time until the end of the response body',
+                                ('route',))
+API_REQUESTS = Counter('api_requests_total', 'API requests by route and status', ('route', 'status'))
+
+
+@asynccontextmanager
+async def lifespan(app_: FastAPI):
+    # конфиг, БД и кэш живут все время работы приложения, а не создаются на каждый запрос
+    config = configparser.ConfigParser()
+    config.read("pvr.ini")
+    configure_logging(config['logging'] if config.has_section('logging') else None)
+    api_config = config['api'] if config.has_section('api') else {}
+
+    app_.state.chunk_prefix = config['plstgen']['chunk_prefix']
+    app_.state.pvr_dir = config['writer']['pvr_dir'] if config.has_section('writer') else './pvr'
+    app_.state.db_manager = DbManager(batch_interval=0)
+    app_.state.tail = SegmentTail(db_manager=app_.state.db_manager,
+                                  interval=float(api_config.get('tail_interval', 1)))
+    app_.state.cache = PlaylistCache(max_entries=int(api_config.get('cache_entries', 1000)),
+                                     max_bytes=int(api_config.get('cache_bytes', 64 * 1024 * 1024)),
+                                     ttl=float(api_config.get('cache_ttl', 60)),
+                                     historical_ttl=float(api_config.get('cache_historical_ttl', 3600)))
+    # большие плейлисты отдаются потоком и не кэшируются
+    app_.state.cache_entry_bytes = int(api_config.get('cache_entry_bytes', 1024 * 1024))
+    # live playlist: окно по умолчанию и ожидание новых чанков (blocking reload)
+    app_.state.live_window = float(api_config.get('live_window', 60))
+    app_.state.notifier = ChannelNotifier(tail=app_.state.tail)
+    # индекс чанков в памяти для VOD playlist и metadata вместо запросов к БД
+    app_.state.segment_index = None
+    if config.getboolean('api', 'segment_index', fallback=False):
+        app_.state.segment_index = SegmentIndex(db_manager=app_.state.db_manager, tail=app_.state.tail,
+                                                layout=config.get('writer', 'layout', fallback='flat'),
+                                                trim_interval=config.getfloat('api', 'index_trim_interval',
+                                                                              fallback=10))
+    app_.state.live_locks = {}
+    # шифрование архива на лету, если задана секция [drm]
+    app_.state.archive_encryptor = None
+    if config.has_section('drm'):
+        drm_config = config['drm']
+        key_manager = KeyManager(key_encryptor_url=drm_config['key_encryptor_url'],
+                                 key_client_url=drm_config['key_client_url'],
+                                 ttl=drm_config.getfloat('key_ttl', fallback=3600))
+        cache = EncryptedSegmentCache(max_bytes=drm_config.getint('cache_bytes', fallback=256 * 1024 * 1024),
+                                      directory=drm_config.get('cache_dir', fallback=None),
+                                      max_disk_bytes=drm_config.getint('cache_disk_bytes', fallback=0))
+        app_.state.archive_encryptor = ArchiveEncryptor(storage=app_.state.pvr_dir, key_manager=key_manager,
+                                                        cache=cache, db_manager=app_.state.db_manager,
+                                                        content_id=drm_config.get('content_id', fallback=None) or None)
+
+    await app_.state.tail.start()
+    tasks = []
+    if app_.state.segment_index is not None:
+        # индекс загружается до чтения новых чанков: иначе загружаемые старые чанки вставлялись бы перед новыми
+        await app_.state.segment_index.load(last_id=app_.state.tail.last_id)
+        tasks.append(asyncio.create_task(app_.state.segment_index.run()))
+    tasks.append(asyncio.create_task(app_.state.tail.run()))
+    yield
+    for task in tasks:
+        task.cancel()
+    if app_.state.archive_encryptor is not None:
+        await app_.state.archive_encryptor.key_manager.close()
+
+
+class RequestMetricsMiddleware:
+    """Time and status of requests by route template (ASGI middleware, streaming responses are not buffered)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get('route')
+            route = route.path if route is not None else 'unmatched'
+            API_REQUEST_SECONDS.labels(route).observe(time.perf_counter() - started)
+            API_REQUESTS.labels(route, status).inc()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(RequestMetricsMiddleware)
+
+
+def _get_generator(channel_name: str) -> PlaylistGenerator:
+    return PlaylistGenerator(channel_name=channel_name,
+                             db_manager=app.state.db_manager,
+                             chunk_prefix=app.state.chunk_prefix,
+                             segment_index=app.state.segment_index)
+
+
+def _get_cache_version(channel_name: str, to_datetime: Optional[datetime.datetime]):
+    """
+    None for fully historical interval (cached for historical_ttl: the interval changes only by retention),
+    otherwise current version of the channel
+    :param to_datetime: end of the interval in UTC, as segment starts in db; None - open-ended interval
+    """
+
+    if to_datetime is not None and app.state.tail.is_historical(channel_name=channel_name, to_datetime=to_datetime):
+        return None
+    return app.state.tail.get_version(channel_name)
+
+
+async def _stream_and_cache(parts, cache_key: tuple, version):
+    buffer = []
+    size = 0
+    async for part in parts:
+        if buffer is not None:
+            buffer.append(part)
+            size += len(part)
+            if size > app.state.cache_entry_bytes:
+                buffer = None
+        yield part
+    if buffer is not None:
+        app.state.cache.put(cache_key, ''.join(buffer), version=version, size=size)
+
+
+async def _get_live_playlist(channel_name: str, window: float, from_datetime: Optional[datetime.datetime]):
+    """
+    Live playlist rendered once per version of the channel for all waiting requests
+    :return: version of the channel and result of PlaylistGenerator.generate_live_playlist
+    """
+
+    version = app.state.tail.get_version(channel_name)
+    cache_key = ('live', channel_name, window, from_datetime)
+    live = app.state.cache.get(cache_key, version=version)
+    if live is None:
+        async with app.state.live_locks.setdefault(channel_name, asyncio.Lock()):
+            live = app.state.cache.get(cache_key, version=version)
+            if live is None:
+                live = await _get_generator(channel_name=channel_name).generate_live_playlist(
+                    window=window, from_datetime=from_datetime)
+                if live is not None:
+                    app.state.cache.put(cache_key, live, version=version, size=len(live[0]))
+    return version, live
 
 
 # @app.get(f"/{API_PREFIX}/GetNPVRPlayList")
@@ -23,24 +182,102 @@ async def get_playlist(channel_name: str,
                        startTime: str = None,
                        endTime: str = None,
                        startTimestamp: int = None,
-                       endTimestamp: int = None):
+                       endTimestamp: int = None,
+                       encrypted: bool = False):
     if startTime is not None:
         from_datetime = datetime.datetime.strptime(startTime, '%d/%m/%YT%H:%M:%S')
     elif startTimestamp is not None:
-        from_datetime = datetime.datetime.fromtimestamp(startTimestamp)
+        from_datetime = datetime.datetime.utcfromtimestamp(startTimestamp)
 
     if endTime is not None:
         to_datetime = datetime.datetime.strptime(endTime, '%d/%m/%YT%H:%M:%S')
     elif endTimestamp is not None:
-        to_datetime = datetime.datetime.fromtimestamp(endTimestamp)
+        to_datetime = datetime.datetime.utcfromtimestamp(endTimestamp)
     else:
-        to_datetime = datetime.datetime.now()
+        to_datetime = None
+
+    key_line = None
+    encrypted_uri_prefix = None
+    if encrypted:
+        if app.state.archive_encryptor is None:
+            raise HTTPException(status_code=404, detail='encryption is not configured')
+        key = await app.state.archive_encryptor.get_key(channel_name)
+        key_line = key.key_line
+        # относительно /streamer/ - и для {channel_name}.m3u8, и для GetNPVRPlayList
+        encrypted_uri_prefix = f'enc/{channel_name}/{key.key_id}/'
+
+    # интервал без конца кэшируется под одним ключом до появления новых чанков канала
+    cache_key = ('playlist', channel_name, from_datetime, to_datetime, encrypted_uri_prefix, key_line)
+    version = _get_cache_version(channel_name=channel_name, to_datetime=to_datetime)
+    playlist_str = app.state.cache.get(cache_key, version=version)
+    if playlist_str is not None:
+        return playlist_str
+    if to_datetime is None:
+        to_datetime = datetime.datetime.utcnow()
+
+    generator = _get_generator(channel_name=channel_name)
+    parts = await generator.stream_vod_playlist(from_datetime=from_datetime,
+                                                to_datetime=to_datetime,
+                                                key_line=key_line,
+                                                encrypted_uri_prefix=encrypted_uri_prefix)
+    if parts is None:
+        return None
+    return StreamingResponse(_stream_and_cache(parts, cache_key=cache_key, version=version),
+                             media_type=PlainTextResponse.media_type)
 
-    generator = PlaylistGenerator(channel_name=channel_name)
-    playlist_str = await generator.generate_vod_playlist(from_datetime=from_datetime,
-                                                         to_datetime=to_datetime)
 
-    return playlist_str
+@app.get(f"/{API_PREFIX}/enc/{{channel_name}}/{{key_id}}/{{segment_id}}.ts")
+async def get_encrypted_segment(channel_name: str, key_id: str, segment_id: int):
+    """Archive segment encrypted with DRM key of the channel (segment uri of playlist with encrypted=true)"""
+
+    if app.state.archive_encryptor is None:
+        raise HTTPException(status_code=404, detail='encryption is not configured')
+    data = await app.state.archive_encryptor.get_segment(channel_name=channel_name, segment_id=segment_id,
+                                                         key_id=key_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail='no such chunk')
+    return Response(content=data, media_type='video/mp2t')
+
+
+@app.get(f"/{API_PREFIX}/{{channel_name}}/live.m3u8", response_class=PlainTextResponse)
+async def get_live_playlist(channel_name: str,
+                            window: float = None,
+                            startTime: str = None,
+                            startTimestamp: int = None,
+                            hls_msn: int = Query(None, alias='_HLS_msn')):
+    """
+    Live playlist of the archive: sliding window of the last window seconds
+    or EVENT playlist from startTime/startTimestamp;
+    with _HLS_msn the request is held until the segment with this media sequence number is in the playlist
+    """
+
+    if startTime is not None:
+        from_datetime = datetime.datetime.strptime(startTime, '%d/%m/%YT%H:%M:%S')
+    elif startTimestamp is not None:
+        from_datetime = datetime.datetime.utcfromtimestamp(startTimestamp)
+    else:
+        from_datetime = None
+    if window is None or window <= 0:
+        window = app.state.live_window
+
+    loop = asyncio.get_running_loop()
+    deadline = None
+    while True:
+        version, live = await _get_live_playlist(channel_name=channel_name, window=window,
+                                                 from_datetime=from_datetime)
+        if live is None:
+            raise HTTPException(status_code=404, detail='no chunks')
+        playlist, last_media_sequence, target_duration = live
+        if hls_msn is None or last_media_sequence >= hls_msn:
+            return playlist
+        if hls_msn > last_media_sequence + 2:
+            raise HTTPException(status_code=400, detail=f'_HLS_msn is too far from {last_media_sequence}')
+        if deadline is None:
+            # ожидание не дольше трех target duration
+            deadline = loop.time() + 3 * target_duration
+        if not await app.state.notifier.wait_for_change(channel_name=channel_name, version=version,
+                                                        timeout=deadline - loop.time()):
+            raise HTTPException(status_code=503, detail=f'segment {hls_msn} is not ready')
 
 
 @app.get(f"/{API_PREFIX}/{{channel_name}}/metadata")
@@ -48,11 +285,76 @@ async def get_metadata(channel_name: str,
                        startTime: str,
                        endTime: str = None):
     from_datetime = datetime.datetime.strptime(startTime, '%d/%m/%YT%H:%M:%S')
-    to_datetime = datetime.datetime.strptime(endTime,
-                                             '%d/%m/%YT%H:%M:%S') if endTime is not None else datetime.datetime.now()
+    to_datetime = datetime.datetime.strptime(endTime, '%d/%m/%YT%H:%M:%S') if endTime is not None else None
 
-    generator = PlaylistGenerator(channel_name=channel_name)
-    metadata = await generator.get_metadata_for_interval(from_datetime=from_datetime,
-                                                         to_datetime=to_datetime)
+    # интервал без конца кэшируется под одним ключом до появления новых чанков канала
+    cache_key = ('metadata', channel_name, from_datetime, to_datetime)
+    version = _get_cache_version(channel_name=channel_name, to_datetime=to_datetime)
+    metadata = app.state.cache.get(cache_key, version=version)
+    if metadata is None:
+        generator = _get_generator(channel_name=channel_name)
+        metadata = await generator.get_metadata_for_interval(
+            from_datetime=from_datetime,
+            to_datetime=to_datetime if to_datetime is not None else datetime.datetime.utcnow())
+        app.state.cache.put(cache_key, metadata, version=version, size=len(metadata) * 200)
 
     return metadata
+
+
+@app.get(f"/{API_PREFIX}/{{channel_name}}/clip.ts")
+async def get_clip(channel_name: str,
+                   request: Request,
+                   startTime: str = None,
+                   endTime: str = None,
+                   startTimestamp: int = None,
+                   endTimestamp: int = None):
+    """Chunks of the interval as one MPEG-TS file, with Range support"""
+
+    if startTime is not None:
+        from_datetime = datetime.datetime.strptime(startTime, '%d/%m/%YT%H:%M:%S')
+    elif startTimestamp is not None:
+        from_datetime = datetime.datetime.utcfromtimestamp(startTimestamp)
+    else:
+        raise HTTPException(status_code=400, detail='startTime or startTimestamp is required')
+
+    if endTime is not None:
+        to_datetime = datetime.datetime.strptime(endTime, '%d/%m/%YT%H:%M:%S')
+    elif endTimestamp is not None:
+        to_datetime = datetime.datetime.utcfromtimestamp(endTimestamp)
+    else:
+        to_datetime = datetime.datetime.utcnow()
+
+    exporter = ClipExporter(channel_name=channel_name, storage=app.state.pvr_dir, db_manager=app.state.db_manager)
+    pieces = await exporter.get_pieces(from_datetime=from_datetime, to_datetime=to_datetime)
+    if not pieces:
+        raise HTTPException(status_code=404, detail='no chunks in the interval')
+
+    total_length = sum(length for _, _, length in pieces)
+    headers = {'content-disposition': f'attachment; filename="{channel_name}_{from_datetime:%Y%m%d_%H%M%S}.ts"'}
+    try:
+        byte_range = parse_range(request.headers.get('range'), total_length=total_length)
+    except RangeNotSatisfiable:
+        return PlainTextResponse('', status_code=416, headers={'content-range': f'bytes */{total_length}'})
+    if byte_range is None:
+        return ClipResponse(pieces, headers=headers)
+
+    first, last = byte_range
+    headers['content-range'] = f'bytes {first}-{last}/{total_length}'
+    return ClipResponse(slice_pieces(pieces, first=first, last=last), status_code=206, headers=headers)
+
+
+@app.get(f"/{API_PREFIX}/cache")
+async def get_cache_stats():
+    return app.state.cache.stats()
+
+
+@app.get(f"/{API_PREFIX}/cache/encrypted")
+async def get_encrypted_cache_stats():
+    if app.state.archive_encryptor is None:
+        raise HTTPException(status_code=404, detail='encryption is not configured')
+    return app.state.archive_encryptor.cache.stats()
+
+
+@app.get(f"/{API_PREFIX}/metrics")
+async def get_metrics():
+    return Response(content=REGISTRY.render(), media_type=CONTENT_TYPE)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Throughput and peak Python memory of clip export (/streamer/{channel}/clip.ts) through uvicorn:
+whole clip and Range request, for archive of separate chunk files (flat) and hourly containers (packed)
+
+python benchmarks/clip_benchmark.py --size-gb 4
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import aiohttp
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from streamer.Db import DbManager  # noqa: E402
+from streamer.HlsWriter import LAYOUT_FLAT, LAYOUT_PACKED, get_segment_name  # noqa: E402
+
+START = datetime.datetime(2024, 6, 1)
+DURATION = 2
+PORT = 8799
+
+
+async def fill_archive(db_manager: DbManager, pvr_dir: str, channel_name: str, layout: str,
+                       segments: int, segment_size: int):
+    block = os.urandom(segment_size)
+    channel_dir = os.path.join(pvr_dir, channel_name)
+    os.makedirs(channel_dir, exist_ok=True)
+    for media_sequence in range(segments):
+        start_datetime = START + datetime.timedelta(seconds=media_sequence * DURATION)
+        filename = get_segment_name(start_datetime=start_datetime, layout=layout)
+        path = os.path.join(channel_dir, filename)
+        with open(path, 'ab') as f:
+            byte_offset = f.tell()
+            f.write(block)
+        packed = layout == LAYOUT_PACKED
+        await db_manager.add_segment(filename=filename, duration=DURATION, start_datetime=start_datetime,
+                                     original_filename=f'c_{media_sequence}.ts', media_sequence=media_sequence,
+                                     channel_name=channel_name,
+                                     byte_offset=byte_offset if packed else None,
+                                     byte_length=segment_size if packed else None)
+    await db_manager.flush()
+
+
+async def download(session: aiohttp.ClientSession, url: str, headers: dict = None):
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = 0
+    async with session.get(url, headers=headers) as resp:
+        status = resp.status
+        async for chunk in resp.content.iter_chunked(1024 * 1024):
+            size += len(chunk)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return status, size, elapsed, peak
+
+
+async def main(args):
+    segment_size = args.segment_mb * 1024 * 1024
+    segments = int(args.size_gb * 1024 / args.segment_mb)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        pvr_dir = os.path.join(tmp_dir, 'pvr')
+        with open(os.path.join(tmp_dir, 'pvr.ini'), 'w') as f:
+            f.write(f'[writer]\npvr_dir = {pvr_dir}\n'
+                    f'[plstgen]\nchunk_prefix = http://127.0.0.1/pvr/\n'
+                    f'[db]\nurl = sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}\nbatch_interval = 1\n')
+        # API читает pvr.ini из текущей папки
+        os.chdir(tmp_dir)
+        db_manager = DbManager()
+        await db_manager.create_db()
+        for layout in (LAYOUT_FLAT, LAYOUT_PACKED):
+            started = time.perf_counter()
+            await fill_archive(db_manager, pvr_dir, channel_name=layout, layout=layout,
+                               segments=segments, segment_size=segment_size)
+            print(f'{layout}: {segments} chunks, {segments * segment_size / 1024 ** 3:.1f} GiB written '
+                  f'in {time.perf_counter() - started:.1f} s')
+
+        import api
+        server = uvicorn.Server(uvicorn.Config(api.app, port=PORT, log_level='warning'))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.1)
+
+        to_timestamp = int((START + datetime.timedelta(seconds=segments * DURATION)).timestamp())
+        from_timestamp = int(START.timestamp())
+        total = segments * segment_size
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+            for layout in (LAYOUT_FLAT, LAYOUT_PACKED):
+                url = f'http://127.0.0.1:{PORT}/streamer/{layout}/clip.ts' \
+                      f'?startTimestamp={from_timestamp}&endTimestamp={to_timestamp}'
+                for name, headers in (('whole', None),
+                                      ('range 1/2', {'Range': f'bytes={total // 4}-{total // 4 * 3 - 1}'})):
+                    status, size, elapsed, peak = await download(session, url, headers=headers)
+                    print(f'{layout:7} {name:10} status {status}  {size / 1024 ** 3:6.2f} GiB  '
+                          f'{size / 1024 ** 2 / elapsed:8.1f} MiB/s  peak {peak / 1024 / 1024:6.1f} MiB')
+
+        server.should_exit = True
+        await server_task
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-gb', type=float, default=4)
+    parser.add_argument('--segment-mb', type=int, default=2)
+    parser.add_argument('--dir', default=None, help='directory for temporary archive')
+    asyncio.run(main(parser.parse_args()))
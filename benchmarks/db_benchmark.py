@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Insert rate and range query latency of the segment index
+
+python benchmarks/db_benchmark.py --rows 2000000 --channels 50
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamer.Db import DbManager  # noqa: E402
+
+START = datetime.datetime(2024, 6, 1)
+DURATION = 2.0
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def fill(db_manager: DbManager, rows: int, channels: int, per_row_rows: int) -> None:
+    # чанки всех каналов приходят вперемешку, как от writer
+    started = time.perf_counter()
+    for i in range(rows):
+        media_sequence, channel = divmod(i, channels)
+        await db_manager.add_segment(filename=f'{media_sequence}.ts', duration=DURATION,
+                                     start_datetime=START + datetime.timedelta(seconds=media_sequence * DURATION),
+                                     original_filename=f'c_{media_sequence}.ts', media_sequence=media_sequence,
+                                     channel_name=f'camera{channel}')
+        if db_manager.batcher is not None and len(db_manager.batcher.rows) >= 10000:
+            await db_manager.flush()
+        if db_manager.batcher is None and i + 1 >= per_row_rows:
+            break
+    await db_manager.flush()
+    elapsed = time.perf_counter() - started
+    inserted = i + 1
+    mode = 'batched' if db_manager.batcher is not None else 'per row'
+    print(f'insert {mode:8} {inserted:>9} rows {elapsed:8.2f} s {inserted / elapsed:10.0f} rows/s')
+
+
+async def query(db_manager: DbManager, rows: int, channels: int, hours: float, queries: int) -> None:
+    total_seconds = rows // channels * DURATION
+    latencies = []
+    result_rows = 0
+    for _ in range(queries):
+        from_datetime = START + datetime.timedelta(seconds=random.uniform(0, max(total_seconds - hours * 3600, 0)))
+        started = time.perf_counter()
+        result = await db_manager.get_segments(from_datetime=from_datetime,
+                                               to_datetime=from_datetime + datetime.timedelta(hours=hours),
+                                               channel_name=f'camera{random.randrange(channels)}')
+        latencies.append(time.perf_counter() - started)
+        result_rows += len(result)
+    print(f'range {hours:5}h {result_rows // queries:>7} rows/query  '
+          f'p50 {statistics.median(latencies) * 1000:8.2f} ms  p99 {percentile(latencies, 0.99) * 1000:8.2f} ms')
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        url = f'sqlite:///{os.path.join(tmp_dir, "per_row.sqlite")}'
+        db_manager = DbManager(url=url, batch_interval=0)
+        await db_manager.create_db()
+        await fill(db_manager, args.rows, args.channels, per_row_rows=args.per_row_rows)
+
+        url = f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}'
+        db_manager = DbManager(url=url, batch_interval=1)
+        await db_manager.create_db()
+        await fill(db_manager, args.rows, args.channels, per_row_rows=args.per_row_rows)
+        for hours in (1, 24):
+            await query(db_manager, args.rows, args.channels, hours, args.queries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2_000_000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--per-row-rows', type=int, default=5000, help='rows to insert one by one for comparison')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark: local synthetic HLS origin (live playlists over HTTP for writer and clear playlists
+on disk for encryptor) and fake DRM key server; writer, encryptor and API run as separate processes,
+as in production. Reports segments/s, record and encrypt latency, API p50/p99 of playlist and metadata
+queries for several archive sizes, CPU and RSS of every component; results are written as JSON
+to compare them across commits (Linux only: CPU and RSS are read from /proc)
+
+python benchmarks/e2e_benchmark.py --channels 20 --duration 60 --output e2e.json
+python benchmarks/e2e_benchmark.py --compare e2e_old.json e2e.json
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import signal
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, TCPConnector, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ARCHIVE_START = datetime.datetime(2024, 6, 1)
+ARCHIVE_DURATION = 2
+ORIGIN_WINDOW = 6
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def summarize(values: list, scale: float = 1000) -> dict:
+    """p50, p99, max and mean of latencies (in ms by default)"""
+
+    if not values:
+        return {'count': 0}
+    return {'count': len(values),
+            'p50': round(percentile(values, 0.5) * scale, 2),
+            'p99': round(percentile(values, 0.99) * scale, 2),
+            'max': round(max(values) * scale, 2),
+            'mean': round(statistics.mean(values) * scale, 2)}
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_commit() -> dict:
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                             cwd=ROOT, text=True).strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+class ProcessSampler:
+    """CPU time and RSS of a process with all its children (writer shards, encryptor pool workers)"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.cpu = {}
+        self.cpu_seconds = 0.0
+        self.max_rss = 0
+        self.rss = []
+        self.started = None
+        self.elapsed = 0.0
+
+    @staticmethod
+    def _read_stat(pid: int):
+        with open(f'/proc/{pid}/stat') as f:
+            # имя процесса может содержать пробелы
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss = int(f.read().split()[1]) * PAGE_SIZE
+        return int(fields[1]), (int(fields[11]) + int(fields[12])) / CLK_TCK, rss
+
+    def _get_tree(self) -> dict:
+        stats = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    stats[int(name)] = self._read_stat(int(name))
+                except (OSError, IndexError, ValueError):
+                    pass
+        tree = {}
+        parents = [self.pid]
+        while parents:
+            pid = parents.pop()
+            if pid in stats and pid not in tree:
+                tree[pid] = stats[pid]
+                parents.extend(child for child, (ppid, _, _) in stats.items() if ppid == pid)
+        return tree
+
+    def start(self) -> None:
+        self.cpu = {pid: cpu for pid, (_, cpu, _) in self._get_tree().items()}
+        self.started = time.monotonic()
+
+    def sample(self) -> None:
+        tree = self._get_tree()
+        for pid, (_, cpu, _) in tree.items():
+            self.cpu_seconds += cpu - self.cpu.get(pid, 0.0)
+            self.cpu[pid] = cpu
+        rss = sum(rss for _, _, rss in tree.values())
+        self.rss.append(rss)
+        self.max_rss = max(self.max_rss, rss)
+        self.elapsed = time.monotonic() - self.started
+
+    def result(self) -> dict:
+        return {'cpu_percent': round(self.cpu_seconds / self.elapsed * 100, 1) if self.elapsed else 0.0,
+                'cpu_seconds': round(self.cpu_seconds, 2),
+                'rss_mib_avg': round(statistics.mean(self.rss) / 1024 / 1024, 1) if self.rss else 0.0,
+                'rss_mib_max': round(self.max_rss / 1024 / 1024, 1)}
+
+
+class SyntheticOrigin:
+    """
+    Live HLS origin driven by the clock: segment N of every channel is published at started + (N + 1) * duration;
+    the same clock writes clear chunks and playlists to disk for encryptor
+    """
+
+    def __init__(self, channels: int, streams: int, segment_size: int, target_duration: float, hls_dir: str):
+        self.channels = channels
+        self.streams = streams
+        self.segment_size = segment_size
+        self.target_duration = target_duration
+        self.hls_dir = hls_dir
+        self.block = os.urandom(segment_size)
+        self.started = time.time()
+        # время публикации чанков для encryptor по (поток, media sequence)
+        self.published = {}
+
+    def get_published_at(self, media_sequence: int) -> float:
+        return self.started + (media_sequence + 1) * self.target_duration
+
+    def get_last_media_sequence(self) -> int:
+        return int((time.time() - self.started) / self.target_duration) - 1
+
+    def render_playlist(self, name: str, last: int) -> str:
+        first = max(0, last - ORIGIN_WINDOW + 1)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{int(self.target_duration + 0.999)}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        for media_sequence in range(first, last + 1):
+            lines += [f'#EXTINF:{self.target_duration:.3f},', f'{name}_{media_sequence}.ts']
+        return '\n'.join(lines) + '\n'
+
+    async def handle_playlist(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render_playlist(request.match_info['name'], self.get_last_media_sequence()),
+                            content_type='application/vnd.apple.mpegurl')
+
+    async def handle_segment(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.block, content_type='video/mp2t')
+
+    def _sync_publish(self, media_sequence: int) -> None:
+        for stream in range(self.streams):
+            name = f's{stream}'
+            with open(os.path.join(self.hls_dir, f'{name}_{media_sequence}.ts'), 'wb') as f:
+                f.write(self.block)
+            path = os.path.join(self.hls_dir, f'{name}_clear.m3u8')
+            with open(path + '.tmp', 'w') as f:
+                f.write(self.render_playlist(name, media_sequence))
+            os.replace(path + '.tmp', path)
+            self.published[(name, media_sequence)] = time.time()
+            old = os.path.join(self.hls_dir, f'{name}_{media_sequence - ORIGIN_WINDOW * 2}.ts')
+            if os.path.exists(old):
+                os.remove(old)
+
+    async def produce(self) -> None:
+        """Writes clear chunks and playlists for encryptor on the same clock as HTTP origin"""
+
+        loop = asyncio.get_running_loop()
+        media_sequence = 0
+        while True:
+            await asyncio.sleep(max(self.get_published_at(media_sequence) - time.time(), 0))
+            await loop.run_in_executor(None, self._sync_publish, media_sequence)
+            media_sequence += 1
+
+
+async def handle_key(request: web.Request) -> web.Response:
+    delay = request.app['drm_delay']
+    if delay:
+        await asyncio.sleep(delay)
+    digest = hashlib.sha256(request.match_info['content_id'].encode()).hexdigest()
+    return web.json_response({'key': digest[:32], 'iv': digest[32:]})
+
+
+async def start_servers(origin: SyntheticOrigin, origin_port: int, drm_port: int, drm_delay: float) -> list:
+    origin_app = web.Application()
+    origin_app.router.add_get('/live/{name}.m3u8', origin.handle_playlist)
+    origin_app.router.add_get('/live/{name}_{media_sequence}.ts', origin.handle_segment)
+    drm_app = web.Application()
+    drm_app['drm_delay'] = drm_delay
+    drm_app.router.add_get('/keys/{content_id}', handle_key)
+
+    runners = []
+    for app, port in ((origin_app, origin_port), (drm_app, drm_port)):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        runners.append(runner)
+    return runners
+
+
+def write_configs(args, work_dir: str, origin_port: int, drm_port: int, api_port: int) -> None:
+    hls_dir = os.path.join(work_dir, 'hls')
+    os.makedirs(hls_dir, exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+    with open(os.path.join(work_dir, 'pvr.ini'), 'w') as f:
+        f.write(f'[writer]\npvr_dir = {os.path.join(work_dir, "pvr")}\nlayout = {args.layout}\n'
+                f'workers = {args.writer_workers}\nstats_interval = 10\n'
+                f'[plstgen]\nchunk_prefix = http://127.0.0.1:{api_port}/pvr/\n'
+                f'[db]\nurl = sqlite:///{os.path.join(work_dir, "base.sqlite")}\n'
+                f'batch_interval = {args.batch_interval}\n'
+                f'[api]\ntail_interval = 1\n'
+                f'[cleaner]\ninterval = 60\n')
+    with open(os.path.join(work_dir, 'channels.json'), 'w') as f:
+        json.dump([{'source': f'http://127.0.0.1:{origin_port}/live/cam{channel}.m3u8', 'depth_in_hours': 24}
+                   for channel in range(args.channels)], f, indent=2)
+    with open(os.path.join(work_dir, 'streams.json'), 'w') as f:
+        json.dump([{'content_id': f'content{stream}', 'clear_playlist_name': f's{stream}_clear.m3u8'}
+                   for stream in range(args.streams)], f, indent=2)
+    with open(os.path.join(work_dir, 'config.ini'), 'w') as f:
+        f.write(f'[encryptor]\nhls_dir = {hls_dir}\n'
+                f'key_encryptor_url = http://127.0.0.1:{drm_port}/keys/\n'
+                f'key_client_url = https://keys.example/\n'
+                f'chunks_number = 5\nrefresh_interval = 0.1\nclear_playlist_suffix = _clear\n'
+                f'engine = {args.engine}\nstreams_file = streams.json\n'
+                + (f'workers = {args.encrypt_workers}\n' if args.encrypt_workers else '')
+                + f'stats_interval = 10\nwatch_mode = inotify\nwatch_timeout = 10\n'
+                f'key_rotation_segments = {args.key_rotation_segments}\n')
+
+
+async def start_process(work_dir: str, name: str, *command) -> asyncio.subprocess.Process:
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    log = open(os.path.join(work_dir, f'{name}.out'), 'wb')
+    return await asyncio.create_subprocess_exec(sys.executable, *command, cwd=work_dir, env=env,
+                                                stdout=log, stderr=subprocess.STDOUT)
+
+
+async def stop_process(process: asyncio.subprocess.Process, timeout: float = 15) -> None:
+    if process.returncode is not None:
+        return
+    # SIGINT: писатели дописывают БД, пулы процессов останавливаются
+    process.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+def _sync_read_new_rows(db_path: str, last_id: int) -> list:
+    with sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=5) as conn:
+        return conn.execute('SELECT id, channel_name, media_sequence FROM segment WHERE id > ? ORDER BY id',
+                            (last_id,)).fetchall()
+
+
+def _sync_read_encrypted(hls_dir: str, streams: int) -> list:
+    segments = []
+    for stream in range(streams):
+        try:
+            with open(os.path.join(hls_dir, f's{stream}.m3u8')) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            continue
+        media_sequence = 0
+        for line in lines:
+            if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                media_sequence = int(line.split(':')[1])
+            elif line and not line.startswith('#'):
+                segments.append((f's{stream}', media_sequence))
+                media_sequence += 1
+    return segments
+
+
+async def run_live(args, work_dir: str, origin: SyntheticOrigin) -> dict:
+    """Writer and encryptor under load: throughput, latency of recording and encryption, CPU and RSS"""
+
+    loop = asyncio.get_running_loop()
+    db_path = os.path.join(work_dir, 'base.sqlite')
+    hls_dir = os.path.join(work_dir, 'hls')
+    writer = await start_process(work_dir, 'writer', os.path.join(ROOT, 'writer.py'))
+    encryptor = await start_process(work_dir, 'encryptor', os.path.join(ROOT, 'encryptor.py'))
+    samplers = {'writer': ProcessSampler(writer.pid), 'encryptor': ProcessSampler(encryptor.pid)}
+
+    await asyncio.sleep(args.warmup)
+    for sampler in samplers.values():
+        sampler.start()
+    last_id = max((row[0] for row in await loop.run_in_executor(None, _sync_read_new_rows, db_path, 0)),
+                  default=0)
+    seen_encrypted = set(await loop.run_in_executor(None, _sync_read_encrypted, hls_dir, args.streams))
+    record_latencies, encrypt_latencies = [], []
+    recorded = {}
+    started = time.monotonic()
+    next_sample = started
+    while time.monotonic() - started < args.duration:
+        now = time.time()
+        for row_id, channel_name, media_sequence in await loop.run_in_executor(None, _sync_read_new_rows,
+                                                                              db_path, last_id):
+            last_id = row_id
+            recorded.setdefault(channel_name, set()).add(media_sequence)
+            record_latencies.append(now - origin.get_published_at(media_sequence))
+        for segment in await loop.run_in_executor(None, _sync_read_encrypted, hls_dir, args.streams):
+            if segment not in seen_encrypted:
+                seen_encrypted.add(segment)
+                if segment in origin.published:
+                    encrypt_latencies.append(now - origin.published[segment])
+        if time.monotonic() >= next_sample:
+            for sampler in samplers.values():
+                sampler.sample()
+            next_sample += 0.5
+        await asyncio.sleep(args.poll_interval)
+    elapsed = time.monotonic() - started
+
+    await asyncio.gather(stop_process(writer), stop_process(encryptor))
+    return {
+        'writer': {
+            'segments_per_second': round(len(record_latencies) / elapsed, 2),
+            'expected_segments_per_second': round(args.channels / args.target_duration, 2),
+            'channels_recording': len(recorded),
+            'record_latency_ms': summarize(record_latencies),
+            **samplers['writer'].result()},
+        'encryptor': {
+            'segments_per_second': round(len(encrypt_latencies) / elapsed, 2),
+            'expected_segments_per_second': round(args.streams / args.target_duration, 2),
+            'encrypt_latency_ms': summarize(encrypt_latencies),
+            **samplers['encryptor'].result()},
+    }
+
+
+async def fill_archive(hours: float) -> str:
+    from streamer.Db import DbManager
+
+    channel_name = f'archive_{hours:g}h'
+    db_manager = DbManager(batch_interval=1)
+    for media_sequence in range(int(hours * 3600 / ARCHIVE_DURATION)):
+        start_datetime = ARCHIVE_START + datetime.timedelta(seconds=media_sequence * ARCHIVE_DURATION)
+        await db_manager.add_segment(filename=start_datetime.strftime('%Y%m%d_%H%M%S.ts'), duration=ARCHIVE_DURATION,
+                                     start_datetime=start_datetime, original_filename=f'c_{media_sequence}.ts',
+                                     media_sequence=media_sequence, channel_name=channel_name)
+        if len(db_manager.batcher.rows) >= 10000:
+            await db_manager.flush()
+    await db_manager.flush()
+    return channel_name
+
+
+def format_time(value: datetime.datetime) -> str:
+    return value.strftime('%d/%m/%YT%H:%M:%S')
+
+
+async def measure_queries(session: ClientSession, urls: list, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def query(url: str):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.get(url) as resp:
+                await resp.read()
+                if resp.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[query(url) for url in urls])
+    elapsed = time.perf_counter() - started
+    return {'latency_ms': summarize(latencies), 'requests_per_second': round(len(urls) / elapsed, 1),
+            'errors': errors}
+
+
+async def run_api(args, work_dir: str, api_port: int) -> dict:
+    """Playlist and metadata queries to API for archives of several sizes"""
+
+    channels = {}
+    for hours in args.archive_hours:
+        started = time.perf_counter()
+        channels[hours] = await fill_archive(hours)
+        print(f'archive {hours:g}h filled in {time.perf_counter() - started:.1f} s')
+
+    api = await start_process(work_dir, 'api', '-m', 'uvicorn', 'api:app', '--app-dir', ROOT,
+                              '--port', str(api_port), '--log-level', 'warning')
+    sampler = ProcessSampler(api.pid)
+    base_url = f'http://127.0.0.1:{api_port}/streamer'
+    result = {}
+    try:
+        async with ClientSession(connector=TCPConnector(limit=args.concurrency)) as session:
+            for _ in range(100):
+                try:
+                    async with session.get(f'{base_url}/cache') as resp:
+                        if resp.status == 200:
+                            break
+                except OSError:
+                    pass
+                await asyncio.sleep(0.1)
+            sampler.start()
+            for hours, channel_name in channels.items():
+                end = ARCHIVE_START + datetime.timedelta(hours=hours)
+                window = datetime.timedelta(minutes=10)
+                # разные интервалы - без попаданий в кэш
+                starts = [ARCHIVE_START + datetime.timedelta(
+                    seconds=random.randrange(max(int((end - ARCHIVE_START - window).total_seconds()), 1)))
+                    for _ in range(args.requests)]
+                queries = {
+                    'playlist_10m': [f'{base_url}/{channel_name}.m3u8?startTime={format_time(start)}'
+                                     f'&endTime={format_time(start + window)}' for start in starts],
+                    'playlist_full': [f'{base_url}/{channel_name}.m3u8?startTime={format_time(ARCHIVE_START)}'
+                                      f'&endTime={format_time(end)}'] * max(args.requests // 10, 1),
+                    'metadata_full': [f'{base_url}/{channel_name}/metadata?startTime={format_time(ARCHIVE_START)}'
+                                      f'&endTime={format_time(end)}'] * args.requests,
+                }
+                result[f'{hours:g}h'] = {}
+                for name, urls in queries.items():
+                    result[f'{hours:g}h'][name] = await measure_queries(session, urls, args.concurrency)
+                    sampler.sample()
+    finally:
+        await stop_process(api)
+    result.update(sampler.result())
+    return result
+
+
+async def main(args):
+    work_dir = os.path.abspath(args.dir or tempfile.mkdtemp(prefix='e2e_benchmark_'))
+    os.makedirs(work_dir, exist_ok=True)
+    origin_port, drm_port, api_port = get_free_port(), get_free_port(), get_free_port()
+    write_configs(args, work_dir, origin_port=origin_port, drm_port=drm_port, api_port=api_port)
+    # streamer читает pvr.ini и пишет логи относительно текущей папки
+    os.chdir(work_dir)
+    from streamer.Db import DbManager
+    await DbManager().create_db()
+
+    origin = SyntheticOrigin(channels=args.channels, streams=args.streams, segment_size=args.segment_size,
+                             target_duration=args.target_duration, hls_dir=os.path.join(work_dir, 'hls'))
+    runners = await start_servers(origin, origin_port=origin_port, drm_port=drm_port, drm_delay=args.drm_delay)
+    producer = asyncio.create_task(origin.produce())
+    try:
+        results = await run_live(args, work_dir, origin)
+    finally:
+        producer.cancel()
+        for runner in runners:
+            await runner.cleanup()
+    if args.archive_hours:
+        results['api'] = await run_api(args, work_dir, api_port=api_port)
+
+    return {'meta': {**get_commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                     'python': platform.python_version(), 'cpus': os.cpu_count(), 'work_dir': work_dir,
+                     'params': {key: value for key, value in vars(args).items()
+                                if key not in ('output', 'dir', 'compare')}},
+            **results}
+
+
+def flatten(data: dict, prefix: str = '') -> dict:
+    values = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[f'{prefix}{key}'] = value
+    return values
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f'old: {old["meta"].get("commit")}  new: {new["meta"].get("commit")}')
+    old_params, new_params = old['meta'].get('params', {}), new['meta'].get('params', {})
+    for key in sorted(set(old_params) | set(new_params)):
+        if old_params.get(key) != new_params.get(key):
+            print(f'parameter {key} differs: {old_params.get(key)} -> {new_params.get(key)}')
+    old_values, new_values = flatten(old), flatten(new)
+    for key in sorted(set(old_values) & set(new_values)):
+        if key.startswith('meta.'):
+            continue
+        before, after = old_values[key], new_values[key]
+        change = f'{(after - before) / before * 100:+8.1f}%' if before else '         '
+        print(f'{key:60} {before:>12} {after:>12} {change}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=10, help='channels recorded by writer')
+    parser.add_argument('--streams', type=int, default=10, help='live streams encrypted by encryptor')
+    parser.add_argument('--segment-size', type=int, default=500_000)
+    parser.add_argument('--target-duration', type=float, default=2)
+    parser.add_argument('--duration', type=float, default=30, help='measurement of writer and encryptor, seconds')
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='resolution of latency measurement')
+    parser.add_argument('--layout', default='flat')
+    parser.add_argument('--writer-workers', type=int, default=0)
+    parser.add_argument('--batch-interval', type=float, default=1)
+    parser.add_argument('--engine', default='builtin')
+    parser.add_argument('--encrypt-workers', type=int, default=0, help='0 - number of CPUs')
+    parser.add_argument('--key-rotation-segments', type=int, default=0)
+    parser.add_argument('--drm-delay', type=float, default=0, help='response delay of fake DRM server, seconds')
+    parser.add_argument('--archive-hours', type=lambda value: [float(hours) for hours in value.split(',') if hours],
+                        default=[1, 24, 168], help='archive sizes for API queries, empty - no API benchmark')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--dir', help='working directory, by default temporary')
+    parser.add_argument('--output', help='JSON file with results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two JSON results')
+    args_ = parser.parse_args()
+
+    if args_.compare:
+        compare(*args_.compare)
+        sys.exit()
+    output = os.path.abspath(args_.output) if args_.output else None
+    results_ = asyncio.run(main(args_))
+    text = json.dumps(results_, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
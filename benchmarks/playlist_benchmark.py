@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Latency and peak memory of VOD playlist rendering: m3u8 objects (previous implementation)
+against streaming renderer, for 1 hour, 24 hours and 7 days of 2-second chunks
+
+python benchmarks/playlist_benchmark.py
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import m3u8
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streamer.Db import DbManager  # noqa: E402
+from streamer.PlaylistGenerator import PlaylistGenerator  # noqa: E402
+
+START = datetime.datetime(2024, 6, 1)
+DURATION = 2
+CHANNEL = 'camera0'
+CHUNK_PREFIX = 'http://127.0.0.1/pvr/'
+
+
+async def render_with_m3u8(generator: PlaylistGenerator, from_datetime: datetime.datetime,
+                           to_datetime: datetime.datetime) -> str:
+    """Previous implementation of PlaylistGenerator.generate_vod_playlist"""
+
+    await generator._get_segments_from_db(from_datetime=from_datetime, to_datetime=to_datetime)
+    playlist = m3u8.model.M3U8()
+    prev_media_sequence = None
+    for segment in generator.segments:
+        media_sequence = segment.media_sequence
+        discontinuity = prev_media_sequence is not None and media_sequence - prev_media_sequence != 1
+        uri = os.path.join(generator.chunk_prefix, generator.channel_name, segment.filename)
+        playlist.add_segment(m3u8.model.Segment(uri=uri, duration=segment.duration, discontinuity=discontinuity))
+        prev_media_sequence = media_sequence
+    playlist.files = [segment.filename for segment in generator.segments]
+    playlist.is_variant = False
+    playlist.__dict__['media_sequence'] = 1
+    playlist.__dict__['version'] = 3
+    playlist.__dict__['target_duration'] = generator.segments[0].duration
+    playlist.__dict__['playlist_type'] = 'VOD'
+    playlist.__dict__['is_endlist'] = True
+    return playlist.dumps()
+
+
+async def render_streaming(generator: PlaylistGenerator, from_datetime: datetime.datetime,
+                           to_datetime: datetime.datetime) -> str:
+    parts = await generator.stream_vod_playlist(from_datetime=from_datetime, to_datetime=to_datetime)
+    size = 0
+    # как StreamingResponse: части отдаются клиенту и не накапливаются
+    async for part in parts:
+        size += len(part)
+    return size
+
+
+async def measure(render, db_manager: DbManager, hours: float):
+    generator = PlaylistGenerator(channel_name=CHANNEL, db_manager=db_manager, chunk_prefix=CHUNK_PREFIX)
+    from_datetime = START
+    to_datetime = START + datetime.timedelta(hours=hours)
+
+    started = time.perf_counter()
+    await render(generator, from_datetime, to_datetime)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    await render(generator, from_datetime, to_datetime)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_manager = DbManager(url=f'sqlite:///{os.path.join(tmp_dir, "bench.sqlite")}', batch_interval=1)
+        await db_manager.create_db()
+        for media_sequence in range(int(args.days * 24 * 3600 / DURATION)):
+            # дыра раз в час, чтобы в плейлисте были #EXT-X-DISCONTINUITY
+            if media_sequence % 1800 == 1799:
+                continue
+            await db_manager.add_segment(filename=f'{media_sequence}.ts', duration=DURATION,
+                                         start_datetime=START + datetime.timedelta(seconds=media_sequence * DURATION),
+                                         original_filename=f'c_{media_sequence}.ts', media_sequence=media_sequence,
+                                         channel_name=CHANNEL)
+            if len(db_manager.batcher.rows) >= 10000:
+                await db_manager.flush()
+        await db_manager.flush()
+
+        generator = PlaylistGenerator(channel_name=CHANNEL, db_manager=db_manager, chunk_prefix=CHUNK_PREFIX)
+        check_to = START + datetime.timedelta(hours=2)
+        if await render_with_m3u8(generator, START, check_to) != \
+                await generator.generate_vod_playlist(from_datetime=START, to_datetime=check_to):
+            raise SystemExit('playlists differ')
+
+        for hours in (1, 24, args.days * 24):
+            for name, render in (('m3u8', render_with_m3u8), ('streaming', render_streaming)):
+                elapsed, peak = await measure(render, db_manager, hours)
+                print(f'{hours:6.0f}h {name:10} {elapsed * 1000:10.1f} ms  peak {peak / 1024 / 1024:8.1f} MiB')
+        print('outputs are identical')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=float, default=7)
+    asyncio.run(main(parser.parse_args()))
@@ -2,25 +2,109 @@
 # -*- coding: utf-8 -*-
 
 import os
+import json
+import asyncio
 import configparser
+from asyncio import sleep
+from typing import List
 
-from streamer import HlsEncryptor
+from streamer import HlsEncryptor, EncryptorPool
+from streamer.HlsEncryptor import remove_unknown_files
+from streamer.KeyManager import KeyManager
+from streamer.MetricsServer import MetricsServer
+from streamer.PlaylistWatcher import PlaylistWatcher
+from streamer.logs import configure_logging, logger
 
 PWD = os.getcwd()
 
 
+async def encrypt(encryptor_: HlsEncryptor, pool: EncryptorPool, watcher: PlaylistWatcher):
+    while True:
+        try:
+            new_segment, _, media_sequence = encryptor_.check_for_new_segment()
+        except Exception as e:
+            logger.error(f'Cant read clear playlist of {encryptor_.content_id}: {e} - {e.__class__.__name__}')
+            await sleep(refresh_interval)
+            continue
+        if new_segment:
+            try:
+                await encryptor_.async_update_encrypted_data(segment=new_segment, media_sequence=media_sequence,
+                                                             pool=pool)
+            except Exception as e:
+                # чанк пропускается (например, уже удален упаковщиком), остальные потоки продолжают шифрование
+                encryptor_.encrypt_errors.inc()
+                logger.error(f'Cant encrypt chunk {new_segment.uri} of {encryptor_.content_id}, skipped: '
+                             f'{e} - {e.__class__.__name__}')
+        else:
+            await watcher.wait(encryptor_.source_name, timeout=watch_timeout)
+
+
+async def report(pool: EncryptorPool, stats_interval: float):
+    while True:
+        await sleep(stats_interval)
+        pool.report()
+
+
+async def process_streams(streams: List, pool: EncryptorPool, watcher: PlaylistWatcher, stats_interval: float):
+    # ключи всех потоков запрашиваются асинхронно и кэшируются, следующий ключ ротации запрашивается заранее
+    key_manager = KeyManager(key_encryptor_url=key_encryptor_url, key_client_url=key_client_url, ttl=key_ttl)
+    encryptors = [HlsEncryptor(content_id=stream['content_id'], source_name=stream['clear_playlist_name'],
+                               storage=hls_dir, key_encryptor_url=key_encryptor_url,
+                               key_client_url=key_client_url, engine=engine, key_manager=key_manager,
+                               rotation_segments=rotation_segments, rotation_seconds=rotation_seconds)
+                  for stream in streams]
+    # шифрованные чанки восстановленных окон остаются, остальные файлы прошлого запуска удаляются
+    remove_unknown_files(hls_dir, encryptors)
+    tasks = [asyncio.create_task(encrypt(encryptor_, pool, watcher)) for encryptor_ in encryptors]
+    tasks.append(asyncio.create_task(report(pool, stats_interval)))
+    if metrics_server is not None:
+        await metrics_server.start()
+
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        watcher.close()
+        pool.shutdown()
+        await key_manager.close()
+        if metrics_server is not None:
+            await metrics_server.close()
+
+
 if __name__ == '__main__':
     config = configparser.ConfigParser()
     config.read("config.ini")
+    configure_logging(config['logging'] if config.has_section('logging') else None)
     hls_dir = config['encryptor']['hls_dir']
     key_encryptor_url = config['encryptor']['key_encryptor_url']
     key_client_url = config['encryptor']['key_client_url']
     chunks_number = int(config['encryptor']['chunks_number'])
-    refresh_interval = int(config['encryptor']['refresh_interval'])
-    content_id = config['encryptor']['content_id']
+    refresh_interval = float(config['encryptor']['refresh_interval'])
     clear_playlist_suffix = config['encryptor']['clear_playlist_suffix']
-    clear_playlist_name = config['encryptor']['clear_playlist_name']
+    engine = config['encryptor'].get('engine', 'builtin')
+    streams_file = config['encryptor'].get('streams_file')
+    # inotify (с откатом на polling, если недоступен) или poll - проверка mtime плейлиста раз в refresh_interval
+    watch_mode = config['encryptor'].get('watch_mode', 'inotify')
+    watch_timeout = config['encryptor'].getfloat('watch_timeout', fallback=10)
+    # ротация ключа каждые key_rotation_segments чанков и/или key_rotation_seconds секунд (0 - без ротации)
+    rotation_segments = config['encryptor'].getint('key_rotation_segments', fallback=0)
+    rotation_seconds = config['encryptor'].getfloat('key_rotation_seconds', fallback=0)
+    key_ttl = config['encryptor'].getfloat('key_ttl', fallback=3600)
+    # метрики Prometheus на http://host:port/metrics, без секции [metrics] - выключены
+    metrics_server = MetricsServer.from_config(config['metrics'] if config.has_section('metrics') else None)
+    watcher_ = PlaylistWatcher(directory=hls_dir, poll_interval=refresh_interval,
+                               use_inotify=watch_mode == 'inotify')
 
-    encryptor = HlsEncryptor(content_id=content_id, source_name=clear_playlist_name, storage=hls_dir,
-                             key_encryptor_url=key_encryptor_url, key_client_url=key_client_url )
-    encryptor.process()
+    if streams_file:
+        # один демон на много потоков, шифрование в пуле процессов
+        with open(streams_file, encoding='utf-8') as f:
+            streams_ = json.load(f)
+        workers = config['encryptor'].getint('workers', fallback=None)
+    else:
+        streams_ = [{'content_id': config['encryptor']['content_id'],
+                     'clear_playlist_name': config['encryptor']['clear_playlist_name']}]
+        workers = config['encryptor'].getint('workers', fallback=1)
+    max_queue = config['encryptor'].getint('max_queue', fallback=None)
+    stats_interval = config['encryptor'].getfloat('stats_interval', fallback=60)
+    pool_ = EncryptorPool(workers=workers, max_queue=max_queue)
+    asyncio.run(process_streams(streams=streams_, pool=pool_, watcher=watcher_,
+                                stats_interval=stats_interval))
@@ -1,13 +1,37 @@
+import argparse
 import asyncio
+import datetime
 
 from streamer.Db import DbManager
+from streamer.PlaylistGenerator import PlaylistGenerator
 
 
-async def init_db():
+async def init_db(rebuild: bool = False):
     db_manager = DbManager()
     await db_manager.create_db()
+    if rebuild:
+        await rebuild_recordings()
+
+
+async def rebuild_recordings():
+    """Fills recording table from existing segments and checks it against segment walk"""
+
+    db_manager = DbManager(batch_interval=0)
+    for channel_name in await db_manager.get_channel_names():
+        await db_manager.rebuild_recordings(channel_name=channel_name)
+        generator = PlaylistGenerator(channel_name=channel_name, db_manager=db_manager, chunk_prefix='')
+        expected = await generator.get_metadata_from_segments(from_datetime=datetime.datetime.min,
+                                                              to_datetime=datetime.datetime.max)
+        actual = await generator.get_metadata_for_interval(from_datetime=datetime.datetime.min,
+                                                           to_datetime=datetime.datetime.max)
+        status = 'ok' if actual == expected else 'MISMATCH'
+        print(f'{channel_name}: {len(actual)} recording intervals, {status}')
 
 
 if __name__ == '__main__':
-    asyncio.run(init_db())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rebuild-recordings', action='store_true',
+                        help='recalculate recording intervals (/metadata) for existing segments')
+    args = parser.parse_args()
 
+    asyncio.run(init_db(rebuild=args.rebuild_recordings))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Moves chunks of existing archive to another layout (flat <-> hourly buckets) and updates their names in db.
+Chunks in container files (packed layout) are not moved. writer should be stopped while migrating.
+
+python migrate_archive.py --layout hourly
+"""
+import argparse
+import asyncio
+import configparser
+import os
+
+from streamer.Db import DbManager
+from streamer.HlsWriter import LAYOUT_FLAT, LAYOUT_HOURLY, get_segment_name
+
+
+def move_segments(storage: os.path, moves: dict) -> int:
+    """
+    :param moves: {old name: new name} relative to the channel storage
+    :return: number of moved files
+    """
+
+    moved = 0
+    created_dirs = set()
+    for old_name, new_name in moves.items():
+        old_path = os.path.join(storage, old_name)
+        new_path = os.path.join(storage, new_name)
+        new_dir = os.path.dirname(new_path)
+        if new_dir not in created_dirs:
+            os.makedirs(new_dir, exist_ok=True)
+            created_dirs.add(new_dir)
+        try:
+            os.replace(old_path, new_path)
+            moved += 1
+        except FileNotFoundError:
+            # уже перенесен прерванным запуском или удален очисткой
+            pass
+    return moved
+
+
+async def migrate(storage: os.path, layout: str, batch_size: int = 1000):
+    db_manager = DbManager(batch_interval=0)
+    loop = asyncio.get_running_loop()
+    last_id = 0
+    checked = 0
+    moved = 0
+    updated = 0
+    while True:
+        rows = await db_manager.get_segments_after(last_id=last_id, limit=batch_size)
+        if not rows:
+            break
+        last_id = rows[-1].id
+        checked += len(rows)
+
+        moves_by_channel = {}
+        filenames = {}
+        for row in rows:
+            if row.byte_length is not None:
+                continue
+            new_name = get_segment_name(start_datetime=row.start_datetime, layout=layout)
+            if new_name != row.filename:
+                moves_by_channel.setdefault(row.channel_name, {})[row.filename] = new_name
+                filenames[row.id] = new_name
+
+        # сначала файлы, потом записи: прерванный запуск можно повторить
+        for channel_name, moves in moves_by_channel.items():
+            moved += await loop.run_in_executor(None, move_segments, os.path.join(storage, channel_name), moves)
+        await db_manager.update_segment_filenames(filenames)
+        updated += len(filenames)
+        print(f'{checked} chunks checked, {moved} files moved, {updated} rows updated', end='\r')
+    print(f'{checked} chunks checked, {moved} files moved, {updated} rows updated')
+
+
+if __name__ == '__main__':
+    config = configparser.ConfigParser()
+    config.read("pvr.ini")
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--layout', choices=(LAYOUT_FLAT, LAYOUT_HOURLY),
+                        default=config['writer'].get('layout', fallback=LAYOUT_FLAT),
+                        help='target archive layout, by default layout from pvr.ini')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+    if args.layout not in (LAYOUT_FLAT, LAYOUT_HOURLY):
+        parser.error(f'chunks cant be migrated to {args.layout} layout')
+
+    asyncio.run(migrate(storage=config['writer']['pvr_dir'], layout=args.layout, batch_size=args.batch_size))
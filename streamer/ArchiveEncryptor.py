@@ -0,0 +1,94 @@
+import asyncio
+import os
+from typing import Dict, Optional
+
+from streamer.Db import DbManager
+from streamer.EncryptedSegmentCache import EncryptedSegmentCache
+from streamer.KeyManager import DrmKey, KeyManager
+from streamer.SegmentCipher import SegmentCipher
+
+
+class ArchiveEncryptor:
+    """
+    Encrypts clear archive segments on request (AES-128, as HlsEncryptor does for live)
+    with DRM key of the channel; encrypted segments are cached, concurrent requests of one segment share encryption
+    """
+
+    def __init__(self, storage: os.path, key_manager: KeyManager, cache: EncryptedSegmentCache,
+                 db_manager: DbManager = None, content_id: str = None):
+        """
+        :param storage: archive directory (pvr_dir)
+        :param content_id: content id of all channels, by default content id is the channel name
+        """
+
+        self.storage = storage
+        self.key_manager = key_manager
+        self.cache = cache
+        self.db_manager = db_manager if db_manager is not None else DbManager()
+        self.content_id = content_id
+        self.in_progress: Dict[str, asyncio.Future] = {}
+
+    async def get_key(self, channel_name: str) -> DrmKey:
+        return await self.key_manager.get(self.content_id or channel_name)
+
+    @staticmethod
+    def _sync_encrypt(path: os.path, byte_offset: Optional[int], byte_length: Optional[int],
+                      cipher: SegmentCipher) -> bytes:
+        with open(path, 'rb') as f:
+            if byte_length is None:
+                data = f.read()
+            else:
+                # чанк внутри часового контейнера (раскладка packed)
+                data = os.pread(f.fileno(), byte_length, byte_offset)
+        return cipher.encrypt_bytes(data)
+
+    async def _encrypt(self, channel_name: str, segment_id: int, key: DrmKey) -> Optional[bytes]:
+        segment = await self.db_manager.get_segment(segment_id=segment_id, channel_name=channel_name)
+        if segment is None:
+            return None
+        path = os.path.join(self.storage, channel_name, segment.filename)
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._sync_encrypt, path, segment.byte_offset,
+                                              segment.byte_length, key.cipher)
+        except FileNotFoundError:
+            return None
+
+    async def _get_key_by_id(self, channel_name: str, key_id: str) -> Optional[DrmKey]:
+        key = self.key_manager.get_by_id(key_id)
+        if key is not None and key.content_id == (self.content_id or channel_name):
+            return key
+        # после перезапуска API ключ известен, только если DRM-сервер отдает тот же ключ
+        key = await self.get_key(channel_name)
+        return key if key.key_id == key_id else None
+
+    async def get_segment(self, channel_name: str, segment_id: int, key_id: str) -> Optional[bytes]:
+        """
+        :param key_id: id of the key of the playlist (segment is encrypted with the key named in #EXT-X-KEY,
+        even if the key of the channel has been changed since the playlist was rendered)
+        :return: encrypted segment or None if there is no such segment or the key is unknown
+        """
+
+        key = await self._get_key_by_id(channel_name=channel_name, key_id=key_id)
+        if key is None:
+            return None
+        name = f'{channel_name}_{segment_id}_{key.key_id}.ts'
+        data = await self.cache.get(name)
+        if data is not None:
+            return data
+
+        future = self.in_progress.get(name)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = self.in_progress[name] = asyncio.get_running_loop().create_future()
+        try:
+            data = await self._encrypt(channel_name=channel_name, segment_id=segment_id, key=key)
+            if data is not None:
+                await self.cache.put(name, data)
+            future.set_result(data)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.in_progress[name]
+        return data
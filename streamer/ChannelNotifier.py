@@ -0,0 +1,41 @@
+import asyncio
+from typing import Dict
+
+from streamer.SegmentTail import SegmentTail
+
+
+class ChannelNotifier:
+    """
+    Wakes all requests waiting for new segments of a channel (blocking playlist reload)
+    by one notification from SegmentTail, waiting requests do not query db
+    """
+
+    def __init__(self, tail: SegmentTail):
+        self.tail = tail
+        self.conditions: Dict[str, asyncio.Condition] = {}
+        tail.subscribe(self._on_new_segments)
+
+    def _on_new_segments(self, channel_name: str, segments) -> None:
+        condition = self.conditions.get(channel_name)
+        if condition is not None:
+            asyncio.get_running_loop().create_task(self._notify(condition))
+
+    @staticmethod
+    async def _notify(condition: asyncio.Condition) -> None:
+        async with condition:
+            condition.notify_all()
+
+    async def wait_for_change(self, channel_name: str, version: int, timeout: float) -> bool:
+        """
+        :param version: version of the channel (SegmentTail.get_version) known to the caller
+        :return: True if the channel has new segments, False on timeout
+        """
+
+        condition = self.conditions.setdefault(channel_name, asyncio.Condition())
+        try:
+            async with condition:
+                await asyncio.wait_for(condition.wait_for(lambda: self.tail.get_version(channel_name) != version),
+                                       timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
@@ -0,0 +1,169 @@
+import asyncio
+import datetime
+import os
+import re
+from typing import List, Optional, Tuple
+
+import anyio
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from streamer.Db import DbManager
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+# файл, смещение и длина куска клипа
+ClipPiece = Tuple[str, int, int]
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+ZERO_COPY_EXTENSION = 'http.response.zerocopysend'
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(range_header: Optional[str], total_length: int) -> Optional[Tuple[int, int]]:
+    """
+    :param range_header: value of Range header, only single range is supported
+    :return: first and last byte of the range, None to send the whole clip
+    :raises RangeNotSatisfiable: if the range is out of the clip
+    """
+
+    if not range_header:
+        return None
+    match = RANGE_PATTERN.match(range_header.strip())
+    if match is None:
+        # несколько диапазонов или другие единицы: отдаем клип целиком
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # bytes=-N - последние N байт
+        first, last = max(total_length - int(last), 0), total_length - 1
+    else:
+        first = int(first)
+        last = min(int(last), total_length - 1) if last else total_length - 1
+    if first >= total_length or first > last:
+        raise RangeNotSatisfiable()
+    return first, last
+
+
+def slice_pieces(pieces: List[ClipPiece], first: int, last: int) -> List[ClipPiece]:
+    """Pieces of bytes first..last (inclusive) of the clip"""
+
+    result = []
+    position = 0
+    for path, offset, length in pieces:
+        piece_first = max(first, position)
+        piece_last = min(last, position + length - 1)
+        if piece_first <= piece_last:
+            result.append((path, offset + piece_first - position, piece_last - piece_first + 1))
+        position += length
+        if position > last:
+            break
+    return result
+
+
+class ClipResponse(Response):
+    """
+    Sends pieces of files back-to-back without loading the clip into memory:
+    by zero-copy send (sendfile) of ASGI server if it supports the extension,
+    otherwise by chunks of chunk_size read with pread in a thread
+    """
+
+    media_type = 'video/mp2t'
+
+    def __init__(self, pieces: List[ClipPiece], status_code: int = 200, headers: dict = None,
+                 chunk_size: int = 1024 * 1024):
+        self.pieces = pieces
+        self.chunk_size = chunk_size
+        self.status_code = status_code
+        self.background = None
+        headers = dict(headers or {})
+        headers['content-length'] = str(sum(length for _, _, length in pieces))
+        headers['accept-ranges'] = 'bytes'
+        self.init_headers(headers)
+
+    async def _send_zero_copy(self, send: Send) -> None:
+        for index, (path, offset, length) in enumerate(self.pieces):
+            with open(path, 'rb') as f:
+                await send({'type': ZERO_COPY_EXTENSION, 'file': f, 'offset': offset, 'count': length,
+                            'more_body': index < len(self.pieces) - 1})
+
+    async def _send_chunks(self, send: Send) -> None:
+        for path, offset, length in self.pieces:
+            fd = await anyio.to_thread.run_sync(os.open, path, os.O_RDONLY)
+            try:
+                end = offset + length
+                while offset < end:
+                    chunk = await anyio.to_thread.run_sync(os.pread, fd, min(self.chunk_size, end - offset), offset)
+                    if not chunk:
+                        # файл укоротился (удален очисткой) - длина ответа уже объявлена, обрываем соединение
+                        raise EOFError(f'{path} is shorter than expected')
+                    offset += len(chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                os.close(fd)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def _listen_for_disconnect(self, receive: Receive) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if not self.pieces:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+        if ZERO_COPY_EXTENSION in scope.get('extensions', {}):
+            await self._send_zero_copy(send)
+            return
+
+        async with anyio.create_task_group() as task_group:
+            async def stream():
+                await self._send_chunks(send)
+                task_group.cancel_scope.cancel()
+
+            task_group.start_soon(stream)
+            await self._listen_for_disconnect(receive)
+            task_group.cancel_scope.cancel()
+
+
+class ClipExporter:
+    """Resolves segments of the channel in time interval to pieces of archive files"""
+
+    def __init__(self, channel_name: str, storage: os.path, db_manager: DbManager = None):
+        """
+        :param storage: archive directory (pvr_dir), files of the channel are in storage/channel_name
+        """
+
+        self.channel_name = channel_name
+        self.storage = storage
+        self.db_manager = db_manager if db_manager is not None else DbManager()
+
+    def _sync_get_pieces(self, segments: List) -> List[ClipPiece]:
+        pieces = []
+        for segment in segments:
+            path = os.path.join(self.storage, self.channel_name, segment.filename)
+            if segment.byte_length is not None:
+                # чанк в часовом контейнере (раскладка packed)
+                pieces.append((path, segment.byte_offset, segment.byte_length))
+                continue
+            try:
+                pieces.append((path, 0, os.stat(path).st_size))
+            except FileNotFoundError:
+                logger.warning(f'chunk {segment.filename} of {self.channel_name} is in db, but not in storage')
+        return pieces
+
+    async def get_pieces(self, from_datetime: datetime.datetime,
+                         to_datetime: datetime.datetime) -> List[ClipPiece]:
+        segments = await self.db_manager.get_segments(from_datetime=from_datetime,
+                                                      to_datetime=to_datetime,
+                                                      channel_name=self.channel_name)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._sync_get_pieces, segments)
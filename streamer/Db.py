@@ -1,19 +1,34 @@
+import configparser
 import datetime
 import asyncio
+import logging
+import time
 
 import sqlalchemy.exc
 from sqlalchemy_aio import ASYNCIO_STRATEGY
-from typing import List
+from typing import AsyncIterator, List, Dict, Optional
 
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
 
 from sqlalchemy import (
-    Column, Integer, String, DateTime, Float, MetaData, Table, Text, create_engine, select)
-from sqlalchemy.schema import CreateTable, DropTable
+    Column, Integer, String, DateTime, Float, Index, MetaData, Table, bindparam, create_engine, event, select)
 
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
 
-from streamer.logs import logger
+from streamer.Metrics import Counter, Histogram
+from streamer.logs import capture_logger, get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_DB_URL = 'sqlite:///base.sqlite'
+
+DB_INSERT_SECONDS = Histogram('db_insert_seconds', 'Segment insert transaction time (batch or one segment)')
+DB_INSERTED_SEGMENTS = Counter('db_inserted_segments_total', 'Segments inserted to db')
+DB_INSERT_ERRORS = Counter('db_insert_errors_total', 'Failed segment insert transactions')
+DB_DROPPED_SEGMENTS = Counter('db_dropped_segments_total', 'Segments dropped after failed insert attempts')
+DB_DELETE_SECONDS = Histogram('db_delete_seconds', 'Segment delete transaction time')
+# запас в секундах, компенсирующий неточность расчета старта чанка (для исключения ложных дыр)
+RECORDING_GAP_MARGIN = 2
 
 metadata = MetaData()
 segments = Table(
@@ -24,42 +39,474 @@ segments = Table(
     Column('filename', String),
     Column('start_datetime', DateTime),
     Column('duration', Float),
-    Column('media_sequence', Integer)
+    Column('media_sequence', Integer),
+    # положение чанка в часовом контейнере (раскладка packed), для отдельных файлов чанков - NULL
+    Column('byte_offset', Integer),
+    Column('byte_length', Integer),
+    # сквозной номер чанка в канале (в порядке добавления) и номер его непрерывного участка - для live playlist:
+    # в отличие от media_sequence источника не уменьшаются после его перезапуска; у старых строк - NULL
+    Column('position', Integer),
+    Column('discontinuity_sequence', Integer),
+    # все выборки идут по каналу и интервалу времени
+    Index('ix_segment_channel_name_start_datetime', 'channel_name', 'start_datetime'),
+    Index('ix_segment_channel_name_position', 'channel_name', 'position'),
+    # удаление контейнеров packed и поиск файлов без записей при очистке архива
+    Index('ix_segment_channel_name_filename', 'channel_name', 'filename')
+)
+
+# непрерывные интервалы записи по каналам, обновляются writer при добавлении чанков
+recordings = Table(
+    'recording', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('channel_name', String),
+    Column('start_datetime', DateTime),
+    Column('last_start_datetime', DateTime),
+    Column('end_datetime', DateTime),
+    Index('ix_recording_channel_name_start_datetime', 'channel_name', 'start_datetime')
 )
 
+_engines = {}
+_batchers = {}
+_trackers = {}
+_sequencers = {}
+
+
+def continues_recording(end_datetime: datetime.datetime, start_datetime: datetime.datetime) -> bool:
+    """
+    :param end_datetime: end of the previous segment (start + duration)
+    :param start_datetime: start of the next segment
+    :return: True if there is no gap between segments
+    """
+
+    return start_datetime < end_datetime + datetime.timedelta(seconds=RECORDING_GAP_MARGIN)
+
+
+def _read_db_config() -> configparser.SectionProxy:
+    config = configparser.ConfigParser()
+    config.read("pvr.ini")
+    if not config.has_section('db'):
+        config.add_section('db')
+    return config['db']
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # WAL: читатели (API) не блокируют писателя (writer) и наоборот
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.close()
+
+
+def get_engine(url: str = None, echo: bool = None):
+    """
+    Returns engine shared by all DbManagers of the process
+    :param url: db url, by default [db] url from pvr.ini or sqlite:///base.sqlite
+    :param echo: log all statements, by default [db] echo from pvr.ini or False
+    """
+
+    db_config = _read_db_config()
+    url = url or db_config.get('url', DEFAULT_DB_URL)
+    if url not in _engines:
+        if echo is None:
+            echo = db_config.getboolean('echo', fallback=False)
+        if echo and capture_logger('sqlalchemy.engine', logging.INFO):
+            # запросы пишутся в лог через очередь, а не в stdout из цикла событий
+            echo = False
+        engine = create_engine(url, echo=echo, strategy=ASYNCIO_STRATEGY)
+        if url.startswith('sqlite'):
+            event.listen(engine.sync_engine, 'connect', _set_sqlite_pragmas)
+        _engines[url] = engine
+    return _engines[url]
+
+
+@asynccontextmanager
+async def begin(engine):
+    """
+    Like engine.begin(), but stops the worker thread of the connection on exit
+    (engine.begin() of sqlalchemy_aio leaves one thread per transaction)
+    """
+
+    async with engine.connect() as conn:
+        async with conn.begin():
+            yield conn
+
+
+def _create_schema(engine) -> None:
+    metadata.create_all(engine)
+    # create_all не добавляет колонки в уже существующие таблицы
+    for table in metadata.sorted_tables:
+        existing_columns = {column['name'] for column in sqlalchemy.inspect(engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                logger.info(f'Adding column {table.name}.{column.name}')
+                engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                               f'{column.type.compile(engine.dialect)}')
+    # create_all не добавляет индексы в уже существующие таблицы
+    for table in metadata.sorted_tables:
+        existing_indexes = {index['name'] for index in sqlalchemy.inspect(engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info(f'Creating index {index.name}')
+                index.create(engine)
+
+
+class RecordingState:
+    def __init__(self, recording_id: Optional[int], start_datetime: datetime.datetime,
+                 last_start_datetime: datetime.datetime, end_datetime: datetime.datetime):
+        self.id = recording_id
+        self.start_datetime = start_datetime
+        self.last_start_datetime = last_start_datetime
+        self.end_datetime = end_datetime
+        self.dirty = False
+
+
+class RecordingTracker:
+    """Extends the last recording interval of the channel or starts a new one for every inserted segment"""
+
+    def __init__(self):
+        self.states: Dict[str, Optional[RecordingState]] = {}
+
+    async def _load(self, conn, channel_name: str) -> Optional[RecordingState]:
+        query = select([recordings]).where(recordings.columns.channel_name == channel_name) \
+            .order_by(recordings.columns.start_datetime.desc()).limit(1)
+        execution = await conn.execute(query)
+        row = await execution.first()
+        if row is None:
+            return None
+        return RecordingState(recording_id=row.id, start_datetime=row.start_datetime,
+                              last_start_datetime=row.last_start_datetime, end_datetime=row.end_datetime)
+
+    async def _save(self, conn, channel_name: str, state: RecordingState) -> None:
+        values = dict(last_start_datetime=state.last_start_datetime,
+                      end_datetime=state.end_datetime)
+        if state.id is not None:
+            # начало интервала не перезаписывается: его может сдвинуть очистка архива
+            execution = await conn.execute(recordings.update().where(recordings.columns.id == state.id)
+                                           .values(**values))
+            if execution.rowcount:
+                state.dirty = False
+                return
+        # интервал новый или уже удален при очистке архива
+        execution = await conn.execute(recordings.insert().values(channel_name=channel_name,
+                                                                  start_datetime=state.start_datetime,
+                                                                  **values))
+        state.id = execution.inserted_primary_key[0]
+        state.dirty = False
+
+    async def _merge(self, conn, channel_name: str, start_datetime: datetime.datetime,
+                     end_datetime: datetime.datetime) -> RecordingState:
+        """
+        Adds segment inserted out of order of start to the intervals it touches (merging them if it fills the gap)
+        or to a new interval
+        :return: the last interval of the channel
+        """
+
+        state = self.states[channel_name]
+        if state.dirty:
+            await self._save(conn, channel_name, state)
+        margin = datetime.timedelta(seconds=RECORDING_GAP_MARGIN)
+        query = select([recordings]).where(and_(recordings.columns.channel_name == channel_name,
+                                                recordings.columns.start_datetime < end_datetime + margin,
+                                                recordings.columns.end_datetime > start_datetime - margin)) \
+            .order_by(recordings.columns.start_datetime.asc())
+        execution = await conn.execute(query)
+        touched = await execution.fetchall()
+        if not touched:
+            await conn.execute(recordings.insert().values(channel_name=channel_name,
+                                                          start_datetime=start_datetime,
+                                                          last_start_datetime=start_datetime,
+                                                          end_datetime=end_datetime))
+            return state
+        merged = RecordingState(recording_id=touched[0].id,
+                                start_datetime=min(start_datetime, touched[0].start_datetime),
+                                last_start_datetime=max([start_datetime] + [row.last_start_datetime
+                                                                            for row in touched]),
+                                end_datetime=max([end_datetime] + [row.end_datetime for row in touched]))
+        await conn.execute(recordings.update().where(recordings.columns.id == merged.id)
+                           .values(start_datetime=merged.start_datetime,
+                                   last_start_datetime=merged.last_start_datetime,
+                                   end_datetime=merged.end_datetime))
+        if len(touched) > 1:
+            await conn.execute(recordings.delete().where(recordings.columns.id.in_([row.id for row in touched[1:]])))
+        # последний интервал канала мог слиться с предыдущими
+        if state.id in {row.id for row in touched}:
+            return merged
+        return state
+
+    async def add(self, conn, rows: List[Dict]) -> None:
+        """
+        Updates recording table for inserted segments (within the same transaction)
+        :param conn: connection with started transaction
+        :param rows: inserted segments in order of insertion
+        """
+
+        changed = {}
+        for row in rows:
+            channel_name = row['channel_name']
+            if channel_name not in self.states:
+                self.states[channel_name] = await self._load(conn, channel_name)
+            state = self.states[channel_name]
+            end_datetime = row['start_datetime'] + datetime.timedelta(seconds=row['duration'])
+            if state is not None and row['start_datetime'] < state.last_start_datetime:
+                # чанк старше последнего (запись после перезапуска writer с отставшим playlist) - редкий случай
+                state = self.states[channel_name] = await self._merge(conn, channel_name,
+                                                                      start_datetime=row['start_datetime'],
+                                                                      end_datetime=end_datetime)
+                changed.pop(channel_name, None)
+                continue
+            if state is not None and continues_recording(state.end_datetime, row['start_datetime']):
+                state.last_start_datetime = max(state.last_start_datetime, row['start_datetime'])
+                state.end_datetime = max(state.end_datetime, end_datetime)
+            else:
+                if state is not None and state.dirty:
+                    await self._save(conn, channel_name, state)
+                state = self.states[channel_name] = RecordingState(recording_id=None,
+                                                                   start_datetime=row['start_datetime'],
+                                                                   last_start_datetime=row['start_datetime'],
+                                                                   end_datetime=end_datetime)
+            state.dirty = True
+            changed[channel_name] = state
+        for channel_name, state in changed.items():
+            await self._save(conn, channel_name, state)
+
+    def reset(self, channel_name: str = None) -> None:
+        if channel_name is None:
+            self.states = {}
+        else:
+            self.states.pop(channel_name, None)
+
+
+def get_tracker(engine) -> RecordingTracker:
+    if engine not in _trackers:
+        _trackers[engine] = RecordingTracker()
+    return _trackers[engine]
+
+
+class SequenceState:
+    def __init__(self, position: int, media_sequence: Optional[int], discontinuity_sequence: int):
+        self.position = position
+        self.media_sequence = media_sequence
+        self.discontinuity_sequence = discontinuity_sequence
+
+
+class SegmentSequencer:
+    """
+    Numbers inserted segments of every channel: position grows by one per segment,
+    discontinuity_sequence - every time media sequence of the source does not follow the previous one
+    """
 
-class DbManager:
     def __init__(self):
-        self.engine = create_engine('sqlite:///base.sqlite', echo=True, strategy=ASYNCIO_STRATEGY)
-        # self.conn = await self.engine.connect()
+        self.states: Dict[str, SequenceState] = {}
+
+    async def _load(self, conn, channel_name: str) -> SequenceState:
+        query = select([segments.columns.position,
+                        segments.columns.media_sequence,
+                        segments.columns.discontinuity_sequence
+                        ]).where(and_(segments.columns.channel_name == channel_name,
+                                      segments.columns.position.isnot(None))
+                                 ).order_by(segments.columns.position.desc()).limit(1)
+        execution = await conn.execute(query)
+        row = await execution.first()
+        if row is None:
+            return SequenceState(position=-1, media_sequence=None, discontinuity_sequence=0)
+        return SequenceState(position=row.position, media_sequence=row.media_sequence,
+                             discontinuity_sequence=row.discontinuity_sequence)
+
+    async def number(self, conn, rows: List[Dict]) -> None:
+        """
+        Sets position and discontinuity_sequence of segments before their insert (within the same transaction)
+        :param rows: segments in order of insertion
+        """
+
+        for row in rows:
+            channel_name = row['channel_name']
+            if channel_name not in self.states:
+                self.states[channel_name] = await self._load(conn, channel_name)
+            state = self.states[channel_name]
+            state.position += 1
+            if state.media_sequence is not None and row['media_sequence'] - state.media_sequence != 1:
+                state.discontinuity_sequence += 1
+            state.media_sequence = row['media_sequence']
+            row['position'] = state.position
+            row['discontinuity_sequence'] = state.discontinuity_sequence
+
+    def reset(self) -> None:
+        self.states = {}
+
+
+def get_sequencer(engine) -> SegmentSequencer:
+    if engine not in _sequencers:
+        _sequencers[engine] = SegmentSequencer()
+    return _sequencers[engine]
+
+
+class SegmentBatcher:
+    """
+    Write-behind buffer: segments from all channels are inserted by one transaction per interval;
+    a batch failed max_attempts times in a row is inserted row by row and rows which still fail are dropped
+    """
+
+    def __init__(self, engine, interval: float = 1, max_batch: int = 1000, max_attempts: int = 10):
+        self.engine = engine
+        self.tracker = get_tracker(engine)
+        self.sequencer = get_sequencer(engine)
+        self.interval = interval
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        # неудачные попытки вставки первого пакета подряд
+        self.attempts = 0
+        self.rows = []
+        self.task = None
+        self.lock = asyncio.Lock()
+
+    def add(self, row: Dict) -> None:
+        self.rows.append(row)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while self.rows:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def _insert(self, rows: List[Dict]) -> None:
+        try:
+            async with begin(self.engine) as conn:
+                await self.sequencer.number(conn, rows)
+                await conn.execute(segments.insert(), rows)
+                await self.tracker.add(conn, rows)
+        except sqlalchemy.exc.SQLAlchemyError:
+            DB_INSERT_ERRORS.inc()
+            self.tracker.reset()
+            self.sequencer.reset()
+            raise
+
+    async def _insert_one_by_one(self, rows: List[Dict]) -> int:
+        """
+        Isolates rows which can not be inserted, they are dropped
+        (their files are removed by the orphan sweep of retention if it is enabled)
+        :return: number of inserted rows
+        """
+
+        inserted = 0
+        for row in rows:
+            try:
+                await self._insert([row])
+                inserted += 1
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                DB_DROPPED_SEGMENTS.inc()
+                logger.error(f'Segment {row["filename"]} of {row["channel_name"]} has been dropped '
+                             f'after {self.max_attempts} failed inserts: {e} - {e.__class__.__name__}')
+        return inserted
+
+    async def flush(self) -> None:
+        async with self.lock:
+            while self.rows:
+                rows, self.rows = self.rows[:self.max_batch], self.rows[self.max_batch:]
+                started = time.perf_counter()
+                if self.attempts >= self.max_attempts:
+                    self.attempts = 0
+                    inserted = await self._insert_one_by_one(rows)
+                else:
+                    try:
+                        await self._insert(rows)
+                    except sqlalchemy.exc.SQLAlchemyError as e:
+                        self.attempts += 1
+                        logger.error(f'Cant insert {len(rows)} segments to db (attempt {self.attempts}): '
+                                     f'{e} - {e.__class__.__name__}')
+                        # не теряем чанки, повторим на следующем интервале
+                        self.rows = rows + self.rows
+                        return
+                    self.attempts = 0
+                    inserted = len(rows)
+                DB_INSERT_SECONDS.observe(time.perf_counter() - started)
+                DB_INSERTED_SEGMENTS.inc(inserted)
+                logger.debug(f'{inserted} segments have been inserted to db')
+
+
+class DbManager:
+    def __init__(self, url: str = None, batch_interval: float = None):
+        """
+        :param url: db url (see get_engine)
+        :param batch_interval: flush interval of batched inserts in seconds, 0 - insert every segment immediately;
+        by default [db] batch_interval from pvr.ini or 0 ([db] batch_max_attempts - failed inserts of a batch
+        before it is inserted row by row)
+        """
+
+        self.engine = get_engine(url)
+        self.tracker = get_tracker(self.engine)
+        self.sequencer = get_sequencer(self.engine)
+        db_config = _read_db_config()
+        if batch_interval is None:
+            batch_interval = db_config.getfloat('batch_interval', fallback=0)
+        self.batcher = None
+        if batch_interval > 0:
+            if self.engine not in _batchers:
+                _batchers[self.engine] = SegmentBatcher(self.engine, interval=batch_interval,
+                                                        max_attempts=db_config.getint('batch_max_attempts',
+                                                                                      fallback=10))
+            self.batcher = _batchers[self.engine]
 
     async def create_db(self):
-        await self.engine.execute(CreateTable(segments))
+        """Creates absent tables and indexes, so it can be run on existing db as migration"""
+
+        await self.engine.run_in_thread(_create_schema, self.engine.sync_engine)
 
     async def add_segment(self, filename: str, duration: float,
                           start_datetime: datetime.datetime,
                           original_filename: str,
                           media_sequence: int,
-                          channel_name: str) -> bool:
-        async with self.engine.connect() as conn:
-            # try:
-            await conn.execute(segments.insert().values(filename=filename,
-                                                        start_datetime=start_datetime,
-                                                        duration=duration,
-                                                        original_filename=original_filename,
-                                                        media_sequence=media_sequence,
-                                                        channel_name=channel_name))
+                          channel_name: str,
+                          byte_offset: int = None,
+                          byte_length: int = None) -> bool:
+        """
+        :param byte_offset: offset of the segment in container file (packed layout)
+        :param byte_length: length of the segment in container file (packed layout)
+        """
+
+        # у всех строк пакета одинаковый набор колонок (executemany)
+        row = dict(filename=filename,
+                   start_datetime=start_datetime,
+                   duration=duration,
+                   original_filename=original_filename,
+                   media_sequence=media_sequence,
+                   channel_name=channel_name,
+                   byte_offset=byte_offset,
+                   byte_length=byte_length)
+        if self.batcher is not None:
+            self.batcher.add(row)
             return True
-            # except sqlalchemy.exc.IntegrityError:
-            #     logger.warning(f'chunk {original_filename} already in db')
-            #     return False
+        started = time.perf_counter()
+        try:
+            async with begin(self.engine) as conn:
+                await self.sequencer.number(conn, [row])
+                await conn.execute(segments.insert().values(**row))
+                await self.tracker.add(conn, [row])
+        except sqlalchemy.exc.SQLAlchemyError:
+            # состояние каналов в памяти опережает откаченную транзакцию
+            self.tracker.reset(channel_name)
+            self.sequencer.reset()
+            raise
+        DB_INSERT_SECONDS.observe(time.perf_counter() - started)
+        DB_INSERTED_SEGMENTS.inc()
+        return True
+
+    async def flush(self) -> None:
+        """Writes batched segments to db"""
+
+        if self.batcher is not None:
+            await self.batcher.flush()
 
     async def get_segments(self, from_datetime: datetime.datetime,
                            to_datetime: datetime.datetime, channel_name: str) -> List[str]:
-        query = select([segments.columns.filename,
+        query = select([segments.columns.id,
+                        segments.columns.filename,
                         segments.columns.start_datetime,
                         segments.columns.duration,
-                        segments.columns.media_sequence
+                        segments.columns.media_sequence,
+                        segments.columns.byte_offset,
+                        segments.columns.byte_length
                         ]).where(and_(segments.columns.start_datetime >= from_datetime,
                                       segments.columns.start_datetime <= to_datetime,
                                       segments.columns.channel_name == channel_name
@@ -70,10 +517,303 @@ class DbManager:
             result = await execution.fetchall()
         return [segment for segment in result]
 
-    async def delete_segments(self, older_then: datetime.datetime, channel_name: str) -> None:
+    async def iter_segments(self, from_datetime: datetime.datetime,
+                            to_datetime: datetime.datetime, channel_name: str,
+                            batch_size: int = 1000) -> AsyncIterator[List]:
+        """Same as get_segments, but yields rows by batches from the cursor"""
+
+        query = select([segments.columns.id,
+                        segments.columns.filename,
+                        segments.columns.start_datetime,
+                        segments.columns.duration,
+                        segments.columns.media_sequence,
+                        segments.columns.byte_offset,
+                        segments.columns.byte_length
+                        ]).where(and_(segments.columns.start_datetime >= from_datetime,
+                                      segments.columns.start_datetime <= to_datetime,
+                                      segments.columns.channel_name == channel_name
+                                      )).order_by(segments.columns.start_datetime.asc())
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            try:
+                while True:
+                    rows = await execution.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                await execution.close()
+
+    async def get_segment(self, segment_id: int, channel_name: str):
+        """Segment by id or None"""
+
+        query = select([segments.columns.filename,
+                        segments.columns.byte_offset,
+                        segments.columns.byte_length
+                        ]).where(and_(segments.columns.id == segment_id,
+                                      segments.columns.channel_name == channel_name))
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return await execution.first()
+
+    async def get_interval_summary(self, from_datetime: datetime.datetime,
+                                   to_datetime: datetime.datetime, channel_name: str):
+        """
+        Max segment duration (None if there are no segments) and max byte length
+        (None if there are no segments in container files) in the interval
+        """
+
+        query = select([sqlalchemy.func.max(segments.columns.duration).label('max_duration'),
+                        sqlalchemy.func.max(segments.columns.byte_length).label('max_byte_length')
+                        ]).where(and_(segments.columns.start_datetime >= from_datetime,
+                                      segments.columns.start_datetime <= to_datetime,
+                                      segments.columns.channel_name == channel_name))
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return await execution.first()
+
+    async def get_last_segment_id(self) -> int:
+        async with self.engine.connect() as conn:
+            last_id = await conn.scalar(select([sqlalchemy.func.max(segments.columns.id)]))
+        return last_id or 0
+
+    async def get_segments_after(self, last_id: int, limit: int = 1000) -> List:
+        """
+        Returns segments of all channels inserted after segment with last_id (tail of the table by primary key)
+        """
+
+        query = select([segments.columns.id,
+                        segments.columns.channel_name,
+                        segments.columns.filename,
+                        segments.columns.start_datetime,
+                        segments.columns.duration,
+                        segments.columns.media_sequence,
+                        segments.columns.byte_offset,
+                        segments.columns.byte_length
+                        ]).where(segments.columns.id > last_id).order_by(segments.columns.id.asc()).limit(limit)
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            result = await execution.fetchall()
+        return result
+
+    async def delete_segments(self, older_then: datetime.datetime, channel_name: str) -> int:
+        """:return: number of deleted segments"""
+
+        started = time.perf_counter()
+        async with begin(self.engine) as conn:
+            result = await conn.execute(segments.delete().where(and_(segments.columns.start_datetime < older_then,
+                                                                     segments.columns.channel_name == channel_name)))
+            await self._trim_recordings(conn, channel_name=channel_name)
+        DB_DELETE_SECONDS.observe(time.perf_counter() - started)
+        return result.rowcount
+
+    async def update_segment_filenames(self, filenames: Dict[int, str]) -> None:
+        """
+        Sets new filenames of segments (archive layout migration)
+        :param filenames: {segment id: new filename}
+        """
+
+        if not filenames:
+            return
+        query = segments.update().where(segments.columns.id == bindparam('segment_id')) \
+            .values(filename=bindparam('new_filename'))
+        async with begin(self.engine) as conn:
+            await conn.execute(query, [dict(segment_id=segment_id, new_filename=filename)
+                                       for segment_id, filename in filenames.items()])
+
+    async def delete_segments_by_filenames(self, filenames: List[str], channel_name: str) -> int:
+        """
+        Deletes all segments stored in the files (container files of packed layout)
+        :return: number of deleted segments
+        """
+
+        started = time.perf_counter()
+        async with begin(self.engine) as conn:
+            result = await conn.execute(segments.delete().where(and_(segments.columns.filename.in_(filenames),
+                                                                     segments.columns.channel_name == channel_name)))
+            await self._trim_recordings(conn, channel_name=channel_name)
+        DB_DELETE_SECONDS.observe(time.perf_counter() - started)
+        return result.rowcount
+
+    async def delete_segments_in_dirs(self, dirs: List[str], channel_name: str,
+                                      older_then: datetime.datetime, batch_size: int = 100) -> int:
+        """
+        Deletes segments stored in the directories (removed hourly buckets)
+        :param dirs: directories relative to the channel storage, e.g. 2024/06/01/13
+        :param older_then: all the directories hold segments started before this datetime (limits the scan)
+        :return: number of deleted segments
+        """
+
+        started = time.perf_counter()
+        deleted = 0
+        async with begin(self.engine) as conn:
+            # условия по частям: глубина выражения в sqlite ограничена
+            for index in range(0, len(dirs), batch_size):
+                in_dirs = or_(*(segments.columns.filename.like(f'{path}/%')
+                                for path in dirs[index:index + batch_size]))
+                result = await conn.execute(segments.delete().where(and_(
+                    segments.columns.channel_name == channel_name,
+                    segments.columns.start_datetime < older_then,
+                    in_dirs)))
+                deleted += result.rowcount
+            await self._trim_recordings(conn, channel_name=channel_name)
+        DB_DELETE_SECONDS.observe(time.perf_counter() - started)
+        return deleted
+
+    async def delete_segments_by_ids(self, ids: List[int], channel_name: str) -> None:
+        started = time.perf_counter()
+        async with begin(self.engine) as conn:
+            await conn.execute(segments.delete().where(segments.columns.id.in_(ids)))
+            await self._trim_recordings(conn, channel_name=channel_name)
+        DB_DELETE_SECONDS.observe(time.perf_counter() - started)
+
+    async def get_existing_filenames(self, filenames: List[str], channel_name: str) -> set:
+        """:return: those of the files which are referenced by segments of the channel"""
+
+        query = select([segments.columns.filename]).distinct() \
+            .where(and_(segments.columns.channel_name == channel_name,
+                        segments.columns.filename.in_(filenames)))
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return {row.filename for row in await execution.fetchall()}
+
+    async def get_oldest_segments(self, channel_name: str, limit: int,
+                                  older_then: datetime.datetime = None) -> List:
+        """
+        The oldest segments of the channel (for retention)
+        :param older_then: only segments started before this datetime
+        """
+
+        condition = segments.columns.channel_name == channel_name
+        if older_then is not None:
+            condition = and_(condition, segments.columns.start_datetime < older_then)
+        query = select([segments.columns.id,
+                        segments.columns.filename,
+                        segments.columns.start_datetime
+                        ]).where(condition).order_by(segments.columns.start_datetime.asc()).limit(limit)
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return await execution.fetchall()
+
+    async def _trim_recordings(self, conn, channel_name: str) -> None:
+        """Cuts recording intervals of the channel by its oldest remaining segment"""
+
+        first_start = await conn.scalar(select([sqlalchemy.func.min(segments.columns.start_datetime)])
+                                        .where(segments.columns.channel_name == channel_name))
+        if first_start is None:
+            await conn.execute(recordings.delete().where(recordings.columns.channel_name == channel_name))
+            return
+        await conn.execute(recordings.delete().where(and_(recordings.columns.last_start_datetime < first_start,
+                                                          recordings.columns.channel_name == channel_name)))
+        await conn.execute(recordings.update().where(and_(recordings.columns.start_datetime < first_start,
+                                                          recordings.columns.channel_name == channel_name))
+                           .values(start_datetime=first_start))
+
+    async def get_recordings(self, from_datetime: datetime.datetime,
+                             to_datetime: datetime.datetime, channel_name: str) -> List:
+        """Recording intervals having segments started within the interval"""
+
+        query = select([recordings.columns.start_datetime,
+                        recordings.columns.last_start_datetime,
+                        recordings.columns.end_datetime
+                        ]).where(and_(recordings.columns.channel_name == channel_name,
+                                      recordings.columns.start_datetime <= to_datetime,
+                                      recordings.columns.last_start_datetime >= from_datetime
+                                      )).order_by(recordings.columns.start_datetime.asc())
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return await execution.fetchall()
+
+    async def get_first_segment_after(self, from_datetime: datetime.datetime, channel_name: str):
+        """The first segment started at from_datetime or later"""
+
+        query = select([segments.columns.start_datetime,
+                        segments.columns.duration
+                        ]).where(and_(segments.columns.channel_name == channel_name,
+                                      segments.columns.start_datetime >= from_datetime
+                                      )).order_by(segments.columns.start_datetime.asc()).limit(1)
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return await execution.first()
+
+    async def get_last_segment_before(self, to_datetime: datetime.datetime, channel_name: str):
+        """The last segment started at to_datetime or earlier"""
+
+        query = select([segments.columns.start_datetime,
+                        segments.columns.duration
+                        ]).where(and_(segments.columns.channel_name == channel_name,
+                                      segments.columns.start_datetime <= to_datetime
+                                      )).order_by(segments.columns.start_datetime.desc()).limit(1)
+
         async with self.engine.connect() as conn:
-            await conn.execute(segments.delete().where(and_(segments.columns.start_datetime < older_then,
-                                                            segments.columns.channel_name == channel_name)))
+            execution = await conn.execute(query)
+            return await execution.first()
+
+    async def get_live_segments(self, from_datetime: datetime.datetime, channel_name: str) -> List:
+        """
+        Numbered segments started at from_datetime or later in order of their position (for live playlist)
+        """
+
+        query = select([segments.columns.id,
+                        segments.columns.filename,
+                        segments.columns.start_datetime,
+                        segments.columns.duration,
+                        segments.columns.media_sequence,
+                        segments.columns.byte_offset,
+                        segments.columns.byte_length,
+                        segments.columns.position,
+                        segments.columns.discontinuity_sequence
+                        ]).where(and_(segments.columns.channel_name == channel_name,
+                                      segments.columns.start_datetime >= from_datetime,
+                                      segments.columns.position.isnot(None)
+                                      )).order_by(segments.columns.position.asc())
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            result = await execution.fetchall()
+        return result
+
+    async def get_last_saved_segment(self, channel_name: str):
+        """The latest segment of the channel with its name and media sequence in the source playlist"""
+
+        query = select([segments.columns.original_filename,
+                        segments.columns.media_sequence
+                        ]).where(segments.columns.channel_name == channel_name
+                                 ).order_by(segments.columns.start_datetime.desc()).limit(1)
+
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(query)
+            return await execution.first()
+
+    async def get_channel_names(self) -> List[str]:
+        async with self.engine.connect() as conn:
+            execution = await conn.execute(select([segments.columns.channel_name]).distinct())
+            return [row.channel_name for row in await execution.fetchall()]
+
+    async def rebuild_recordings(self, channel_name: str, batch_size: int = 10000) -> None:
+        """Recalculates recording intervals of the channel from its segments"""
+
+        await self.flush()
+        async with begin(self.engine) as conn:
+            await conn.execute(recordings.delete().where(recordings.columns.channel_name == channel_name))
+        self.tracker.reset(channel_name)
+
+        async for rows in self.iter_segments(from_datetime=datetime.datetime.min,
+                                             to_datetime=datetime.datetime.max,
+                                             channel_name=channel_name,
+                                             batch_size=batch_size):
+            async with begin(self.engine) as conn:
+                await self.tracker.add(conn, [dict(channel_name=channel_name,
+                                                   start_datetime=row.start_datetime,
+                                                   duration=row.duration) for row in rows])
 
 
 if __name__ == '__main__':
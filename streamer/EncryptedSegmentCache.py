@@ -0,0 +1,111 @@
+import asyncio
+import math
+import os
+from collections import OrderedDict
+from typing import Optional
+
+from streamer.PlaylistCache import PlaylistCache
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class EncryptedSegmentCache:
+    """
+    Two-level LRU cache of encrypted segments: memory (max_bytes) and directory on disk (max_disk_bytes);
+    segments evicted from memory stay on disk, disk cache survives restarts
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, directory: os.path = None, max_disk_bytes: int = 0):
+        self.memory = PlaylistCache(max_entries=max(max_bytes // 1024, 1), max_bytes=max_bytes, ttl=0,
+                                    historical_ttl=math.inf)
+        self.directory = directory if max_disk_bytes > 0 else None
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_entries = OrderedDict()
+        self.disk_bytes = 0
+        self.disk_hits = 0
+        if self.directory is not None:
+            self._load_disk_entries()
+
+    def _load_disk_entries(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        with os.scandir(self.directory) as entries:
+            files = [(entry.stat().st_mtime, entry.name, entry.stat().st_size) for entry in entries
+                     if entry.is_file() and entry.name.endswith('.ts')]
+        for _, name, size in sorted(files):
+            self.disk_entries[name] = size
+            self.disk_bytes += size
+
+    def _get_path(self, name: str) -> os.path:
+        return os.path.join(self.directory, name)
+
+    def _sync_read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self._get_path(name), 'rb') as f:
+                data = f.read()
+            # порядок вытеснения после перезапуска - по mtime
+            os.utime(self._get_path(name))
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _sync_write(self, name: str, data: bytes) -> None:
+        tmp_path = self._get_path(f'.{name}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self._get_path(name))
+
+    def _sync_remove(self, names) -> None:
+        for name in names:
+            try:
+                os.remove(self._get_path(name))
+            except FileNotFoundError:
+                pass
+
+    async def get(self, name: str) -> Optional[bytes]:
+        """
+        :param name: file name of the segment in the cache (unique for segment and key)
+        """
+
+        data = self.memory.get(name, version=None)
+        if data is not None or name not in self.disk_entries:
+            return data
+        self.disk_entries.move_to_end(name)
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, self._sync_read, name)
+        if data is None:
+            self.disk_bytes -= self.disk_entries.pop(name, 0)
+            return None
+        self.disk_hits += 1
+        self.memory.put(name, data, version=None)
+        return data
+
+    async def put(self, name: str, data: bytes) -> None:
+        self.memory.put(name, data, version=None)
+        if self.directory is None or len(data) > self.max_disk_bytes or name in self.disk_entries:
+            return
+
+        self.disk_entries[name] = len(data)
+        self.disk_bytes += len(data)
+        evicted = []
+        while self.disk_bytes > self.max_disk_bytes:
+            evicted_name, size = self.disk_entries.popitem(last=False)
+            self.disk_bytes -= size
+            evicted.append(evicted_name)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._sync_write, name, data)
+            if evicted:
+                await loop.run_in_executor(None, self._sync_remove, evicted)
+        except OSError as e:
+            logger.error(f'Cant write encrypted segment {name} to cache: {e} - {e.__class__.__name__}')
+            self.disk_bytes -= self.disk_entries.pop(name, 0)
+
+    def stats(self) -> dict:
+        return {
+            'memory': self.memory.stats(),
+            'disk_entries': len(self.disk_entries),
+            'disk_bytes': self.disk_bytes,
+            'max_disk_bytes': self.max_disk_bytes,
+            'disk_hits': self.disk_hits,
+        }
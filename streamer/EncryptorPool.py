@@ -0,0 +1,81 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+
+from streamer.SegmentCipher import encrypt_file, ENGINE_BUILTIN
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class StreamStats:
+    def __init__(self):
+        self.segments = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def add(self, latency: float) -> None:
+        self.segments += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_latency = latency
+
+    @property
+    def avg_latency(self) -> float:
+        return self.total_latency / self.segments if self.segments else 0.0
+
+
+class EncryptorPool:
+    """Bounded pool of worker processes for CPU-bound chunk encryption shared by all streams"""
+
+    def __init__(self, workers: int = None, max_queue: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or self.workers * 4
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.stats: Dict[str, StreamStats] = {}
+        self._slots = None
+
+    async def encrypt(self, stream_name: str, input_file: os.path, output_file: os.path,
+                      key: str, iv: str, engine: str = ENGINE_BUILTIN) -> None:
+        """
+        Encrypts file in one of worker processes; waits for a free slot if queue is full
+        :param stream_name: stream the chunk belongs to (for logging)
+        """
+
+        if self._slots is None:
+            # семафор создается внутри работающего loop
+            self._slots = asyncio.Semaphore(self.max_queue)
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            async with self._slots:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, encrypt_file,
+                                           input_file, output_file, key, iv, engine)
+        except Exception as e:
+            logger.error(f'Cant encrypt {input_file} for stream {stream_name}: {e} - {e.__class__.__name__}')
+            raise
+        finally:
+            self.queue_depth -= 1
+
+    def record_latency(self, stream_name: str, latency: float) -> None:
+        self.stats.setdefault(stream_name, StreamStats()).add(latency)
+
+    def report(self) -> None:
+        """Logs per-stream latency and queue depth since the previous report"""
+
+        logger.info(f'Encryptor pool: workers {self.workers}, queue depth {self.queue_depth}, '
+                    f'max queue depth {self.max_queue_depth} of {self.max_queue}')
+        for stream_name, stats in self.stats.items():
+            logger.info(f'Stream {stream_name}: {stats.segments} segments, '
+                        f'latency avg {stats.avg_latency:.3f}s, max {stats.max_latency:.3f}s, '
+                        f'last {stats.last_latency:.3f}s')
+        self.stats = {}
+        self.max_queue_depth = self.queue_depth
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
@@ -1,33 +1,184 @@
+import asyncio
 import datetime
 import os
+import shutil
 import time
-import _thread
+from concurrent.futures import Executor
+from typing import List
 
 from streamer import HlsWriter
-from streamer.logs import logger
+from streamer.HlsWriter import LAYOUT_FLAT, LAYOUT_HOURLY, LAYOUT_PACKED
+from streamer.Metrics import Counter, Histogram
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+RETENTION_SECONDS = Histogram('hls_retention_seconds', 'Removal time of expired segments of a channel')
+SEGMENTS_REMOVED = Counter('hls_retention_removed_segments_total', 'Segments removed from archive', ('channel',))
 
 
 class HlsDeleter(HlsWriter):
-    def __init__(self, storage: os.path, depth_in_hours: float, channel_name: str):
-        super().__init__(source_url=None, storage=storage, channel_name=channel_name)
+    def __init__(self, storage: os.path, depth_in_hours: float, channel_name: str, layout: str = LAYOUT_FLAT):
+        super().__init__(source_url=None, storage=storage, channel_name=channel_name, layout=layout)
         self.depth_in_hours = depth_in_hours
+        self.removed_segments = SEGMENTS_REMOVED.labels(channel_name)
 
     def _get_the_oldest_date(self):
         return datetime.datetime.utcnow() - datetime.timedelta(hours=self.depth_in_hours)
 
-    async def _clear_db(self):
-        await self.db_manager.delete_segments(older_then=self._get_the_oldest_date(),
-                                              channel_name=self.channel_name)
+    def _sync_remove_files(self, segment_names: List[str]) -> None:
+        for segment_name in segment_names:
+            try:
+                os.remove(self._get_segment_path(segment_name))
+                logger.debug(f'old chunk {segment_name} has been removed', extra={'channel': self.channel_name})
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _get_numeric_dirs(path: os.path) -> List[str]:
+        with os.scandir(path) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir() and entry.name.isdigit())
+
+    def _sync_remove_buckets(self, older_then: datetime.datetime) -> List[str]:
+        """
+        Removes hourly buckets (YYYY/MM/DD/HH) ended before older_then, one directory removal per bucket;
+        only bucket directories are listed, not segments
+        :return: removed buckets relative to the channel storage
+        """
+
+        removed = []
+        for year in self._get_numeric_dirs(self.storage):
+            year_dir = os.path.join(self.storage, year)
+            if datetime.datetime(int(year), 1, 1) >= older_then:
+                break
+            for month in self._get_numeric_dirs(year_dir):
+                month_dir = os.path.join(year_dir, month)
+                if datetime.datetime(int(year), int(month), 1) >= older_then:
+                    break
+                for day in self._get_numeric_dirs(month_dir):
+                    day_dir = os.path.join(month_dir, day)
+                    if datetime.datetime(int(year), int(month), int(day)) >= older_then:
+                        break
+                    for hour in self._get_numeric_dirs(day_dir):
+                        bucket_end = datetime.datetime(int(year), int(month), int(day), int(hour)) \
+                                     + datetime.timedelta(hours=1)
+                        if bucket_end > older_then:
+                            break
+                        shutil.rmtree(os.path.join(day_dir, hour), ignore_errors=True)
+                        removed.append(f'{year}/{month}/{day}/{hour}')
+                        logger.debug(f'old bucket {year}/{month}/{day}/{hour} has been removed',
+                                     extra={'channel': self.channel_name})
+                    # пустые папки дня, месяца и года больше не нужны
+                    for path in (day_dir, month_dir, year_dir):
+                        try:
+                            os.rmdir(path)
+                        except OSError:
+                            break
+        return removed
+
+    def _sync_list_files(self, modified_before: float) -> List[str]:
+        """
+        :param modified_before: unix time, newer files (being downloaded or appended) are skipped
+        :return: files of segments and containers (with .part of downloads) relative to the channel storage
+        """
+
+        names = []
+        for root, _, files in os.walk(self.storage):
+            for name in files:
+                if '.ts' not in name:
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.stat(path).st_mtime >= modified_before:
+                        continue
+                except FileNotFoundError:
+                    continue
+                names.append(os.path.relpath(path, self.storage).replace(os.sep, '/'))
+        return sorted(names)
+
+    async def remove_orphans(self, min_age: float, executor: Executor = None, batch_size: int = 500) -> int:
+        """
+        Removes files without db rows: .part of interrupted downloads, segments whose rows were not inserted
+        (batch dropped by db writer) or already deleted
+        :param min_age: only files not modified for min_age seconds (rows of new files are inserted after download)
+        :return: number of removed files
+        """
+
+        loop = asyncio.get_running_loop()
+        names = await loop.run_in_executor(executor, self._sync_list_files, time.time() - min_age)
+        removed = 0
+        for index in range(0, len(names), batch_size):
+            batch = names[index:index + batch_size]
+            known = await self.db_manager.get_existing_filenames(filenames=batch, channel_name=self.channel_name)
+            orphans = [name for name in batch if name not in known]
+            if orphans:
+                await loop.run_in_executor(executor, self._sync_remove_files, orphans)
+                removed += len(orphans)
+        if removed:
+            logger.info(f'{removed} files without db records of {self.channel_name} have been removed')
+        return removed
+
+    async def remove_segments(self, rows: List, executor: Executor = None) -> int:
+        """
+        Removes files of segments and then their rows,
+        so a failure in between leaves rows which will be removed next time
+        :param rows: segments (id, filename)
+        :param executor: executor for blocking file removal
+        :return: number of removed segments
+        """
+
+        loop = asyncio.get_running_loop()
+        if self.layout == LAYOUT_PACKED:
+            # контейнер удаляется целиком вместе со всеми своими чанками
+            filenames = sorted({row.filename for row in rows})
+            await loop.run_in_executor(executor, self._sync_remove_files, filenames)
+            removed = await self.db_manager.delete_segments_by_filenames(filenames=filenames,
+                                                                         channel_name=self.channel_name)
+            self.removed_segments.inc(removed)
+            return removed
+        await loop.run_in_executor(executor, self._sync_remove_files, [row.filename for row in rows])
+        await self.db_manager.delete_segments_by_ids(ids=[row.id for row in rows], channel_name=self.channel_name)
+        self.removed_segments.inc(len(rows))
+        return len(rows)
+
+    async def remove_buckets(self, older_then: datetime.datetime, executor: Executor = None) -> int:
+        """
+        Removes whole hourly buckets ended before older_then and then rows of their segments
+        (rows of other files, e.g. flat segments left after layout migration, are removed by the row-driven pass)
+        :return: number of removed segments
+        """
 
-    def _get_file_last_modification_time(self, file: os.DirEntry) -> datetime.datetime:
-        return datetime.datetime.utcfromtimestamp(os.path.getmtime(os.path.join(self.storage, file.name)))
+        bucket_older_then = older_then.replace(minute=0, second=0, microsecond=0)
+        loop = asyncio.get_running_loop()
+        buckets = await loop.run_in_executor(executor, self._sync_remove_buckets, bucket_older_then)
+        if not buckets:
+            return 0
+        removed = await self.db_manager.delete_segments_in_dirs(dirs=buckets, channel_name=self.channel_name,
+                                                                older_then=bucket_older_then)
+        self.removed_segments.inc(removed)
+        logger.debug(f'{len(buckets)} old buckets ({removed} chunks) of {self.channel_name} have been removed')
+        return removed
 
-    def _sync_clear_storage(self):
-        for file in os.scandir(self.storage):
-            if self._get_file_last_modification_time(file) < self._get_the_oldest_date():
-                os.remove(os.path.join(self.storage, file.name))
-                logger.debug(f'old chunk {file.name} has been removed')
+    async def clear_storage_and_db(self, executor: Executor = None, batch_size: int = 500) -> int:
+        """
+        Removes segments older than depth_in_hours: whole expired hourly buckets for hourly layout,
+        the rest (segments of the current bucket or of flat archive) by db rows in batches;
+        for packed layout only whole expired containers are removed
+        :return: number of removed segments
+        """
 
-    async def clear_storage_and_db(self):
-        await self._clear_db()
-        _thread.start_new_thread(self._sync_clear_storage, ())
+        started = time.perf_counter()
+        older_then = self._get_the_oldest_date()
+        removed = 0
+        if self.layout == LAYOUT_HOURLY:
+            removed += await self.remove_buckets(older_then=older_then, executor=executor)
+        elif self.layout == LAYOUT_PACKED:
+            older_then = older_then.replace(minute=0, second=0, microsecond=0)
+        while True:
+            rows = await self.db_manager.get_oldest_segments(channel_name=self.channel_name, limit=batch_size,
+                                                             older_then=older_then)
+            if rows:
+                removed += await self.remove_segments(rows, executor=executor)
+            if len(rows) < batch_size:
+                RETENTION_SECONDS.observe(time.perf_counter() - started)
+                return removed
@@ -1,115 +1,338 @@
+import asyncio
+import json
 import os
+import time
 from collections import deque
-from time import sleep
-from typing import Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import m3u8
-import requests
-from aiohttp import ClientSession
 
 from streamer import HlsReader
-from streamer.logs import logger
+from streamer.KeyManager import DrmKey, KeyManager
+from streamer.LivePlaylist import LivePlaylist
+from streamer.Metrics import Counter, Gauge, Histogram
+from streamer.SegmentCipher import ENGINE_BUILTIN
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
 
 ENC_SUFFIX = 'enc_'
 CLEAR_SUFFIX = '_clear'
+STATE_VERSION = 1
+
+ENCRYPT_SECONDS = Histogram('hls_encrypt_seconds',
+                            'Chunk encryption time in worker pool, including waiting for a worker')
+ENCRYPT_LATENCY_SECONDS = Histogram('hls_encrypt_latency_seconds',
+                                    'Time from detection of a clear chunk to publication of the encrypted playlist')
+SEGMENTS_ENCRYPTED = Counter('hls_segments_encrypted_total', 'Encrypted chunks', ('stream',))
+ENCRYPT_ERRORS = Counter('hls_encrypt_errors_total', 'Failed chunk encryptions', ('stream',))
+KEY_FALLBACKS = Counter('hls_encrypt_key_fallbacks_total',
+                        'Chunks encrypted with the previous key because the next key was not ready', ('stream',))
+STREAM_LAG = Gauge('hls_stream_lag_seconds', 'Duration of clear playlist chunks not encrypted yet', ('stream',))
 
 
 class HlsEncryptor(HlsReader):
     def __init__(self, source_name: str, storage: os.path,
                  key_encryptor_url: str, key_client_url: str,
-                 content_id: str):
+                 content_id: str, engine: str = ENGINE_BUILTIN, key_manager: KeyManager = None,
+                 rotation_segments: int = 0, rotation_seconds: float = 0):
+        """
+        :param key_manager: shared KeyManager (daemon keeps one for all streams)
+        :param rotation_segments: change key every rotation_segments chunks (0 - no rotation by chunks)
+        :param rotation_seconds: change key every rotation_seconds seconds (0 - no rotation by time)
+        """
+
         super().__init__(source_url=os.path.join(storage, source_name))  # чтение только локального m3u8
         self.encrypted_segments_cache = deque()
+        self.source_name = source_name
         self.storage = storage
+        self.playlist_signature = None
         self.key_encryptor_url = key_encryptor_url
         self.key_client_url = key_client_url
         self.content_id = content_id
-        self.key = None
-        self.iv = None
+        self.engine = engine
+        self.key_manager = key_manager if key_manager is not None else KeyManager(
+            key_encryptor_url=key_encryptor_url, key_client_url=key_client_url)
+        self.rotation_segments = rotation_segments
+        self.rotation_seconds = rotation_seconds
+        # текущий ключ, ключ запрашивается асинхронно перед первым чанком
+        self.drm_key: Optional[DrmKey] = None
+        self.encrypted_playlist = LivePlaylist(path=os.path.join(self.storage,
+                                                                 self.source_url.replace(CLEAR_SUFFIX, '')))
+        self.encrypted_segments = SEGMENTS_ENCRYPTED.labels(content_id)
+        self.encrypt_errors = ENCRYPT_ERRORS.labels(content_id)
+        self.key_fallbacks = KEY_FALLBACKS.labels(content_id)
+        self.lag = STREAM_LAG.labels(content_id)
+        # окно шифрованного playlist для файла состояния: чанки в том же порядке, что и в encrypted_playlist
+        self.window: deque = deque()
+        directory, name = os.path.split(self.encrypted_playlist.path)
+        self.state_path = os.path.join(directory, f'.{name}.state.json')
+        # media sequence последнего восстановленного чанка: более старые чанки clear playlist не шифруются
+        self.resume_after: Optional[int] = None
 
-        self.sync_remove_files_from_previous_start()
-        self.sync_get_key(self.content_id)
+        self.sync_restore_from_previous_start()
 
-    def sync_remove_files_from_previous_start(self) -> None:
-        """Removes encrypted files after the last start if exist"""
+    @staticmethod
+    def _get_file_signature(path: str) -> Optional[List[int]]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
 
-        for file in os.scandir(self.storage):
-            if file.name.startswith(ENC_SUFFIX):
-                os.remove(os.path.join(self.storage, file.name))
-                logger.debug(f'old chunk {file.name} has been removed')
+    def _is_restorable(self, entry: Dict) -> bool:
+        """Encrypted chunk is the same as at the moment of saving and its clear chunk has not been replaced"""
 
-    def sync_get_key(self, content_id: str):
-        drm_response = requests.get(url=f'{self.key_encryptor_url}{content_id}')
-        data = drm_response.json()
-        logger.debug('Got key and iv from DRM server')
-        self.key = data['key']
-        self.iv = data['iv']
+        if self._get_file_signature(os.path.join(self.storage, entry['output'])) != entry['output_signature']:
+            return False
+        # чистый чанк мог быть уже удален упаковщиком - шифрованный при этом остается верным
+        clear_signature = self._get_file_signature(os.path.join(self.storage, entry['uri']))
+        return clear_signature is None or clear_signature == entry['clear_signature']
 
-    async def get_key(self, content_id: str):
+    def sync_restore_from_previous_start(self) -> None:
         """
-        Request key from MultiDRM
-        :param content_id: content id to get key for
-        :return: key, iv
+        Restores encrypted playlist window from the state file of the previous start: encrypted chunks
+        are not encrypted again, the window is kept up to the first missing or stale chunk,
+        chunks after it are encrypted again from the clear playlist
         """
 
-        async with ClientSession() as session:
-            async with session.get(f'{self.key_encryptor_url}{content_id}') as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    logger.debug(f'Got key and iv from DRM server')
-                    self.key = data['key']
-                    self.iv = data['iv']
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f'Cant read state file {self.state_path}: {e} - {e.__class__.__name__}')
+            return
+        if state.get('version') != STATE_VERSION or state.get('content_id') != self.content_id \
+                or state.get('source_name') != self.source_name:
+            logger.warning(f'State file {self.state_path} belongs to another stream, encryption starts from scratch')
+            return
+
+        restored = []
+        discontinuity_sequence = state.get('discontinuity_sequence', 0)
+        for entry in state['window']:
+            if self._is_restorable(entry):
+                restored.append(entry)
+            elif restored:
+                break
+            elif entry['discontinuity']:
+                # пропущенные чанки начала окна уходят из него вместе со своими разрывами
+                discontinuity_sequence += 1
+        if not restored:
+            return
+
+        playlist = self.encrypted_playlist
+        playlist.version = state['playlist_version']
+        playlist.target_duration = state['target_duration']
+        playlist.discontinuity_sequence = discontinuity_sequence
+        for entry in restored:
+            playlist.append(uri=entry['output'], duration=entry['duration'], media_sequence=entry['media_sequence'],
+                            key_line=entry['key_line'], discontinuity=entry['discontinuity'])
+            self.window.append(entry)
+            self.encrypted_segments_cache.append(entry['output'])
+            # чанки окна не шифруются повторно
+            self.live_segments_cache.append((entry['uri'], entry['media_sequence']))
+            self.live_segments_index.add((entry['uri'], entry['media_sequence']))
+        self.resume_after = restored[-1]['media_sequence']
+        playlist.publish()
+        logger.info(f'Encrypted playlist of {self.content_id} has been restored with {len(restored)} of '
+                    f'{len(state["window"])} chunks, last media sequence {restored[-1]["media_sequence"]}')
+
+    def save_state(self) -> None:
+        """Writes encrypted playlist window to the state file (key itself is not saved, only its id and key line)"""
+
+        while len(self.window) > len(self.encrypted_playlist.entries):
+            self.window.popleft()
+        state = {'version': STATE_VERSION,
+                 'content_id': self.content_id,
+                 'source_name': self.source_name,
+                 'playlist_version': self.encrypted_playlist.version,
+                 'target_duration': self.encrypted_playlist.target_duration,
+                 'discontinuity_sequence': self.encrypted_playlist.discontinuity_sequence,
+                 'key_id': self.drm_key.content_id if self.drm_key is not None else None,
+                 'window': list(self.window)}
+        directory, name = os.path.split(self.state_path)
+        tmp_path = os.path.join(directory, f'{name}.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
 
-    def sync_encrypt(self, input_file_name: str) -> str:
+    def _read_playlist(self):
+        """Reads clear playlist only if it has been changed since the last reading"""
+
+        try:
+            stat = os.stat(self.source_url)
+        except OSError as e:
+            logger.error(f'Cant read source playlist {self.source_url}: {e} - {e.__class__.__name__}')
+            return
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if signature == self.playlist_signature:
+            return
+        self.playlist_signature = signature
+        super()._read_playlist()
+
+    def _find_new_segment(self):
+        while True:
+            segment, segment_start_datetime, media_sequence = super()._find_new_segment()
+            if segment is None or self.resume_after is None:
+                return segment, segment_start_datetime, media_sequence
+            last_media_sequence = self.live_playlist.media_sequence + len(self.live_playlist.segments) - 1
+            # clear playlist заканчивается раньше восстановленного окна - упаковщик начал нумерацию заново
+            if media_sequence > self.resume_after or last_media_sequence < self.resume_after:
+                self.resume_after = None
+                return segment, segment_start_datetime, media_sequence
+
+    def _get_rotation_periods(self, media_sequence: int, now: float) -> List[int]:
+        periods = []
+        if self.rotation_segments:
+            periods.append(media_sequence // self.rotation_segments)
+        if self.rotation_seconds:
+            periods.append(int(now // self.rotation_seconds))
+        return periods
+
+    def _get_key_id(self, periods: List[int]) -> str:
+        """Key id for DRM server and key uri: content_id or content_id_<period>... with rotation"""
+
+        return '_'.join([self.content_id] + [str(period) for period in periods])
+
+    def get_key_ids(self, media_sequence: int, now: float = None) -> Tuple[str, List[str]]:
         """
-        Encrypts file
-        :param input_file_name: file to encrypt
-        :param key: key
-        :param iv: iv
-        :return: encrypted file name
+        :return: id of the key for the chunk and ids of the next keys (for prefetch)
+        """
+
+        periods = self._get_rotation_periods(media_sequence, time.time() if now is None else now)
+        next_key_ids = []
+        for index in range(len(periods)):
+            next_periods = list(periods)
+            next_periods[index] += 1
+            next_key_ids.append(self._get_key_id(next_periods))
+        return self._get_key_id(periods), next_key_ids
+
+    async def get_key(self, media_sequence: int) -> DrmKey:
+        """
+        Key for the chunk without waiting for DRM server: if the key of the new rotation period
+        has not been received yet, the current key is used; waits for DRM server only before the first key
         """
 
+        key_id, next_key_ids = self.get_key_ids(media_sequence)
+        key = self.key_manager.get_cached(key_id)
+        if key is None:
+            if self.drm_key is None:
+                key = await self._wait_for_key(key_id)
+            else:
+                logger.warning(f'Key {key_id} is not ready, chunk {media_sequence} of {self.content_id} '
+                               f'is encrypted with {self.drm_key.content_id}')
+                self.key_fallbacks.inc()
+                key = self.drm_key
+        if key is not self.drm_key:
+            logger.info(f'Key of {self.content_id} has been changed to {key.content_id}')
+            self.drm_key = key
+        for next_key_id in next_key_ids:
+            self.key_manager.prefetch(next_key_id)
+        return key
+
+    async def _wait_for_key(self, key_id: str) -> DrmKey:
+        while True:
+            try:
+                return await self.key_manager.get(key_id)
+            except Exception as e:
+                logger.error(f'Cant get key {key_id} from DRM server: {e} - {e.__class__.__name__}')
+                await asyncio.sleep(self.key_manager.retry_interval)
+
+    def _get_encryption_paths(self, input_file_name: str) -> Tuple[str, str, str]:
         input_file = os.path.join(self.storage, input_file_name)
         output_file_name = ENC_SUFFIX + input_file_name
         output_file = os.path.join(self.storage, output_file_name)
-        logger.debug(f'Start encryption: {input_file}')
-        os.system(
-            f"openssl enc -aes-128-cbc -e -in {input_file} -out {output_file} -nosalt -K {self.key} -iv {self.iv}")
-        logger.debug(f'End encryption: {output_file}')
+        return input_file, output_file_name, output_file
 
+    def _add_to_encrypted_cache(self, output_file_name: str) -> None:
         self.encrypted_segments_cache.append(output_file_name)
-        if len(self.encrypted_segments_cache) > self.live_playlist_length:
+        # окно, восстановленное после перезапуска, может быть длиннее нового clear playlist
+        while len(self.encrypted_segments_cache) > self.live_playlist_length:
             the_oldest_encrypted_chunk = self.encrypted_segments_cache.popleft()
-            os.remove(os.path.join(self.storage, the_oldest_encrypted_chunk))
-            logger.debug(f'The oldest encrypted chunk {the_oldest_encrypted_chunk} has been removed')
+            try:
+                os.remove(os.path.join(self.storage, the_oldest_encrypted_chunk))
+            except FileNotFoundError:
+                pass
+            logger.debug(f'The oldest encrypted chunk {the_oldest_encrypted_chunk} has been removed',
+                         extra={'channel': self.content_id})
 
+    async def encrypt(self, input_file_name: str, pool, key: DrmKey) -> str:
+        """
+        Encrypts file in worker pool
+        :param input_file_name: file to encrypt
+        :param pool: EncryptorPool
+        :param key: key of the chunk
+        :return: encrypted file name
+        """
+
+        input_file, output_file_name, output_file = self._get_encryption_paths(input_file_name)
+        started = time.perf_counter()
+        await pool.encrypt(stream_name=self.content_id, input_file=input_file, output_file=output_file,
+                           key=key.key, iv=key.iv, engine=self.engine)
+        ENCRYPT_SECONDS.observe(time.perf_counter() - started)
+        self.encrypted_segments.inc()
+        logger.debug(f'End encryption: {output_file}', extra={'channel': self.content_id})
+
+        self._add_to_encrypted_cache(output_file_name)
         return output_file_name
 
-    def update_encrypted_playlist(self) -> None:
-        """Updates encrypted playlist (based on clear playlist) with new key"""
+    def update_encrypted_playlist(self, segment: m3u8.Segment, output_file_name: str,
+                                  media_sequence: int, key: DrmKey) -> None:
+        """
+        Adds encrypted chunk to encrypted playlist window and publishes it
+        :param segment: clear chunk from clear playlist
+        :param output_file_name: encrypted chunk file name
+        :param media_sequence: media sequence of the chunk
+        :param key: key of the chunk (#EXT-X-KEY is written when the key changes)
+        """
 
-        self._read_playlist()
-        logger.debug(f'Encrypted playlist renewing started')
-        uri = f'{self.key_client_url}{self.content_id}.bin'
-        new_key = m3u8.Key(method="AES-128", base_uri=uri, uri=uri, iv=self.iv)
+        playlist = self.encrypted_playlist
+        playlist.length = self.live_playlist_length
+        playlist.version = self.live_playlist.version
+        playlist.target_duration = self.live_playlist.target_duration
+        playlist.append(uri=output_file_name, duration=segment.duration, media_sequence=media_sequence,
+                        key_line=key.key_line, discontinuity=segment.discontinuity)
+        self.window.append({'media_sequence': media_sequence,
+                            'uri': segment.uri,
+                            'output': output_file_name,
+                            'duration': segment.duration,
+                            'discontinuity': segment.discontinuity,
+                            'key_id': key.content_id,
+                            'key_line': key.key_line,
+                            'clear_signature': self._get_file_signature(os.path.join(self.storage, segment.uri)),
+                            'output_signature': self._get_file_signature(os.path.join(self.storage,
+                                                                                      output_file_name))})
+        # состояние сохраняется до публикации: в опубликованном playlist нет чанков, неизвестных после перезапуска
+        self.save_state()
+        playlist.publish()
+        logger.debug(f'Encrypted playlist has been updated with {output_file_name}', extra={'channel': self.content_id})
 
-        for segment in self.live_playlist.segments:
-            segment.key = new_key
-            segment.uri = ENC_SUFFIX + segment.uri
-        self.live_playlist.keys[-1] = new_key
-        self.live_playlist.dump(os.path.join(self.storage, self.source_url.replace(CLEAR_SUFFIX, '')))
-        logger.debug(f'Encrypted playlist renewing ended')
+    async def async_update_encrypted_data(self, segment: m3u8.Segment, media_sequence: int, pool) -> None:
+        """Encrypts clear chunk in worker pool and updates encrypted playlist"""
 
-    def update_encrypted_data(self, file: str) -> None:
-        """Encrypts clear chunk and updates encrypted playlist"""
+        detected_at = time.monotonic()
+        key = await self.get_key(media_sequence)
+        output_file_name = await self.encrypt(input_file_name=segment.uri, pool=pool, key=key)
+        self.update_encrypted_playlist(segment=segment, output_file_name=output_file_name,
+                                       media_sequence=media_sequence, key=key)
+        latency = time.monotonic() - detected_at
+        pool.record_latency(stream_name=self.content_id, latency=latency)
+        ENCRYPT_LATENCY_SECONDS.observe(latency)
+        # чанки clear playlist после зашифрованного - отставание от live
+        position = media_sequence - self.live_playlist.media_sequence
+        self.lag.set(sum(next_segment.duration
+                         for next_segment in self.live_playlist.segments[max(position + 1, 0):]))
 
-        self.sync_encrypt(input_file_name=file)
-        self.update_encrypted_playlist()
 
-    def process(self):
-        while True:
-            new_segment, _, _ = self.check_for_new_segment()
-            if new_segment:
-                self.update_encrypted_data(file=new_segment.uri)
-            sleep(1)
+def remove_unknown_files(storage: os.path, encryptors: Iterable[HlsEncryptor]) -> None:
+    """Removes encrypted files of the previous start which are not in restored windows of the encryptors"""
 
+    known = set()
+    for encryptor in encryptors:
+        known.update(encryptor.encrypted_segments_cache)
+    for file in os.scandir(storage):
+        if file.name.startswith(ENC_SUFFIX) and file.name not in known:
+            os.remove(os.path.join(storage, file.name))
+            logger.debug(f'old chunk {file.name} has been removed')
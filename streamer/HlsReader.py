@@ -1,18 +1,41 @@
 import datetime
+import time
 from collections import deque
+from typing import List, Tuple
 
 import m3u8
 
-from streamer.logs import logger
+from streamer.HttpPool import HttpPool
+from streamer.Metrics import Counter, Histogram
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+MAX_VARIANT_DEPTH = 3
+
+PLAYLIST_FETCH_SECONDS = Histogram('hls_playlist_fetch_seconds', 'Source playlist fetch and parse time')
+PLAYLIST_FETCHES = Counter('hls_playlist_fetches_total', 'Source playlist fetches by result', ('result',))
+FETCHES_CHANGED = PLAYLIST_FETCHES.labels('changed')
+FETCHES_NOT_MODIFIED = PLAYLIST_FETCHES.labels('not_modified')
+FETCHES_FAILED = PLAYLIST_FETCHES.labels('error')
 
 
 class HlsReader:
 
-    def __init__(self, source_url: str):
+    def __init__(self, source_url: str, http_pool: HttpPool = None):
         self.live_playlist = m3u8.model.M3U8()
         self.live_segments_cache = deque()
+        # множество для проверки за O(1), deque - для вытеснения самых старых
+        self.live_segments_index = set()
         self.source_url = source_url
         self.live_playlist_length = 0
+        self.own_http_pool = http_pool is None
+        self.http_pool = HttpPool() if http_pool is None else http_pool
+        # url медиа-плейлиста после разрешения вариантов (master playlist не перечитывается на каждом опросе)
+        self.media_playlist_url = None
+        self.etag = None
+        self.last_modified = None
+        self.playlist_content = None
 
     def _read_playlist(self):
         try:
@@ -23,22 +46,110 @@ class HlsReader:
         except Exception as e:
             logger.error(f'Cant download source playlist {self.source_url}: {e} - {e.__class__.__name__}')
 
+    async def _fetch(self, url: str, conditional: bool) -> (int, str):
+        headers = {}
+        if conditional:
+            if self.etag is not None:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified is not None:
+                headers['If-Modified-Since'] = self.last_modified
+        async with self.http_pool.get_session(url).get(url, headers=headers) as resp:
+            if resp.status == 200:
+                self.etag = resp.headers.get('ETag')
+                self.last_modified = resp.headers.get('Last-Modified')
+                return resp.status, await resp.text()
+            return resp.status, None
+
+    async def _async_read_playlist(self) -> bool:
+        """
+        Downloads playlist without blocking the loop; uses conditional requests
+        and parses playlist only if it has been changed
+        :return: True if new version of playlist has been parsed
+        """
+
+        started = time.perf_counter()
+        try:
+            url = self.media_playlist_url or self.source_url
+            for _ in range(MAX_VARIANT_DEPTH):
+                status, content = await self._fetch(url, conditional=url == self.media_playlist_url)
+                if status == 304:
+                    FETCHES_NOT_MODIFIED.inc()
+                    return False
+                if status != 200:
+                    raise ValueError(f'status {status} for {url}')
+                if url == self.media_playlist_url and content == self.playlist_content:
+                    FETCHES_NOT_MODIFIED.inc()
+                    return False
+
+                playlist = m3u8.loads(content, uri=url)
+                if playlist.is_variant:
+                    url = playlist.playlists[0].absolute_uri
+                    continue
+
+                self.media_playlist_url = url
+                self.playlist_content = content
+                self.live_playlist = playlist
+                self.live_playlist_length = len(self.live_playlist.segments)
+                FETCHES_CHANGED.inc()
+                return True
+            raise ValueError(f'too many nested variant playlists in {self.source_url}')
+        except Exception as e:
+            logger.error(f'Cant download source playlist {self.source_url}: {e} - {e.__class__.__name__}')
+            FETCHES_FAILED.inc()
+            # при ошибке заново разрешаем варианты через master playlist
+            self.media_playlist_url = None
+            self.etag = None
+            self.last_modified = None
+            return False
+        finally:
+            PLAYLIST_FETCH_SECONDS.observe(time.perf_counter() - started)
+
     def _flush_queue(self):
         self.live_segments_cache.clear()
+        self.live_segments_index.clear()
 
-    def check_for_new_segment(self) -> (m3u8.Segment, datetime.datetime):
-        self._read_playlist()
+    def _find_new_segments(self, limit: int = None) -> List[Tuple[m3u8.Segment, datetime.datetime, int]]:
+        """
+        Finds segments of the current playlist which have not been seen yet
+        :param limit: max number of segments to return (and mark as seen)
+        :return: list of (segment, segment start datetime, media sequence)
+        """
+
+        new_segments = []
         if self.live_playlist:
             for position, segment in enumerate(self.live_playlist.segments):
-                # logger.debug(f'CACHE: {self.live_segments_cache}')
                 segment_media_sequence = self.live_playlist.media_sequence + position
 
-                if (segment.uri, segment_media_sequence) not in self.live_segments_cache:
+                if (segment.uri, segment_media_sequence) not in self.live_segments_index:
                     self.live_segments_cache.append((segment.uri, segment_media_sequence))
-                    logger.debug(f'New segment {segment.uri} has been added to local cache')
+                    self.live_segments_index.add((segment.uri, segment_media_sequence))
+                    logger.debug(f'New segment {segment.uri} has been added to local cache',
+                                 extra={'channel': self.source_url})
                     delay = (self.live_playlist_length - position) * self.live_playlist.data['targetduration']
                     segment_start_datetime = datetime.datetime.utcnow() - datetime.timedelta(seconds=delay)
-                    if len(self.live_segments_cache) > self.live_playlist_length:
-                        self.live_segments_cache.popleft()
-                    return segment, segment_start_datetime, segment_media_sequence
+                    new_segments.append((segment, segment_start_datetime, segment_media_sequence))
+                    if limit is not None and len(new_segments) >= limit:
+                        break
+        while len(self.live_segments_cache) > self.live_playlist_length:
+            self.live_segments_index.discard(self.live_segments_cache.popleft())
+        return new_segments
+
+    def _find_new_segment(self) -> (m3u8.Segment, datetime.datetime):
+        new_segments = self._find_new_segments(limit=1)
+        if new_segments:
+            return new_segments[0]
         return None, None, None
+
+    def check_for_new_segment(self) -> (m3u8.Segment, datetime.datetime):
+        self._read_playlist()
+        return self._find_new_segment()
+
+    async def async_check_for_new_segments(self) -> List[Tuple[m3u8.Segment, datetime.datetime, int]]:
+        """Returns all unseen segments from one playlist fetch"""
+
+        await self._async_read_playlist()
+        return self._find_new_segments()
+
+    async def close(self):
+        if self.own_http_pool:
+            await self.http_pool.close()
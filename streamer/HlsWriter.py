@@ -1,52 +1,240 @@
+import asyncio
+import datetime
 import os
-from typing import Union
+import time
+from typing import List, Tuple, Union
 
 import aiofiles
-from aiohttp import ClientSession
+import m3u8
 
 from streamer import HlsReader
 from streamer.Db import DbManager
-from streamer.logs import logger
+from streamer.HttpPool import HttpPool
+from streamer.Metrics import Counter, Gauge, Histogram
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+# все чанки канала в одной папке
+LAYOUT_FLAT = 'flat'
+# чанки канала по часовым папкам YYYY/MM/DD/HH
+LAYOUT_HOURLY = 'hourly'
+# чанки канала дописываются в часовые файлы-контейнеры YYYYmmdd_HH.ts, в БД хранятся смещение и длина чанка
+LAYOUT_PACKED = 'packed'
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_HOURLY, LAYOUT_PACKED)
+
+SEGMENT_DOWNLOAD_SECONDS = Histogram('hls_segment_download_seconds', 'Segment download time')
+SEGMENTS_SAVED = Counter('hls_segments_saved_total', 'Segments saved to archive', ('channel',))
+SEGMENT_BYTES = Counter('hls_segment_bytes_total', 'Bytes of segments saved to archive', ('channel',))
+SEGMENT_ERRORS = Counter('hls_segment_download_errors_total', 'Failed segment downloads', ('channel',))
+CHANNEL_LAG = Gauge('hls_channel_lag_seconds', 'Time since the end of the last saved segment of the channel',
+                    ('channel',))
+
+
+def get_segment_name(start_datetime: datetime.datetime, layout: str = LAYOUT_FLAT) -> str:
+    """
+    :return: path of the segment relative to the channel storage (stored in db and used in playlist uri)
+    """
+
+    if layout == LAYOUT_HOURLY:
+        return start_datetime.strftime('%Y/%m/%d/%H/%Y%m%d_%H%M%S.ts')
+    if layout == LAYOUT_PACKED:
+        return start_datetime.strftime('%Y%m%d_%H.ts')
+    return start_datetime.strftime('%Y%m%d_%H%M%S.ts')
 
 
 class HlsWriter(HlsReader):
     def __init__(self, source_url: str, storage: os.path,
-                 channel_name: str):
-        super().__init__(source_url)
+                 channel_name: str, http_pool: HttpPool = None, max_parallel_downloads: int = 4,
+                 layout: str = LAYOUT_FLAT):
+        super().__init__(source_url, http_pool=http_pool)
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown archive layout {layout}, expected one of {LAYOUTS}')
         self.storage = storage
         self.db_manager = DbManager()
         self.channel_name = channel_name
+        self.max_parallel_downloads = max_parallel_downloads
+        self.download_slots = None
+        self.layout = layout
+        self.bucket_dir = None
+        self.resumed = False
+        # нагрузка канала (и для балансировки каналов по процессам writer)
+        self.saved_segments = SEGMENTS_SAVED.labels(channel_name)
+        self.saved_bytes = SEGMENT_BYTES.labels(channel_name)
+        self.download_errors = SEGMENT_ERRORS.labels(channel_name)
+        # время окончания последнего сохраненного чанка (unix time)
+        self.last_segment_end = None
 
-    async def _download(self, download_url: str, segment_name: str):
-        async with ClientSession() as session:
-            async with session.get(download_url) as resp:
-                if resp.status == 200:
-                    f = await aiofiles.open(os.path.join(self.storage, segment_name),
-                                            mode='wb')
-                    await f.write(await resp.read())
-                    await f.close()
-
-    async def check_for_new_segment_and_save(self) -> Union[float, None]:
-        new_segment, segment_start_datetime, segment_media_sequence = self.check_for_new_segment()
-        if new_segment is not None:
-            download_url = new_segment.absolute_uri
-            original_segment_name = new_segment.uri
-            segment_name = segment_start_datetime.strftime('%Y%m%d_%H%M%S.ts')
-            segment_duration = new_segment.duration
-
-            added = await self.db_manager.add_segment(filename=segment_name,
-                                                      duration=segment_duration,
-                                                      start_datetime=segment_start_datetime,
-                                                      original_filename=original_segment_name,
-                                                      media_sequence=segment_media_sequence,
-                                                      channel_name=self.channel_name)
-            if added:
-                logger.debug(
-                    f'New segment with old name {original_segment_name} started {segment_start_datetime} ' 
-                    f'with media_sequence {segment_media_sequence} '
-                    f'has been saved to db with new name {segment_name}')
-                await self._download(download_url=download_url, segment_name=segment_name)
+    def _get_segment_path(self, segment_name: str) -> os.path:
+        return os.path.join(self.storage, segment_name)
+
+    async def _download(self, download_url: str, segment_name: str) -> bool:
+        """
+        Streams segment to temporary file by chunks and renames it when download is completed
+        :return: True if segment has been saved
+        """
+
+        segment_file = self._get_segment_path(segment_name)
+        part_file = segment_file + '.part'
+        bucket_dir = os.path.dirname(segment_file)
+        if bucket_dir != self.bucket_dir:
+            os.makedirs(bucket_dir, exist_ok=True)
+            self.bucket_dir = bucket_dir
+        started = time.perf_counter()
+        try:
+            async with self.http_pool.get_session(download_url).get(download_url) as resp:
+                if resp.status != 200:
+                    logger.warning(f'Cant download segment {download_url}: status {resp.status}')
+                    self.download_errors.inc()
+                    return False
+                async with aiofiles.open(part_file, mode='wb') as f:
+                    async for chunk in resp.content.iter_chunked(self.http_pool.chunk_size):
+                        await f.write(chunk)
+                        self.saved_bytes.inc(len(chunk))
+            os.replace(part_file, segment_file)
+            self.saved_segments.inc()
+            SEGMENT_DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+            return True
+        except Exception as e:
+            logger.error(f'Cant download segment {download_url}: {e} - {e.__class__.__name__}')
+            self.download_errors.inc()
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            return False
+
+    async def _save_segment(self, new_segment: m3u8.Segment, segment_name: str) -> bool:
+        async with self.download_slots:
+            if await self._download(download_url=new_segment.absolute_uri, segment_name=segment_name):
                 logger.debug(
-                    f'New segment {segment_name} has been downloaded to storage')
+                    f'New segment {segment_name} has been downloaded to storage', extra={'channel': self.channel_name})
+                return True
+            return False
+
+    async def _append_to_container(self, segment_name: str, container_name: str) -> Tuple[int, int]:
+        """
+        Appends downloaded segment to the end of container file and removes the segment file
+        :return: offset and length of the segment in the container
+        """
+
+        segment_file = self._get_segment_path(segment_name)
+        async with aiofiles.open(self._get_segment_path(container_name), mode='ab') as container:
+            byte_offset = await container.tell()
+            async with aiofiles.open(segment_file, mode='rb') as f:
+                while True:
+                    chunk = await f.read(self.http_pool.chunk_size)
+                    if not chunk:
+                        break
+                    await container.write(chunk)
+            byte_length = await container.tell() - byte_offset
+        os.remove(segment_file)
+        return byte_offset, byte_length
+
+    async def _save_packed_segments(self, new_segments: List[Tuple[m3u8.Segment, datetime.datetime, int]]) -> None:
+        """
+        Downloads segments concurrently and appends them to hourly containers in order of media sequence;
+        db rows are added after appending, when offsets are known
+        """
+
+        segment_names = [get_segment_name(start_datetime=segment_start_datetime, layout=self.layout)
+                         + f'.{segment_media_sequence}'
+                         for _, segment_start_datetime, segment_media_sequence in new_segments]
+        downloaded = await asyncio.gather(*[self._save_segment(new_segment=new_segment, segment_name=segment_name)
+                                            for (new_segment, _, _), segment_name in zip(new_segments,
+                                                                                          segment_names)])
+
+        for (new_segment, segment_start_datetime, segment_media_sequence), segment_name, ok in zip(
+                new_segments, segment_names, downloaded):
+            if not ok:
+                continue
+            container_name = get_segment_name(start_datetime=segment_start_datetime, layout=self.layout)
+            byte_offset, byte_length = await self._append_to_container(segment_name=segment_name,
+                                                                       container_name=container_name)
+            await self.db_manager.add_segment(filename=container_name,
+                                              duration=new_segment.duration,
+                                              start_datetime=segment_start_datetime,
+                                              original_filename=new_segment.uri,
+                                              media_sequence=segment_media_sequence,
+                                              channel_name=self.channel_name,
+                                              byte_offset=byte_offset,
+                                              byte_length=byte_length)
+            logger.debug(f'New segment with old name {new_segment.uri} started {segment_start_datetime} '
+                         f'has been appended to {container_name} at {byte_offset} ({byte_length} bytes)',
+                         extra={'channel': self.channel_name})
+
+    async def _skip_saved_segments(self, new_segments: List[Tuple[m3u8.Segment, datetime.datetime, int]]
+                                   ) -> List[Tuple[m3u8.Segment, datetime.datetime, int]]:
+        """
+        After restart of the writer (or moving of the channel to another writer process) skips segments
+        saved before, if the last saved segment is still in the playlist
+        """
+
+        last_segment = await self.db_manager.get_last_saved_segment(channel_name=self.channel_name)
+        if last_segment is None or not any(
+                segment.uri == last_segment.original_filename and segment_media_sequence == last_segment.media_sequence
+                for segment, _, segment_media_sequence in new_segments):
+            return new_segments
+        logger.info(f'Channel {self.channel_name} resumes after segment {last_segment.original_filename} '
+                    f'with media_sequence {last_segment.media_sequence}')
+        return [new_segment for new_segment in new_segments if new_segment[2] > last_segment.media_sequence]
+
+    def _update_lag(self, last_segment: Tuple[m3u8.Segment, datetime.datetime, int] = None) -> None:
+        """
+        Lag behind the live edge: grows while there are no new segments in the source playlist
+        :param last_segment: the newest segment of the source playlist just saved
+        """
+
+        if last_segment is not None:
+            segment, segment_start_datetime, _ = last_segment
+            self.last_segment_end = segment_start_datetime.replace(
+                tzinfo=datetime.timezone.utc).timestamp() + segment.duration
+        if self.last_segment_end is not None:
+            CHANNEL_LAG.labels(self.channel_name).set(max(time.time() - self.last_segment_end, 0))
+
+    async def check_for_new_segments_and_save(self) -> Union[float, None]:
+        """
+        Downloads all new segments of the playlist concurrently and saves downloaded ones to db
+        :return: duration of the last new segment or None if there are no new segments
+        """
+
+        new_segments = await self.async_check_for_new_segments()
+        if new_segments and not self.resumed:
+            self.resumed = True
+            new_segments = await self._skip_saved_segments(new_segments)
+        if not new_segments:
+            self._update_lag()
+            return None
+        if self.download_slots is None:
+            self.download_slots = asyncio.Semaphore(self.max_parallel_downloads)
+        if self.layout == LAYOUT_PACKED:
+            await self._save_packed_segments(new_segments)
+            self._update_lag(new_segments[-1])
+            return new_segments[-1][0].duration
+
+        segment_names = [get_segment_name(start_datetime=segment_start_datetime, layout=self.layout)
+                         for _, segment_start_datetime, _ in new_segments]
+        downloads = [asyncio.ensure_future(self._save_segment(new_segment=new_segment, segment_name=segment_name))
+                     for (new_segment, _, _), segment_name in zip(new_segments, segment_names)]
+        try:
+            # записи в БД добавляются в порядке media sequence и только после загрузки чанка:
+            # плейлисты и индекс API не видят недокачанные чанки
+            for (new_segment, segment_start_datetime, segment_media_sequence), segment_name, download in zip(
+                    new_segments, segment_names, downloads):
+                if not await download:
+                    continue
+                added = await self.db_manager.add_segment(filename=segment_name,
+                                                          duration=new_segment.duration,
+                                                          start_datetime=segment_start_datetime,
+                                                          original_filename=new_segment.uri,
+                                                          media_sequence=segment_media_sequence,
+                                                          channel_name=self.channel_name)
+                if added:
+                    logger.debug(
+                        f'New segment with old name {new_segment.uri} started {segment_start_datetime} '
+                        f'with media_sequence {segment_media_sequence} '
+                        f'has been saved to db with new name {segment_name}', extra={'channel': self.channel_name})
+        finally:
+            for download in downloads:
+                download.cancel()
 
-            return new_segment.duration
+        self._update_lag(new_segments[-1])
+        return new_segments[-1][0].duration
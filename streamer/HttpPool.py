@@ -0,0 +1,50 @@
+from typing import Dict
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+
+class HttpPool:
+    """Shared aiohttp sessions, one per origin, keeping connections alive between requests"""
+
+    def __init__(self, limit_per_host: int = 8, keepalive_timeout: float = 30,
+                 connect_timeout: float = 5, read_timeout: float = 10, total_timeout: float = 60,
+                 chunk_size: int = 64 * 1024):
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.chunk_size = chunk_size
+        self.sessions: Dict[str, ClientSession] = {}
+
+    @classmethod
+    def from_config(cls, section) -> 'HttpPool':
+        """
+        Creates pool from config section
+        :param section: configparser section (or None for defaults)
+        """
+
+        if section is None:
+            return cls()
+        return cls(limit_per_host=section.getint('limit_per_host', fallback=8),
+                   keepalive_timeout=section.getfloat('keepalive_timeout', fallback=30),
+                   connect_timeout=section.getfloat('connect_timeout', fallback=5),
+                   read_timeout=section.getfloat('read_timeout', fallback=10),
+                   total_timeout=section.getfloat('total_timeout', fallback=60),
+                   chunk_size=section.getint('chunk_size', fallback=64 * 1024))
+
+    def get_session(self, url: str) -> ClientSession:
+        """Returns session for url origin; must be called inside running loop"""
+
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'
+        session = self.sessions.get(origin)
+        if session is None or session.closed:
+            connector = TCPConnector(limit_per_host=self.limit_per_host,
+                                     keepalive_timeout=self.keepalive_timeout)
+            session = self.sessions[origin] = ClientSession(connector=connector, timeout=self.timeout)
+        return session
+
+    async def close(self) -> None:
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions = {}
@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import m3u8
+
+from streamer.HttpPool import HttpPool
+from streamer.SegmentCipher import SegmentCipher
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+def get_key_line(key_client_url: str, content_id: str, iv: str) -> str:
+    """#EXT-X-KEY line for segments encrypted with the key of content_id"""
+
+    uri = f'{key_client_url}{content_id}.bin'
+    return str(m3u8.Key(method="AES-128", base_uri=uri, uri=uri, iv=iv))
+
+
+class DrmKey:
+    def __init__(self, content_id: str, key: str, iv: str, key_line: str):
+        self.content_id = content_id
+        self.key = key
+        self.iv = iv
+        self.key_line = key_line
+        self.cipher = SegmentCipher(key=key, iv=iv)
+        # короткий идентификатор ключа для имен в кэше шифрованных чанков
+        self.key_id = hashlib.sha1(f'{key}:{iv}'.encode()).hexdigest()[:12]
+
+
+class KeyManager:
+    """
+    Keys from DRM server cached by content id; key is requested again after ttl seconds,
+    if DRM server is unavailable, the previous key is used and requested again after retry_interval seconds.
+    Keys can be prefetched in background and taken from the cache without waiting for DRM server
+    """
+
+    def __init__(self, key_encryptor_url: str, key_client_url: str, http_pool: HttpPool = None,
+                 ttl: float = 3600, retry_interval: float = 10, max_keys: int = 1000):
+        self.key_encryptor_url = key_encryptor_url
+        self.key_client_url = key_client_url
+        self.own_http_pool = http_pool is None
+        self.http_pool = http_pool if http_pool is not None else HttpPool()
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.max_keys = max_keys
+        # ключи ротации накапливаются, старые вытесняются (LRU)
+        self.keys: OrderedDict[str, DrmKey] = OrderedDict()
+        # полученные ключи по key_id: чанки шифруются ключом, указанным в выданном ранее playlist
+        self.keys_by_id: OrderedDict[str, DrmKey] = OrderedDict()
+        self.expires: Dict[str, float] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.prefetches: Dict[str, asyncio.Task] = {}
+
+    async def _fetch(self, content_id: str) -> DrmKey:
+        url = f'{self.key_encryptor_url}{content_id}'
+        async with self.http_pool.get_session(url).get(url) as resp:
+            resp.raise_for_status()
+            data = await resp.json(content_type=None)
+        logger.debug(f'Got key and iv for {content_id} from DRM server')
+        return DrmKey(content_id=content_id, key=data['key'], iv=data['iv'],
+                      key_line=get_key_line(key_client_url=self.key_client_url, content_id=content_id,
+                                            iv=data['iv']))
+
+    def _get_fresh(self, content_id: str) -> Optional[DrmKey]:
+        if time.monotonic() < self.expires.get(content_id, 0):
+            return self.keys[content_id]
+        return None
+
+    def _store(self, content_id: str, key: DrmKey, expires: float) -> None:
+        self.keys[content_id] = key
+        self.keys.move_to_end(content_id)
+        self.expires[content_id] = expires
+        self.keys_by_id[key.key_id] = key
+        self.keys_by_id.move_to_end(key.key_id)
+        while len(self.keys_by_id) > self.max_keys:
+            self.keys_by_id.popitem(last=False)
+        while len(self.keys) > self.max_keys:
+            evicted, _ = self.keys.popitem(last=False)
+            self.expires.pop(evicted, None)
+            self.locks.pop(evicted, None)
+
+    async def get(self, content_id: str) -> DrmKey:
+        """
+        :return: cached key or key requested from DRM server; if the server is unavailable, expired key is used
+        """
+
+        key = self._get_fresh(content_id)
+        if key is not None:
+            return key
+        async with self.locks.setdefault(content_id, asyncio.Lock()):
+            key = self._get_fresh(content_id)
+            if key is not None:
+                return key
+            try:
+                key = await self._fetch(content_id)
+                self._store(content_id, key, expires=time.monotonic() + self.ttl)
+            except Exception as e:
+                key = self.keys.get(content_id)
+                if key is None:
+                    raise
+                logger.error(f'Cant get key for {content_id}, using the previous one: {e} - {e.__class__.__name__}')
+                self.expires[content_id] = time.monotonic() + self.retry_interval
+            return key
+
+    def get_by_id(self, key_id: str) -> Optional[DrmKey]:
+        """:return: one of the last max_keys received keys by its key_id or None"""
+
+        return self.keys_by_id.get(key_id)
+
+    def get_cached(self, content_id: str) -> Optional[DrmKey]:
+        """
+        Key from the cache without waiting for DRM server (expired key is refreshed in background)
+        :return: key or None if it has not been received yet
+        """
+
+        key = self.keys.get(content_id)
+        if key is None or self._get_fresh(content_id) is None:
+            self.prefetch(content_id)
+        return key
+
+    def prefetch(self, content_id: str) -> None:
+        """Requests the key in background if it is not in the cache or expired"""
+
+        if self._get_fresh(content_id) is not None or content_id in self.prefetches:
+            return
+        self.prefetches[content_id] = asyncio.get_running_loop().create_task(self._prefetch(content_id))
+
+    async def _prefetch(self, content_id: str) -> None:
+        try:
+            await self.get(content_id)
+        except Exception as e:
+            logger.error(f'Cant prefetch key for {content_id}: {e} - {e.__class__.__name__}')
+            # повторный запрос не раньше чем через retry_interval
+            await asyncio.sleep(self.retry_interval)
+        finally:
+            del self.prefetches[content_id]
+
+    async def close(self) -> None:
+        for task in self.prefetches.values():
+            task.cancel()
+        if self.own_http_pool:
+            await self.http_pool.close()
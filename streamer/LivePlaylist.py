@@ -0,0 +1,67 @@
+import os
+from collections import deque
+
+from m3u8.model import number_to_string
+
+
+class LivePlaylist:
+    """
+    Sliding window of a live media playlist kept in memory.
+    Every entry is rendered once when added, so publishing a new version
+    costs one join and one atomic rename regardless of window length
+    """
+
+    def __init__(self, path: os.path, length: int = 0):
+        self.path = path
+        self.length = length
+        self.version = None
+        self.target_duration = None
+        # число #EXT-X-DISCONTINUITY, ушедших из окна (EXT-X-DISCONTINUITY-SEQUENCE)
+        self.discontinuity_sequence = 0
+        # (media_sequence, key line, rendered #EXTINF + uri, discontinuity)
+        self.entries = deque()
+
+    def append(self, uri: str, duration: float, media_sequence: int,
+               key_line: str = None, discontinuity: bool = False) -> None:
+        lines = []
+        if discontinuity:
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append(f'#EXTINF:{number_to_string(duration)},')
+        lines.append(uri)
+        self.entries.append((media_sequence, key_line, '\n'.join(lines), discontinuity))
+        while self.length and len(self.entries) > self.length:
+            if self.entries.popleft()[3]:
+                self.discontinuity_sequence += 1
+
+    @property
+    def media_sequence(self) -> int:
+        return self.entries[0][0] if self.entries else 0
+
+    def render(self) -> str:
+        output = ['#EXTM3U']
+        if self.media_sequence:
+            output.append(f'#EXT-X-MEDIA-SEQUENCE:{self.media_sequence}')
+        if self.discontinuity_sequence:
+            output.append(f'#EXT-X-DISCONTINUITY-SEQUENCE:{self.discontinuity_sequence}')
+        if self.version:
+            output.append(f'#EXT-X-VERSION:{self.version}')
+        if self.target_duration:
+            output.append(f'#EXT-X-TARGETDURATION:{number_to_string(self.target_duration)}')
+        last_key_line = None
+        for _, key_line, entry, _ in self.entries:
+            # #EXT-X-KEY пишется только при смене ключа
+            if key_line is not None and key_line != last_key_line:
+                output.append(key_line)
+                last_key_line = key_line
+            output.append(entry)
+        output.append('')
+        return '\n'.join(output)
+
+    def publish(self) -> None:
+        """Writes playlist to temporary file and renames it, so players never read half-written playlist"""
+
+        directory, name = os.path.split(self.path)
+        tmp_path = os.path.join(directory, f'.{name}.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.path)
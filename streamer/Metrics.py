@@ -0,0 +1,164 @@
+import bisect
+from typing import Dict, List, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# границы гистограмм в секундах: от выборки из БД до скачивания чанка
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    Metric with optional labels in Prometheus text format; values of one set of labels are taken once
+    by labels() and updated without lookups on the hot path (metrics are updated from one thread of the loop)
+    """
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 registry: 'Registry' = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], object] = {}
+        (registry if registry is not None else REGISTRY).register(self)
+        if not labelnames:
+            self._default = self.labels()
+
+    def _create_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> object:
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {values}')
+        value = self.values.get(values)
+        if value is None:
+            value = self.values[values] = self._create_value()
+        return value
+
+    def _format_labels(self, values: Tuple[str, ...], extra: str = '') -> str:
+        labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def _render_value(self, values: Tuple[str, ...], value) -> List[str]:
+        return [f'{self.name}{self._format_labels(values)} {_format_value(value.value)}']
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for values, value in list(self.values.items()):
+            lines.extend(self._render_value(values, value))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _create_value(self):
+        return CounterValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _create_value(self):
+        return GaugeValue()
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.inc(amount)
+
+    def set(self, value: float) -> None:
+        self._default.set(value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: 'Registry' = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames=labelnames, registry=registry)
+
+    def _create_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+
+    def _render_value(self, values: Tuple[str, ...], value: HistogramValue) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value.counts):
+            cumulative += count
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f'{self.name}_bucket{self._format_labels(values, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{self._format_labels(values)} {_format_value(value.sum)}')
+        lines.append(f'{self.name}_count{self._format_labels(values)} {value.count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self.metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """All metrics in Prometheus text exposition format"""
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
@@ -0,0 +1,47 @@
+from typing import Optional
+
+from aiohttp import web
+
+from streamer.Metrics import CONTENT_TYPE, REGISTRY, Registry
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class MetricsServer:
+    """HTTP listener of writer and encryptor daemons: metrics of the process in Prometheus format on /metrics"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9100, registry: Registry = None):
+        self.host = host
+        self.port = port
+        self.registry = registry if registry is not None else REGISTRY
+        self.runner = None
+
+    @classmethod
+    def from_config(cls, section, port_offset: int = 0) -> Optional['MetricsServer']:
+        """
+        :param section: configparser section [metrics] (or None - metrics are not exposed)
+        :param port_offset: offset of the port for several processes of one daemon (writer shards)
+        """
+
+        if section is None:
+            return None
+        return cls(host=section.get('host', fallback='127.0.0.1'),
+                   port=section.getint('port', fallback=9100) + port_offset)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        response = web.Response(body=self.registry.render().encode())
+        response.headers['Content-Type'] = CONTENT_TYPE
+        return response
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f'Metrics are available on http://{self.host}:{self.port}/metrics')
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
@@ -0,0 +1,85 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class CacheEntry:
+    __slots__ = ('value', 'version', 'size', 'created')
+
+    def __init__(self, value: Any, version: Optional[int], size: int):
+        self.value = value
+        self.version = version
+        self.size = size
+        self.created = time.monotonic()
+
+
+class PlaylistCache:
+    """
+    LRU cache of rendered playlists and metadata.
+    Entries with version None (fully historical intervals) expire after historical_ttl
+    (retention removes their oldest segments), other entries are valid while channel version is the same
+    and not older than ttl
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 64 * 1024 * 1024, ttl: float = 60,
+                 historical_ttl: float = 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.historical_ttl = historical_ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, version: int) -> Any:
+        """
+        :param key: cache key
+        :param version: current version of the channel (see SegmentTail.get_version)
+        :return: cached value or None
+        """
+
+        entry = self.entries.get(key)
+        if entry is not None and self._is_expired(entry, version):
+            self._remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def _is_expired(self, entry: CacheEntry, version: int) -> bool:
+        age = time.monotonic() - entry.created
+        if entry.version is None:
+            return age > self.historical_ttl
+        return entry.version != version or age > self.ttl
+
+    def put(self, key: Hashable, value: Any, version: Optional[int], size: int = None) -> None:
+        if size is None:
+            size = len(value) if isinstance(value, (str, bytes)) else sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = CacheEntry(value=value, version=version, size=size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: Hashable) -> None:
+        self.bytes -= self.entries.pop(key).size
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+        }
@@ -1,22 +1,37 @@
 import configparser
 import datetime
+import math
 import os.path
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
 
-import m3u8
+from m3u8.model import number_to_string
 
-from streamer.Db import DbManager
+from streamer.Db import DbManager, continues_recording
+from streamer.SegmentIndex import NO_BYTE_RANGE, ChannelIndex, SegmentIndex
+
+# чанков в одной части playlist, отдаваемого из индекса
+INDEX_RENDER_BATCH = 1000
 
 
 class PlaylistGenerator:
-    def __init__(self, channel_name: str):
+    def __init__(self, channel_name: str, db_manager: DbManager = None, chunk_prefix: str = None,
+                 segment_index: SegmentIndex = None):
+        """
+        :param db_manager: shared DbManager (API keeps one for the app lifetime)
+        :param chunk_prefix: chunk uri prefix, by default read from pvr.ini
+        :param segment_index: in-memory index of segments, VOD playlists and metadata are read from it instead of db
+        """
+
         self.segments = []
-        self.db_manager = DbManager()
+        self.db_manager = db_manager if db_manager is not None else DbManager()
         self.channel_name = channel_name
+        self.segment_index = segment_index
 
-        config = configparser.ConfigParser()
-        config.read("pvr.ini")
-        self.chunk_prefix = config['plstgen']['chunk_prefix']
+        if chunk_prefix is None:
+            config = configparser.ConfigParser()
+            config.read("pvr.ini")
+            chunk_prefix = config['plstgen']['chunk_prefix']
+        self.chunk_prefix = chunk_prefix
 
     async def _get_segments_from_db(self, from_datetime: datetime.datetime,
                                     to_datetime: datetime.datetime):
@@ -24,73 +39,246 @@ class PlaylistGenerator:
                                                            to_datetime=to_datetime,
                                                            channel_name=self.channel_name)
 
-    async def generate_vod_playlist(self, from_datetime: datetime.datetime,
-                                    to_datetime: datetime.datetime):
-        await self._get_segments_from_db(from_datetime=from_datetime,
-                                         to_datetime=to_datetime)
-        if self.segments:
-            playlist = m3u8.model.M3U8()
-            discontinuity = False
-            prev_media_sequence = None
-            for segment in self.segments:
-                media_sequence = segment.media_sequence
+    async def stream_vod_playlist(self, from_datetime: datetime.datetime,
+                                  to_datetime: datetime.datetime,
+                                  key_line: str = None,
+                                  encrypted_uri_prefix: str = None) -> Optional[AsyncIterator[str]]:
+        """
+        Renders VOD playlist directly from db cursor, without m3u8 objects for every segment
+        :param key_line: #EXT-X-KEY line for playlist of encrypted segments
+        :param encrypted_uri_prefix: uri prefix of encrypted segments, segment uri is <prefix><segment id>.ts
+        :return: async iterator of playlist text parts or None if there are no segments in the interval
+        """
+
+        if self.segment_index is not None:
+            return self._stream_vod_playlist_from_index(from_datetime=from_datetime, to_datetime=to_datetime,
+                                                        key_line=key_line, encrypted_uri_prefix=encrypted_uri_prefix)
+        summary = await self.db_manager.get_interval_summary(from_datetime=from_datetime,
+                                                             to_datetime=to_datetime,
+                                                             channel_name=self.channel_name)
+        if summary.max_duration is None:
+            return None
+        # EXT-X-BYTERANGE требует версии 4, шифрованные чанки отдаются целиком
+        return self._render_vod_playlist(from_datetime=from_datetime, to_datetime=to_datetime,
+                                         target_duration=math.ceil(summary.max_duration),
+                                         version=3 if summary.max_byte_length is None or key_line else 4,
+                                         key_line=key_line, encrypted_uri_prefix=encrypted_uri_prefix)
+
+    async def _render_vod_playlist(self, from_datetime: datetime.datetime,
+                                   to_datetime: datetime.datetime, target_duration: int,
+                                   version: int = 3, key_line: str = None,
+                                   encrypted_uri_prefix: str = None) -> AsyncIterator[str]:
+        # формат совпадает с m3u8.M3U8.dumps()
+        yield '#EXTM3U\n' \
+              '#EXT-X-MEDIA-SEQUENCE:1\n' \
+              f'#EXT-X-VERSION:{version}\n' \
+              f'#EXT-X-TARGETDURATION:{number_to_string(target_duration)}\n' \
+              '#EXT-X-PLAYLIST-TYPE:VOD\n'
+        if key_line:
+            yield key_line + '\n'
+
+        prev_media_sequence = None
+        async for segments in self.db_manager.iter_segments(from_datetime=from_datetime,
+                                                            to_datetime=to_datetime,
+                                                            channel_name=self.channel_name):
+            yield self._render_segments(segments, prev_media_sequence=prev_media_sequence,
+                                        encrypted_uri_prefix=encrypted_uri_prefix)
+            prev_media_sequence = segments[-1].media_sequence
+
+        yield '#EXT-X-ENDLIST\n'
+
+    def _stream_vod_playlist_from_index(self, from_datetime: datetime.datetime,
+                                        to_datetime: datetime.datetime,
+                                        key_line: str = None,
+                                        encrypted_uri_prefix: str = None) -> Optional[AsyncIterator[str]]:
+        channel = self.segment_index.get_channel(self.channel_name)
+        if channel is None:
+            return None
+        low, high = channel.find(from_datetime=from_datetime, to_datetime=to_datetime)
+        if low >= high:
+            return None
+        channel = channel.slice(low, high)
+        byte_ranges = max(channel.byte_lengths) != NO_BYTE_RANGE
+        return self._render_vod_playlist_from_index(channel, low=0, high=len(channel),
+                                                    target_duration=math.ceil(max(channel.durations)),
+                                                    version=4 if byte_ranges and not key_line else 3,
+                                                    key_line=key_line, encrypted_uri_prefix=encrypted_uri_prefix)
+
+    async def _render_vod_playlist_from_index(self, channel: ChannelIndex, low: int, high: int,
+                                              target_duration: int, version: int = 3, key_line: str = None,
+                                              encrypted_uri_prefix: str = None) -> AsyncIterator[str]:
+        # тот же текст, что и _render_vod_playlist, но из колонок индекса без объекта на каждый чанк
+        yield '#EXTM3U\n' \
+              '#EXT-X-MEDIA-SEQUENCE:1\n' \
+              f'#EXT-X-VERSION:{version}\n' \
+              f'#EXT-X-TARGETDURATION:{number_to_string(target_duration)}\n' \
+              '#EXT-X-PLAYLIST-TYPE:VOD\n'
+        if key_line:
+            yield key_line + '\n'
+
+        uri_prefix = os.path.join(self.chunk_prefix, self.channel_name)
+        prev_media_sequence = None
+        for batch_start in range(low, high, INDEX_RENDER_BATCH):
+            lines = []
+            for position in range(batch_start, min(batch_start + INDEX_RENDER_BATCH, high)):
+                media_sequence = channel.media_sequences[position]
                 if prev_media_sequence is not None and media_sequence - prev_media_sequence != 1:
-                    discontinuity = True
+                    lines.append('#EXT-X-DISCONTINUITY\n')
+                lines.append(f'#EXTINF:{number_to_string(channel.durations[position])},\n')
+                if encrypted_uri_prefix is not None:
+                    lines.append(f'{encrypted_uri_prefix}{channel.ids[position]}.ts\n')
                 else:
-                    discontinuity = False
-                uri = os.path.join(self.chunk_prefix, self.channel_name, segment.filename)
-                segment_obj = m3u8.model.Segment(uri=uri,
-                                                 duration=segment.duration,
-                                                 discontinuity=discontinuity)
-                playlist.add_segment(segment_obj)
+                    if channel.byte_lengths[position] != NO_BYTE_RANGE:
+                        lines.append(f'#EXT-X-BYTERANGE:{channel.byte_lengths[position]}'
+                                     f'@{channel.byte_offsets[position]}\n')
+                    lines.append(f'{os.path.join(uri_prefix, channel.get_filename(position))}\n')
                 prev_media_sequence = media_sequence
-            playlist.files = [segment.filename for segment in self.segments]
-            playlist.is_variant = False
-            playlist.__dict__['media_sequence'] = 1
-            playlist.__dict__['version'] = 3
-            playlist.__dict__['target_duration'] = self.segments[0].duration
-            playlist.__dict__['playlist_type'] = 'VOD'
-            playlist.__dict__['is_endlist'] = True
-            return playlist.dumps()
-        return None
+            yield ''.join(lines)
+
+        yield '#EXT-X-ENDLIST\n'
+
+    def _render_segments(self, segments: List, prev_media_sequence: Optional[int] = None,
+                         encrypted_uri_prefix: str = None) -> str:
+        """
+        :param prev_media_sequence: media sequence of the segment before the first one (for discontinuity)
+        :param encrypted_uri_prefix: uri prefix of encrypted segments (see stream_vod_playlist)
+        """
+
+        # filename - путь чанка относительно папки канала (с часовой папкой при раскладке hourly, часовой контейнер при packed)
+        uri_prefix = os.path.join(self.chunk_prefix, self.channel_name)
+        lines = []
+        for segment in segments:
+            media_sequence = segment.media_sequence
+            if prev_media_sequence is not None and media_sequence - prev_media_sequence != 1:
+                lines.append('#EXT-X-DISCONTINUITY\n')
+            lines.append(f'#EXTINF:{number_to_string(segment.duration)},\n')
+            if encrypted_uri_prefix is not None:
+                lines.append(f'{encrypted_uri_prefix}{segment.id}.ts\n')
+            else:
+                if segment.byte_length is not None:
+                    # чанк внутри часового контейнера (раскладка packed)
+                    lines.append(f'#EXT-X-BYTERANGE:{segment.byte_length}@{segment.byte_offset}\n')
+                lines.append(f'{os.path.join(uri_prefix, segment.filename)}\n')
+            prev_media_sequence = media_sequence
+        return ''.join(lines)
+
+    async def generate_vod_playlist(self, from_datetime: datetime.datetime,
+                                    to_datetime: datetime.datetime) -> Optional[str]:
+        parts = await self.stream_vod_playlist(from_datetime=from_datetime, to_datetime=to_datetime)
+        if parts is None:
+            return None
+        return ''.join([part async for part in parts])
+
+    async def generate_live_playlist(self, window: float = 60,
+                                     from_datetime: datetime.datetime = None) -> Optional[Tuple[str, int, int]]:
+        """
+        Live playlist of the archive tail (without EXT-X-ENDLIST, with blocking reload):
+        sliding window of the last window seconds or, if from_datetime is set, EVENT playlist from from_datetime.
+        Media sequence numbers of the playlist are positions of the segments in the channel
+        and discontinuity sequence is counted by the writer, so both do not go back after restart of the source
+        :return: playlist, media sequence number of its last segment and target duration
+        or None if there are no segments
+        """
+
+        if from_datetime is None:
+            last_segment = await self.db_manager.get_last_segment_before(to_datetime=datetime.datetime.max,
+                                                                         channel_name=self.channel_name)
+            if last_segment is None:
+                return None
+            from_datetime = last_segment.start_datetime - datetime.timedelta(seconds=window)
+            playlist_type = None
+        else:
+            playlist_type = 'EVENT'
+
+        segments = await self.db_manager.get_live_segments(from_datetime=from_datetime,
+                                                           channel_name=self.channel_name)
+        # номера чанков в playlist идут подряд: окно начинается после последнего пропуска номеров
+        # (чанк, добавленный не по порядку старта, до начала окна)
+        for index in range(len(segments) - 1, 0, -1):
+            if segments[index].position - segments[index - 1].position != 1:
+                segments = segments[index:]
+                break
+        if not segments:
+            return None
+
+        first_segment = segments[0]
+        target_duration = math.ceil(max(segment.duration for segment in segments))
+        version = 3 if all(segment.byte_length is None for segment in segments) else 4
+        header = '#EXTM3U\n' \
+                 f'#EXT-X-MEDIA-SEQUENCE:{first_segment.position}\n' \
+                 f'#EXT-X-DISCONTINUITY-SEQUENCE:{first_segment.discontinuity_sequence}\n' \
+                 f'#EXT-X-VERSION:{version}\n' \
+                 f'#EXT-X-TARGETDURATION:{target_duration}\n' \
+                 '#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES\n'
+        if playlist_type is not None:
+            header += f'#EXT-X-PLAYLIST-TYPE:{playlist_type}\n'
+        # EXT-X-DISCONTINUITY там же, где writer увеличил discontinuity_sequence (разрыв media sequence источника)
+        return header + self._render_segments(segments), segments[-1].position, target_duration
 
     async def get_metadata_for_interval(self, from_datetime: datetime.datetime,
                                         to_datetime: datetime.datetime) -> List[dict]:
+        """
+        Recording intervals from precalculated recording table: O(number of gaps) instead of reading all segments;
+        intervals are cut by the first and the last segments of the requested interval
+        """
+
+        if self.segment_index is not None:
+            channel = self.segment_index.get_channel(self.channel_name)
+            if channel is None:
+                return []
+            return channel.get_intervals(*channel.find(from_datetime=from_datetime, to_datetime=to_datetime))
+
+        recordings = await self.db_manager.get_recordings(from_datetime=from_datetime,
+                                                          to_datetime=to_datetime,
+                                                          channel_name=self.channel_name)
+        result = [{'start_datetime': recording.start_datetime,
+                   'end_datetime': recording.end_datetime} for recording in recordings]
+
+        if recordings and recordings[0].start_datetime < from_datetime:
+            first_segment = await self.db_manager.get_first_segment_after(from_datetime=from_datetime,
+                                                                          channel_name=self.channel_name)
+            if first_segment is None or first_segment.start_datetime > min(recordings[0].last_start_datetime,
+                                                                           to_datetime):
+                result.pop(0)
+                recordings = recordings[1:]
+            else:
+                result[0]['start_datetime'] = first_segment.start_datetime
+
+        if recordings and recordings[-1].last_start_datetime > to_datetime:
+            last_segment = await self.db_manager.get_last_segment_before(to_datetime=to_datetime,
+                                                                         channel_name=self.channel_name)
+            if last_segment is None or last_segment.start_datetime < max(recordings[-1].start_datetime,
+                                                                         from_datetime):
+                result.pop()
+            else:
+                result[-1]['end_datetime'] = last_segment.start_datetime \
+                                             + datetime.timedelta(seconds=last_segment.duration)
+
+        return result
+
+    async def get_metadata_from_segments(self, from_datetime: datetime.datetime,
+                                         to_datetime: datetime.datetime) -> List[dict]:
+        """Recording intervals calculated by walking all segments of the interval (reference implementation)"""
+
         await self._get_segments_from_db(from_datetime=from_datetime,
                                          to_datetime=to_datetime)
         result = []
-        margin = 2  # запас в секундах, компенсирующий неточность расчета старта чанка (для исключения ложных дыр)
-
         current_range = {}
-        duration_of_previous_segment = 0
-        start_of_previous_segment = 0
+        end_of_previous_segment = None
 
         for segment in self.segments:
-            if current_range == {}:
-                # если только начали заполнять новый интервал
+            if current_range and not continues_recording(end_of_previous_segment, segment.start_datetime):
+                # была дыра, закрываем текущий интервал, чанк начинает новый
+                current_range['end_datetime'] = end_of_previous_segment
+                result.append(current_range)
+                current_range = {}
+            if not current_range:
                 current_range['start_datetime'] = segment.start_datetime
-                # данные для использования на следующем шаге
-                duration_of_previous_segment = segment.duration
-                start_of_previous_segment = segment.start_datetime
-            else:
-                # если интервал уже начат и это следующий чанк-кандидат на продление интервала
-                if segment.start_datetime < start_of_previous_segment \
-                        + datetime.timedelta(seconds=duration_of_previous_segment) \
-                        + datetime.timedelta(seconds=margin):
-                    # чанк вовремя, интервал не прерывается, идем дальше
-                    # данные для использования на следующем шаге
-                    duration_of_previous_segment = segment.duration
-                    start_of_previous_segment = segment.start_datetime
-                else:
-                    # была дыра, закрываем текущий интервал и начинаем новый
-                    current_range['end_datetime'] = start_of_previous_segment \
-                                                    + datetime.timedelta(seconds=duration_of_previous_segment)
-                    result.append(current_range)
-                    current_range = {}
+            end_of_previous_segment = segment.start_datetime + datetime.timedelta(seconds=segment.duration)
 
         # закрываем последний интервал
-        current_range['end_datetime'] = start_of_previous_segment \
-                                        + datetime.timedelta(seconds=duration_of_previous_segment)
-        result.append(current_range)
+        if current_range:
+            current_range['end_datetime'] = end_of_previous_segment
+            result.append(current_range)
 
         return result
@@ -0,0 +1,111 @@
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+from typing import Dict, Set
+
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class PlaylistWatcher:
+    """
+    Wakes up waiters when playlists in the directory are closed after writing or renamed into it (inotify).
+    On systems without inotify waiters are simply woken up every poll_interval seconds,
+    so the caller has to check playlist mtime by itself (see HlsEncryptor._read_playlist)
+    """
+
+    def __init__(self, directory: os.path, poll_interval: float = 1, use_inotify: bool = True):
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.fd = self._init_inotify() if use_inotify else None
+        self._events: Dict[str, asyncio.Event] = {}
+        self._loop = None
+
+    @property
+    def is_inotify(self) -> bool:
+        return self.fd is not None
+
+    def _init_inotify(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, os.strerror(errno))
+        except (OSError, AttributeError) as e:
+            logger.warning(f'inotify is not available for {self.directory}, falling back to polling: {e}')
+            return None
+        logger.debug(f'Watching {self.directory} with inotify')
+        return fd
+
+    def _read_events(self) -> Set[str]:
+        """Reads pending inotify events; returns changed file names ('' means the queue overflowed)"""
+
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                if mask & IN_Q_OVERFLOW:
+                    names.add('')
+                else:
+                    names.add(os.fsdecode(data[offset:offset + length].rstrip(b'\0')))
+                offset += length
+
+    def _on_readable(self) -> None:
+        names = self._read_events()
+        for name, event in self._events.items():
+            if name in names or '' in names:
+                event.set()
+
+    def _get_event(self, name: str) -> asyncio.Event:
+        if self._loop is None and self.is_inotify:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self.fd, self._on_readable)
+        if name not in self._events:
+            self._events[name] = asyncio.Event()
+            # первая проверка плейлиста выполняется сразу
+            self._events[name].set()
+        return self._events[name]
+
+    async def wait(self, name: str, timeout: float = None) -> None:
+        """
+        Waits for the playlist to be written
+        :param name: playlist file name in the directory
+        :param timeout: max waiting time (inotify mode only), safety net for lost events
+        """
+
+        if not self.is_inotify:
+            await asyncio.sleep(self.poll_interval)
+            return
+        event = self._get_event(name)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    def close(self) -> None:
+        if self.is_inotify:
+            if self._loop is not None:
+                self._loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
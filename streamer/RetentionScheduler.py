@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import heapq
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from streamer import HlsDeleter
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class RetentionScheduler:
+    """
+    One retention loop for all channels: removes segments expired by depth_in_hours of their channel
+    and, if disk usage of the archive is above max_disk_usage percent, the oldest segments of all channels
+    (but not newer than min_depth_in_hours); files without db records are removed every orphan_interval seconds
+    (the search lists the whole archive, so it is disabled by default)
+    """
+
+    def __init__(self, deleters: List[HlsDeleter], storage: os.path, interval: float = 10,
+                 batch_size: int = 500, max_disk_usage: float = 0, workers: int = 1,
+                 min_depth_in_hours: float = 1, orphan_interval: float = 0, orphan_min_age: float = 3600):
+        """
+        :param min_depth_in_hours: segments of the last hours are not evicted by disk usage
+        (the disk may be filled by other data than the archive)
+        :param orphan_interval: interval of the search of files without db records, 0 - disabled
+        :param orphan_min_age: only files not modified for this number of seconds are considered orphans
+        """
+
+        self.deleters = deleters
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_disk_usage = max_disk_usage
+        self.min_depth_in_hours = min_depth_in_hours
+        self.orphan_interval = orphan_interval
+        self.orphan_min_age = orphan_min_age
+        self.last_orphan_sweep = None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='retention')
+
+    @classmethod
+    def from_config(cls, deleters: List[HlsDeleter], storage: os.path, section) -> 'RetentionScheduler':
+        if section is None:
+            return cls(deleters=deleters, storage=storage)
+        return cls(deleters=deleters, storage=storage,
+                   interval=section.getfloat('interval', fallback=10),
+                   batch_size=section.getint('batch_size', fallback=500),
+                   max_disk_usage=section.getfloat('max_disk_usage', fallback=0),
+                   workers=section.getint('workers', fallback=1),
+                   min_depth_in_hours=section.getfloat('min_depth_in_hours', fallback=1),
+                   orphan_interval=section.getfloat('orphan_interval', fallback=0),
+                   orphan_min_age=section.getfloat('orphan_min_age', fallback=3600))
+
+    def _get_disk_usage(self) -> float:
+        usage = shutil.disk_usage(self.storage)
+        return usage.used / usage.total * 100
+
+    async def _clear_expired(self) -> int:
+        removed = 0
+        for deleter in self.deleters:
+            try:
+                removed += await deleter.clear_storage_and_db(executor=self.executor, batch_size=self.batch_size)
+            except Exception as e:
+                logger.error(f'Cant clear channel {deleter.channel_name}: {e} - {e.__class__.__name__}')
+        return removed
+
+    async def _evict_oldest(self) -> int:
+        """
+        Removes the oldest segments across all channels until disk usage is below max_disk_usage,
+        segments of the last min_depth_in_hours are kept
+        """
+
+        removed = 0
+        older_then = datetime.datetime.utcnow() - datetime.timedelta(hours=self.min_depth_in_hours)
+        while self._get_disk_usage() > self.max_disk_usage:
+            candidates = []
+            for deleter in self.deleters:
+                rows = await deleter.db_manager.get_oldest_segments(channel_name=deleter.channel_name,
+                                                                    limit=self.batch_size, older_then=older_then)
+                candidates.extend((row.start_datetime, row.id, row, deleter) for row in rows)
+            if not candidates:
+                logger.warning(f'Disk usage {self._get_disk_usage():.1f}% is above {self.max_disk_usage}%, '
+                               f'but there are no segments older than {self.min_depth_in_hours} hours to remove')
+                return removed
+
+            by_deleter = {}
+            for _, _, row, deleter in heapq.nsmallest(self.batch_size, candidates, key=lambda item: item[:2]):
+                by_deleter.setdefault(deleter, []).append(row)
+            for deleter, rows in by_deleter.items():
+                removed += await deleter.remove_segments(rows, executor=self.executor)
+        if removed:
+            logger.info(f'{removed} oldest segments have been removed to keep disk usage '
+                        f'below {self.max_disk_usage}%')
+        return removed
+
+    async def _remove_orphans(self) -> int:
+        removed = 0
+        for deleter in self.deleters:
+            try:
+                removed += await deleter.remove_orphans(min_age=self.orphan_min_age, executor=self.executor,
+                                                        batch_size=self.batch_size)
+            except Exception as e:
+                logger.error(f'Cant remove orphan files of {deleter.channel_name}: {e} - {e.__class__.__name__}')
+        return removed
+
+    async def run_once(self) -> int:
+        removed = await self._clear_expired()
+        if self.max_disk_usage:
+            removed += await self._evict_oldest()
+        if self.orphan_interval and (self.last_orphan_sweep is None
+                                     or time.monotonic() - self.last_orphan_sweep >= self.orphan_interval):
+            self.last_orphan_sweep = time.monotonic()
+            await self._remove_orphans()
+        return removed
+
+    async def run(self) -> None:
+        try:
+            while True:
+                try:
+                    await self.run_once()
+                except Exception as e:
+                    logger.error(f'Retention failed: {e} - {e.__class__.__name__}')
+                await asyncio.sleep(self.interval)
+        finally:
+            self.executor.shutdown(wait=True)
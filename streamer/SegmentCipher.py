@@ -0,0 +1,84 @@
+import os
+
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+AES_BLOCK_SIZE = 16
+READ_BLOCK_SIZE = 64 * 1024
+ENGINE_BUILTIN = 'builtin'
+ENGINE_OPENSSL = 'openssl'
+
+_ciphers = {}
+
+
+def hex_to_bytes(value: str, length: int = AES_BLOCK_SIZE) -> bytes:
+    """
+    Converts hex key/iv to bytes the same way openssl enc -K/-iv does
+    (short values are padded with zeros, long ones are truncated)
+    :param value: hex string, optionally prefixed with 0x
+    :param length: expected length in bytes
+    :return: bytes
+    """
+
+    if value.lower().startswith('0x'):
+        value = value[2:]
+    if len(value) % 2:
+        value += '0'
+    return bytes.fromhex(value)[:length].ljust(length, b'\0')
+
+
+class SegmentCipher:
+    """AES-128-CBC with PKCS7 padding, compatible with `openssl enc -aes-128-cbc -nosalt -K <key> -iv <iv>`"""
+
+    def __init__(self, key: str, iv: str, block_size: int = READ_BLOCK_SIZE):
+        self.key = hex_to_bytes(key)
+        self.iv = hex_to_bytes(iv)
+        self.block_size = block_size
+        # расписание ключа считается один раз, на каждый файл создается только новый CBC-контекст
+        self.algorithm = algorithms.AES(self.key)
+
+    def encrypt_file(self, input_file: os.path, output_file: os.path) -> None:
+        """
+        Encrypts file block by block without loading it to memory
+        :param input_file: clear file
+        :param output_file: encrypted file
+        """
+
+        encryptor = Cipher(self.algorithm, modes.CBC(self.iv)).encryptor()
+        padder = padding.PKCS7(AES_BLOCK_SIZE * 8).padder()
+        with open(input_file, 'rb') as f_in, open(output_file, 'wb') as f_out:
+            while True:
+                block = f_in.read(self.block_size)
+                if not block:
+                    break
+                f_out.write(encryptor.update(padder.update(block)))
+            f_out.write(encryptor.update(padder.finalize()) + encryptor.finalize())
+
+    def encrypt_bytes(self, data: bytes) -> bytes:
+        encryptor = Cipher(self.algorithm, modes.CBC(self.iv)).encryptor()
+        padder = padding.PKCS7(AES_BLOCK_SIZE * 8).padder()
+        return encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+
+
+def openssl_encrypt_file(input_file: os.path, output_file: os.path, key: str, iv: str) -> None:
+    """Encrypts file with forked openssl (legacy engine)"""
+
+    os.system(f"openssl enc -aes-128-cbc -e -in {input_file} -out {output_file} -nosalt -K {key} -iv {iv}")
+
+
+def encrypt_file(input_file: os.path, output_file: os.path, key: str, iv: str,
+                 engine: str = ENGINE_BUILTIN) -> None:
+    """
+    Encrypts file with selected engine; used as a job for worker processes,
+    so ciphers are cached per process and key schedule is not recalculated for every chunk
+    """
+
+    if engine == ENGINE_OPENSSL:
+        openssl_encrypt_file(input_file=input_file, output_file=output_file, key=key, iv=iv)
+        return
+    cipher = _ciphers.get((key, iv))
+    if cipher is None:
+        if len(_ciphers) > 64:
+            _ciphers.clear()
+        cipher = _ciphers[(key, iv)] = SegmentCipher(key=key, iv=iv)
+    cipher.encrypt_file(input_file=input_file, output_file=output_file)
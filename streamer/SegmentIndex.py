@@ -0,0 +1,285 @@
+import asyncio
+import datetime
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from streamer.Db import DbManager, RECORDING_GAP_MARGIN
+from streamer.HlsWriter import LAYOUT_FLAT, get_segment_name
+from streamer.Metrics import Gauge
+from streamer.SegmentTail import SegmentTail
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# имя файла чанка вычисляется по началу чанка (get_segment_name), а не хранится
+FILE_DERIVED = -1
+# отсутствующие byte_offset/byte_length (чанк в отдельном файле)
+NO_BYTE_RANGE = -1
+
+INDEX_SEGMENTS = Gauge('api_segment_index_segments', 'Segments in the in-memory index of the API')
+
+
+def to_microseconds(value: datetime.datetime) -> int:
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_microseconds(value: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+class ChannelIndex:
+    """
+    Segments of one channel in array-backed columns sorted by start (about 52 bytes per segment);
+    positions of segments starting a new recording interval are kept to find intervals by the number of gaps
+    """
+
+    def __init__(self, layout: str = LAYOUT_FLAT):
+        self.layout = layout
+        # начало чанка в микросекундах от EPOCH (наивное время, как в БД)
+        self.starts = array('q')
+        self.durations = array('d')
+        self.media_sequences = array('q')
+        self.ids = array('q')
+        self.file_ids = array('i')
+        self.byte_offsets = array('q')
+        self.byte_lengths = array('q')
+        # имена файлов, не совпадающие с вычисленными (контейнеры раскладки packed)
+        self.files: List[str] = []
+        self.file_ids_by_name: Dict[str, int] = {}
+        # позиции (с учетом offset) чанков, начинающих новый интервал записи после дыры
+        self.breaks = array('q')
+        # число чанков, удаленных с начала индекса
+        self.offset = 0
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def _get_file_id(self, filename: str, start_datetime: datetime.datetime) -> int:
+        if filename == get_segment_name(start_datetime=start_datetime, layout=self.layout):
+            return FILE_DERIVED
+        file_id = self.file_ids_by_name.get(filename)
+        if file_id is None:
+            file_id = self.file_ids_by_name[filename] = len(self.files)
+            self.files.append(filename)
+        return file_id
+
+    def _continues(self, position: int) -> bool:
+        end = self.starts[position - 1] + round(self.durations[position - 1] * 1000000)
+        return self.starts[position] < end + RECORDING_GAP_MARGIN * 1000000
+
+    def _update_break(self, position: int) -> None:
+        """Marks or unmarks the segment at position as the start of a new recording interval"""
+
+        if position <= 0 or position >= len(self.starts):
+            return
+        absolute = self.offset + position
+        index = bisect_left(self.breaks, absolute)
+        present = index < len(self.breaks) and self.breaks[index] == absolute
+        if self._continues(position):
+            if present:
+                del self.breaks[index]
+        elif not present:
+            self.breaks.insert(index, absolute)
+
+    def add(self, segment) -> None:
+        """
+        :param segment: row with id, filename, start_datetime, duration, media_sequence, byte_offset, byte_length
+        """
+
+        start = to_microseconds(segment.start_datetime)
+        values = (start, segment.duration, segment.media_sequence, segment.id,
+                  self._get_file_id(segment.filename, segment.start_datetime),
+                  NO_BYTE_RANGE if segment.byte_offset is None else segment.byte_offset,
+                  NO_BYTE_RANGE if segment.byte_length is None else segment.byte_length)
+        columns = (self.starts, self.durations, self.media_sequences, self.ids, self.file_ids,
+                   self.byte_offsets, self.byte_lengths)
+        if not self.starts or start >= self.starts[-1]:
+            for column, value in zip(columns, values):
+                column.append(value)
+            if len(self.starts) > 1 and not self._continues(len(self.starts) - 1):
+                self.breaks.append(self.offset + len(self.starts) - 1)
+            return
+        # чанк старше последнего (запись канала после перезапуска writer с отставшим playlist) - редкий случай
+        position = bisect_right(self.starts, start)
+        for column, value in zip(columns, values):
+            column.insert(position, value)
+        # дыры после вставленного чанка сдвигаются на одну позицию, пересчитываются только соседи
+        for index in range(bisect_left(self.breaks, self.offset + position), len(self.breaks)):
+            self.breaks[index] += 1
+        self._update_break(position)
+        self._update_break(position + 1)
+
+    def trim(self, first_start_datetime: Optional[datetime.datetime]) -> int:
+        """
+        Removes segments started before the oldest segment of the channel remaining in db
+        :param first_start_datetime: start of the oldest segment in db, None - all segments have been removed
+        :return: number of removed segments
+        """
+
+        count = len(self.starts) if first_start_datetime is None \
+            else bisect_left(self.starts, to_microseconds(first_start_datetime))
+        if not count:
+            return 0
+        for column in (self.starts, self.durations, self.media_sequences, self.ids, self.file_ids,
+                       self.byte_offsets, self.byte_lengths):
+            del column[:count]
+        self.offset += count
+        del self.breaks[:bisect_right(self.breaks, self.offset)]
+        if not self.starts:
+            self.files = []
+            self.file_ids_by_name = {}
+        return count
+
+    def find(self, from_datetime: datetime.datetime, to_datetime: datetime.datetime) -> Tuple[int, int]:
+        """
+        :return: positions of the first segment started at from_datetime or later
+        and of the segment after the last one started at to_datetime or earlier
+        """
+
+        return (bisect_left(self.starts, to_microseconds(from_datetime)),
+                bisect_right(self.starts, to_microseconds(to_datetime)))
+
+    def slice(self, low: int, high: int) -> 'ChannelIndex':
+        """
+        Copy of segments from low to high (exclusive) positions (without gaps): a streamed playlist
+        is rendered from the copy, so trim and out-of-order inserts do not shift its positions
+        """
+
+        channel = ChannelIndex(layout=self.layout)
+        for name in ('starts', 'durations', 'media_sequences', 'ids', 'file_ids', 'byte_offsets', 'byte_lengths'):
+            setattr(channel, name, getattr(self, name)[low:high])
+        # список имен только дополняется (или заменяется целиком), id файлов копии остаются верными
+        channel.files = self.files
+        return channel
+
+    def get_filename(self, position: int) -> str:
+        file_id = self.file_ids[position]
+        if file_id == FILE_DERIVED:
+            return get_segment_name(start_datetime=from_microseconds(self.starts[position]), layout=self.layout)
+        return self.files[file_id]
+
+    def get_end_datetime(self, position: int) -> datetime.datetime:
+        return from_microseconds(self.starts[position]) + datetime.timedelta(seconds=self.durations[position])
+
+    def get_intervals(self, low: int, high: int) -> List[dict]:
+        """Recording intervals of segments from low to high (exclusive) positions, O(number of gaps)"""
+
+        if low >= high:
+            return []
+        result = []
+        start = low
+        for index in range(bisect_right(self.breaks, self.offset + low), bisect_left(self.breaks, self.offset + high)):
+            position = self.breaks[index] - self.offset
+            result.append({'start_datetime': from_microseconds(self.starts[start]),
+                           'end_datetime': self.get_end_datetime(position - 1)})
+            start = position
+        result.append({'start_datetime': from_microseconds(self.starts[start]),
+                       'end_datetime': self.get_end_datetime(high - 1)})
+        return result
+
+    def get_size(self) -> int:
+        """Approximate memory of the columns in bytes"""
+
+        return sum(column.itemsize * len(column) for column in (
+            self.starts, self.durations, self.media_sequences, self.ids, self.file_ids,
+            self.byte_offsets, self.byte_lengths, self.breaks))
+
+
+class SegmentIndex:
+    """
+    In-memory index of segments of all channels for playlist and metadata requests:
+    loaded from db at start, then filled by SegmentTail and trimmed by the oldest segments in db after retention
+    """
+
+    def __init__(self, db_manager: DbManager, tail: SegmentTail, layout: str = LAYOUT_FLAT,
+                 trim_interval: float = 10, batch_size: int = 10000):
+        """
+        :param layout: archive layout of writer (file names of segments are not stored if they match it)
+        :param trim_interval: interval of checking segments removed by retention in seconds
+        """
+
+        self.db_manager = db_manager
+        self.layout = layout
+        self.trim_interval = trim_interval
+        self.batch_size = batch_size
+        self.channels: Dict[str, ChannelIndex] = {}
+        # новые чанки SegmentTail, пришедшие во время загрузки, добавляются после нее (по порядку начала)
+        self.pending: Optional[List[Tuple[str, List]]] = None
+        tail.subscribe(self._on_new_segments)
+
+    def _on_new_segments(self, channel_name: str, segments) -> None:
+        if self.pending is not None:
+            self.pending.append((channel_name, segments))
+            return
+        self._add_segments(channel_name, segments)
+
+    def _add_segments(self, channel_name: str, segments) -> None:
+        channel = self.channels.get(channel_name)
+        if channel is None:
+            channel = self.channels[channel_name] = ChannelIndex(layout=self.layout)
+        for segment in segments:
+            channel.add(segment)
+        INDEX_SEGMENTS.inc(len(segments))
+
+    async def load(self, last_id: int) -> None:
+        """
+        Loads segments inserted before the start of SegmentTail
+        :param last_id: SegmentTail.last_id, newer segments come from SegmentTail
+        """
+
+        started = time.perf_counter()
+        self.pending = []
+        try:
+            await self._load(last_id)
+        finally:
+            pending, self.pending = self.pending, None
+            for channel_name, segments in pending:
+                self._add_segments(channel_name, segments)
+        size = sum(channel.get_size() for channel in self.channels.values())
+        count = sum(len(channel) for channel in self.channels.values())
+        logger.info(f'Segment index has been loaded: {count} segments of {len(self.channels)} channels '
+                    f'in {time.perf_counter() - started:.1f} s, {size / 1024 / 1024:.1f} MiB')
+
+    async def _load(self, last_id: int) -> None:
+        loaded_id = 0
+        while loaded_id < last_id:
+            rows = await self.db_manager.get_segments_after(last_id=loaded_id, limit=self.batch_size)
+            rows = [row for row in rows if row.id <= last_id]
+            if not rows:
+                break
+            loaded_id = rows[-1].id
+            new_segments = {}
+            for row in rows:
+                new_segments.setdefault(row.channel_name, []).append(row)
+            for channel_name, channel_segments in new_segments.items():
+                self._add_segments(channel_name, channel_segments)
+
+    async def trim(self) -> int:
+        """
+        Removes segments deleted by retention of writer
+        :return: number of removed segments
+        """
+
+        removed = 0
+        for channel_name, channel in list(self.channels.items()):
+            if not len(channel):
+                continue
+            first_segment = await self.db_manager.get_first_segment_after(from_datetime=datetime.datetime.min,
+                                                                          channel_name=channel_name)
+            removed += channel.trim(first_segment.start_datetime if first_segment is not None else None)
+        INDEX_SEGMENTS.inc(-removed)
+        return removed
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.trim_interval)
+            try:
+                await self.trim()
+            except Exception as e:
+                logger.error(f'Cant trim segment index: {e} - {e.__class__.__name__}')
+
+    def get_channel(self, channel_name: str) -> Optional[ChannelIndex]:
+        return self.channels.get(channel_name)
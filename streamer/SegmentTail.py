@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+from typing import Callable, Dict, List
+
+from streamer.Db import DbManager
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+# запас на неточность расчета старта чанка: интервал, закончившийся раньше последнего чанка
+# больше чем на HISTORICAL_MARGIN, уже не может пополниться
+HISTORICAL_MARGIN = 10
+
+
+class ChannelState:
+    def __init__(self):
+        self.last_id = 0
+        self.last_start_datetime = None
+        self.last_media_sequence = None
+
+
+class SegmentTail:
+    """
+    Follows segments inserted by writer (in another process) by the primary key of segment table
+    and notifies subscribers about them; one db query per interval for all channels
+    """
+
+    def __init__(self, db_manager: DbManager, interval: float = 1, batch_size: int = 1000):
+        self.db_manager = db_manager
+        self.interval = interval
+        self.batch_size = batch_size
+        self.last_id = 0
+        self.channels: Dict[str, ChannelState] = {}
+        self.subscribers: List[Callable] = []
+
+    def subscribe(self, callback: Callable) -> None:
+        """
+        :param callback: callback(channel_name, segments) called for every channel with new segments
+        """
+
+        self.subscribers.append(callback)
+
+    async def start(self) -> None:
+        """Skips segments inserted before the start"""
+
+        self.last_id = await self.db_manager.get_last_segment_id()
+
+    async def poll(self) -> int:
+        """
+        Reads new segments
+        :return: number of new segments
+        """
+
+        count = 0
+        while True:
+            rows = await self.db_manager.get_segments_after(last_id=self.last_id, limit=self.batch_size)
+            if not rows:
+                return count
+            count += len(rows)
+            self.last_id = rows[-1].id
+
+            new_segments = {}
+            for row in rows:
+                new_segments.setdefault(row.channel_name, []).append(row)
+            for channel_name, channel_segments in new_segments.items():
+                state = self.channels.setdefault(channel_name, ChannelState())
+                state.last_id = channel_segments[-1].id
+                last_start_datetime = max(segment.start_datetime for segment in channel_segments)
+                if state.last_start_datetime is None or last_start_datetime > state.last_start_datetime:
+                    state.last_start_datetime = last_start_datetime
+                state.last_media_sequence = channel_segments[-1].media_sequence
+                for callback in self.subscribers:
+                    callback(channel_name, channel_segments)
+            if len(rows) < self.batch_size:
+                return count
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f'Cant read new segments from db: {e} - {e.__class__.__name__}')
+            await asyncio.sleep(self.interval)
+
+    def get_version(self, channel_name: str) -> int:
+        """Changes every time new segments of the channel appear"""
+
+        state = self.channels.get(channel_name)
+        return state.last_id if state is not None else 0
+
+    def is_historical(self, channel_name: str, to_datetime: datetime.datetime) -> bool:
+        """True if no new segments can appear in the interval ending at to_datetime"""
+
+        state = self.channels.get(channel_name)
+        if state is None or state.last_start_datetime is None:
+            return False
+        return to_datetime < state.last_start_datetime - datetime.timedelta(seconds=HISTORICAL_MARGIN)
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import time
+from typing import Callable, Dict, List, Optional
+
+from streamer.logs import get_logger
+
+logger = get_logger(__name__)
+
+# условная стоимость обработки одного чанка (разбор playlist, запись в БД, создание файла) в байтах трафика
+SEGMENT_COST_BYTES = 256 * 1024
+# нагрузка канала без статистики и без подсказок в channels.json
+DEFAULT_BITRATE = 2000
+DEFAULT_SEGMENT_DURATION = 2
+
+
+def get_channel_name(channel: Dict) -> str:
+    return channel['source'].split('/')[-1].split('.')[0]
+
+
+def get_channel_weight(bytes_per_second: float, segments_per_second: float) -> float:
+    return bytes_per_second + segments_per_second * SEGMENT_COST_BYTES
+
+
+def _pack(weights: Dict[str, float], loads: List[float], assignment: Dict[str, int], names) -> None:
+    # жадная упаковка: самый тяжелый канал - в наименее нагруженный шард
+    for name in sorted(names, key=lambda name_: (-weights[name_], name_)):
+        shard = loads.index(min(loads))
+        assignment[name] = shard
+        loads[shard] += weights[name]
+
+
+def assign_channels(weights: Dict[str, float], shards: int, current: Dict[str, int] = None,
+                    rebalance_threshold: float = 1.2) -> Dict[str, int]:
+    """
+    Channels keep their shards, new channels go to the least loaded shards; if the most loaded shard
+    is more than rebalance_threshold times heavier than with full redistribution, all channels are redistributed
+    :param weights: load of channels by channel names
+    :param current: current shards by channel names
+    :return: shards by channel names
+    """
+
+    assignment = {}
+    loads = [0.0] * shards
+    for name, shard in (current or {}).items():
+        if name in weights and shard < shards:
+            assignment[name] = shard
+            loads[shard] += weights[name]
+    _pack(weights, loads, assignment, set(weights) - set(assignment))
+
+    balanced = {}
+    balanced_loads = [0.0] * shards
+    _pack(weights, balanced_loads, balanced, weights)
+    if max(loads) > max(balanced_loads) * rebalance_threshold:
+        return balanced
+    return assignment
+
+
+class ShardSupervisor:
+    """
+    Runs channels of channels file in worker processes (shards) balanced by load of channels,
+    restarts dead workers and redistributes channels when channels file changes.
+    Workers run target(shard, channels, stats_queue) and report load of their channels to stats_queue
+    """
+
+    def __init__(self, channels_file: os.path, workers: int, target: Callable,
+                 on_channels_change: Callable = None, check_interval: float = 5,
+                 rebalance_threshold: float = 1.2, stop_timeout: float = 10):
+        """
+        :param on_channels_change: called with the list of channels after every change of channels file
+        """
+
+        self.channels_file = channels_file
+        self.workers = workers
+        self.target = target
+        self.on_channels_change = on_channels_change
+        self.check_interval = check_interval
+        self.rebalance_threshold = rebalance_threshold
+        self.stop_timeout = stop_timeout
+        self.context = multiprocessing.get_context('spawn')
+        self.stats_queue = self.context.Queue()
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.started = [0.0] * workers
+        self.shard_channels: List[List[Dict]] = [[] for _ in range(workers)]
+        self.channels_mtime = None
+        self.channels: Dict[str, Dict] = {}
+        self.assignment: Dict[str, int] = {}
+        # измеренная нагрузка каналов: байт/с и чанков/с
+        self.rates: Dict[str, tuple] = {}
+
+    def _read_channels(self) -> bool:
+        """
+        :return: True if channels file has been changed
+        """
+
+        try:
+            mtime = os.stat(self.channels_file).st_mtime_ns
+            if mtime == self.channels_mtime:
+                return False
+            with open(self.channels_file, encoding='utf-8') as f:
+                channels = json.load(f)
+        except (OSError, ValueError) as e:
+            # файл может читаться в момент записи, повторное чтение - на следующей проверке
+            logger.error(f'Cant read channels file {self.channels_file}: {e} - {e.__class__.__name__}')
+            return False
+        self.channels_mtime = mtime
+        self.channels = {get_channel_name(channel): channel for channel in channels}
+        return True
+
+    def get_weight(self, channel_name: str) -> float:
+        if channel_name in self.rates:
+            return get_channel_weight(*self.rates[channel_name])
+        channel = self.channels[channel_name]
+        return get_channel_weight(channel.get('bitrate', DEFAULT_BITRATE) * 1000 / 8,
+                                  1 / channel.get('segment_duration', DEFAULT_SEGMENT_DURATION))
+
+    def _start(self, shard: int) -> None:
+        process = self.context.Process(target=self.target, name=f'writer-shard-{shard}', daemon=True,
+                                       args=(shard, self.shard_channels[shard], self.stats_queue))
+        process.start()
+        self.processes[shard] = process
+        self.started[shard] = time.monotonic()
+        logger.info(f'Shard {shard} (pid {process.pid}) has been started with {len(self.shard_channels[shard])} '
+                    f'channels: {", ".join(get_channel_name(channel) for channel in self.shard_channels[shard])}')
+
+    def _sync_stop(self, shard: int) -> None:
+        process = self.processes[shard]
+        if process is None:
+            return
+        # по SIGTERM шард дописывает накопленные чанки в БД
+        process.terminate()
+        process.join(self.stop_timeout)
+        if process.is_alive():
+            logger.warning(f'Shard {shard} (pid {process.pid}) has not stopped in {self.stop_timeout} s, killing it')
+            process.kill()
+            process.join()
+        self.processes[shard] = None
+
+    async def _stop(self, shards: List[int]) -> None:
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, self._sync_stop, shard) for shard in shards])
+
+    async def _rebalance(self) -> None:
+        weights = {name: self.get_weight(name) for name in self.channels}
+        self.assignment = assign_channels(weights, shards=self.workers, current=self.assignment,
+                                          rebalance_threshold=self.rebalance_threshold)
+        shard_channels = [[] for _ in range(self.workers)]
+        for name in sorted(self.assignment):
+            shard_channels[self.assignment[name]].append(self.channels[name])
+
+        changed = [shard for shard in range(self.workers) if shard_channels[shard] != self.shard_channels[shard]]
+        # канал не должен писаться двумя шардами одновременно: сначала остановка, затем запуск
+        await self._stop(changed)
+        for shard in changed:
+            self.shard_channels[shard] = shard_channels[shard]
+            if shard_channels[shard]:
+                self._start(shard)
+        if self.on_channels_change is not None:
+            self.on_channels_change(list(self.channels.values()))
+
+    def _restart_dead(self) -> None:
+        for shard, process in enumerate(self.processes):
+            if process is None or process.is_alive():
+                continue
+            # не чаще раза в check_interval, если шард падает сразу после запуска
+            if time.monotonic() - self.started[shard] < self.check_interval:
+                continue
+            logger.error(f'Shard {shard} (pid {process.pid}) has died with exit code {process.exitcode}, restarting')
+            self._start(shard)
+
+    def _read_stats(self) -> None:
+        while True:
+            try:
+                report = self.stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            interval = report['interval']
+            segments = sum(channel_segments for channel_segments, _ in report['channels'].values())
+            received = sum(channel_bytes for _, channel_bytes in report['channels'].values())
+            for name, (channel_segments, channel_bytes) in report['channels'].items():
+                self.rates[name] = (channel_bytes / interval, channel_segments / interval)
+            logger.info(f'Shard {report["shard"]} (pid {report["pid"]}): {len(report["channels"])} channels, '
+                        f'{segments / interval:.2f} segments/s, {received / interval / 1024 / 1024:.2f} MiB/s')
+
+    async def run(self) -> None:
+        try:
+            while True:
+                if self._read_channels():
+                    await self._rebalance()
+                self._restart_dead()
+                self._read_stats()
+                await asyncio.sleep(self.check_interval)
+        finally:
+            await self._stop([shard for shard in range(self.workers) if self.processes[shard] is not None])
@@ -2,3 +2,5 @@ from streamer.HlsReader import HlsReader
 from streamer.HlsWriter import HlsWriter
 from streamer.HlsDeleter import HlsDeleter
 from streamer.HlsEncryptor import HlsEncryptor
+from streamer.EncryptorPool import EncryptorPool
+from streamer.RetentionScheduler import RetentionScheduler
@@ -1,15 +1,184 @@
+import atexit
 import logging
 import os
+import queue
+import time
 from logging import handlers
+from typing import Dict, Optional, Tuple
 
 
 LOG_DIR = 'logs'
+os.makedirs(LOG_DIR, exist_ok=True)
 log_format = logging.Formatter('%(asctime)s %(module)s %(levelname)s %(message)s')
-handler = handlers.TimedRotatingFileHandler(filename=os.path.join(LOG_DIR, 'streamer.log'),
-                                            when='D',
-                                            interval=1,
-                                            backupCount=10)
-handler.setFormatter(log_format)
+
+
+def _create_file_handler(filename: str) -> logging.Handler:
+    # файл открывается при первой записи: процесс, сменивший файл лога, не трогает общий
+    file_handler = handlers.TimedRotatingFileHandler(filename=os.path.join(LOG_DIR, filename),
+                                                     when='D',
+                                                     interval=1,
+                                                     backupCount=10,
+                                                     delay=True)
+    file_handler.setFormatter(log_format)
+    return file_handler
+
+
+handler = _create_file_handler('streamer.log')
 logger = logging.getLogger('streamer')
 logger.setLevel(logging.DEBUG)
 logger.addHandler(handler)
+
+# обработчик, через который пишут логгеры streamer (файл или очередь к нему)
+_active_handler: logging.Handler = handler
+_listener: Optional[handlers.QueueListener] = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Logger of the component (module) of streamer, its level can be set by [logging] levels
+    :param name: __name__ of the module
+    """
+
+    return logging.getLogger(name)
+
+
+class ChannelRateLimit(logging.Filter):
+    """
+    Token bucket per channel and place of the call for records below WARNING logged with extra={'channel': ...}:
+    per-segment messages of hundreds of channels are limited to rate messages per second (with burst)
+    of every channel, the number of suppressed messages is added to the next passed one
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        # (tokens, time of the last update, suppressed messages) by (channel, module, line)
+        self.buckets: Dict[Tuple[str, str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        channel = getattr(record, 'channel', None)
+        if channel is None or record.levelno >= logging.WARNING:
+            return True
+        key = (channel, record.module, record.lineno)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            record.msg = f'{record.msg} ({bucket[2]} similar messages of {channel} have been suppressed)'
+            bucket[2] = 0
+        return True
+
+
+class NonBlockingQueueHandler(handlers.QueueHandler):
+    """
+    Puts records to the bounded queue without formatting (formatting and writing are done by the listener thread);
+    records are dropped when the queue is full, so slow disk does not block the event loop
+    """
+
+    def __init__(self, queue_: queue.Queue):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # записи не покидают процесс: сообщение и traceback форматируются в потоке записи
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': logger.name, 'module': 'logs', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': f'{self.dropped} log records have been dropped: log queue is full'}))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def set_log_file(filename: str) -> None:
+    """
+    Writes the log of this process to its own file in LOG_DIR (several processes must not rotate one file);
+    must be called before configure_logging
+    """
+
+    global handler, _active_handler
+
+    if _listener is not None:
+        raise RuntimeError('Log file can not be changed after queued logging has been started')
+    file_handler = _create_file_handler(filename)
+    logger.removeHandler(handler)
+    handler.close()
+    logger.addHandler(file_handler)
+    if _active_handler is handler:
+        _active_handler = file_handler
+    handler = file_handler
+
+
+def _parse_levels(value: str) -> Dict[str, str]:
+    """
+    :param value: comma separated component:LEVEL, e.g. "HlsWriter:INFO, Db:WARNING, sqlalchemy.engine:INFO"
+    :return: levels by logger names (components without dot are modules of streamer)
+    """
+
+    levels = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        name, level = (part.strip() for part in item.split(':'))
+        levels[name if '.' in name else f'{logger.name}.{name}'] = level.upper()
+    return levels
+
+
+def configure_logging(section) -> None:
+    """
+    Applies [logging] section of the config (without section the log is written synchronously at DEBUG level)
+    :param section: configparser section or None
+    """
+
+    global _active_handler, _listener
+
+    if section is None:
+        return
+    logger.setLevel(section.get('level', fallback='DEBUG').upper())
+    for name, level in _parse_levels(section.get('levels', fallback='')).items():
+        logging.getLogger(name).setLevel(level)
+
+    if section.getboolean('queue', fallback=False) and _listener is None:
+        queue_handler = NonBlockingQueueHandler(queue.Queue(section.getint('queue_size', fallback=10000)))
+        logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        _listener = handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+        _listener.start()
+        # записи из очереди дописываются в файл при завершении процесса
+        atexit.register(_listener.stop)
+        _active_handler = queue_handler
+
+    channel_rate = section.getfloat('channel_rate', fallback=0)
+    if channel_rate > 0 and not any(isinstance(filter_, ChannelRateLimit) for filter_ in _active_handler.filters):
+        # ограничение частоты проверяется до постановки в очередь
+        _active_handler.addFilter(ChannelRateLimit(rate=channel_rate,
+                                                   burst=section.getint('channel_burst', fallback=5)))
+
+
+def capture_logger(name: str, level: int) -> bool:
+    """
+    Writes records of the foreign logger (e.g. sqlalchemy.engine) to the log of streamer through the queue
+    :return: False if queued logging is not enabled
+    """
+
+    if _listener is None:
+        return False
+    foreign_logger = logging.getLogger(name)
+    if foreign_logger.level == logging.NOTSET:
+        foreign_logger.setLevel(level)
+    if _active_handler not in foreign_logger.handlers:
+        foreign_logger.addHandler(_active_handler)
+    return True
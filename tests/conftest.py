@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from streamer import Db
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    """Url of an empty sqlite db, engines and per-engine state of the test are dropped afterwards"""
+
+    yield f'sqlite:///{tmp_path}/base.sqlite'
+    for cache in (Db._engines, Db._batchers, Db._trackers, Db._sequencers):
+        cache.clear()
+
+
+@pytest.fixture
+def run():
+    """
+    Runs the coroutine in a new event loop; worker threads of the engines (create_db) are bound to the loop,
+    so they are stopped before it is closed
+    """
+
+    async def _main(coroutine):
+        try:
+            return await coroutine
+        finally:
+            for engine in Db._engines.values():
+                if engine._engine_worker is not None:
+                    await engine._engine_worker.quit()
+                    engine._engine_worker = None
+
+    return lambda coroutine: asyncio.run(_main(coroutine))
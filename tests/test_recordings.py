@@ -0,0 +1,162 @@
+import datetime
+import random
+
+import pytest
+
+from streamer import Db
+from streamer.Db import DbManager
+from streamer.PlaylistGenerator import PlaylistGenerator
+
+CHANNEL = 'channel'
+START = datetime.datetime(2024, 6, 1)
+
+
+def _shuffled(segments, swaps: int, seed: int):
+    """Swaps neighbouring segments (writer inserts them in the order of download)"""
+
+    rnd = random.Random(seed)
+    segments = segments[:]
+    for _ in range(swaps):
+        i = rnd.randrange(len(segments) - 5)
+        j = i + rnd.randint(1, 5)
+        segments[i], segments[j] = segments[j], segments[i]
+    return segments
+
+
+def _with_gaps(count: int, seed: int):
+    """(offset in seconds, duration) of segments with random gaps"""
+
+    rnd = random.Random(seed)
+    segments = []
+    offset = 0
+    for _ in range(count):
+        duration = rnd.choice([2, 2, 2, 1.5])
+        segments.append((offset, duration))
+        offset += duration
+        if rnd.random() < 0.1:
+            offset += rnd.choice([5, 20])
+    return segments
+
+
+async def _fill(db_manager: DbManager, segments, flush_probability: float = 0, seed: int = 0) -> None:
+    rnd = random.Random(seed)
+    for i, (offset, duration) in enumerate(segments):
+        await db_manager.add_segment(filename=f'{i}.ts', duration=duration,
+                                     start_datetime=START + datetime.timedelta(seconds=offset),
+                                     original_filename=f'{i}.ts', media_sequence=i, channel_name=CHANNEL)
+        if rnd.random() < flush_probability:
+            await db_manager.flush()
+    await db_manager.flush()
+
+
+async def _compare(db_manager: DbManager, from_datetime=datetime.datetime.min, to_datetime=datetime.datetime.max):
+    generator = PlaylistGenerator(CHANNEL, db_manager=db_manager, chunk_prefix='')
+    expected = await generator.get_metadata_from_segments(from_datetime, to_datetime)
+    actual = await generator.get_metadata_for_interval(from_datetime, to_datetime)
+    return expected, actual
+
+
+def test_gaps(run, db_url):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await db_manager.create_db()
+        await _fill(db_manager, [(0, 2), (2, 2), (4, 2), (30, 2), (32, 2), (100, 2)])
+        return await _compare(db_manager)
+
+    expected, actual = run(check())
+    assert len(expected) == 3
+    assert actual == expected
+
+
+def test_out_of_order_segment_does_not_split_interval(run, db_url):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await db_manager.create_db()
+        await _fill(db_manager, [(2 * i, 2) for i in [0, 1, 2, 3, 5, 4, 6, 7]])
+        return await _compare(db_manager)
+
+    expected, actual = run(check())
+    assert len(expected) == 1
+    assert actual == expected
+
+
+def test_out_of_order_segment_fills_gap(run, db_url):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await db_manager.create_db()
+        # чанк 4 приходит последним и соединяет два интервала
+        await _fill(db_manager, [(2 * i, 2) for i in [0, 1, 2, 3, 5, 6, 7, 4]])
+        return await _compare(db_manager)
+
+    expected, actual = run(check())
+    assert len(expected) == 1
+    assert actual == expected
+
+
+@pytest.mark.parametrize('batch_interval', [0, 1])
+@pytest.mark.parametrize('seed', range(10))
+def test_random_order(run, db_url, batch_interval, seed):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=batch_interval)
+        await db_manager.create_db()
+        segments = _shuffled(_with_gaps(60, seed), swaps=8, seed=seed)
+        await _fill(db_manager, segments, flush_probability=0.1 if batch_interval else 0, seed=seed)
+        return await _compare(db_manager)
+
+    expected, actual = run(check())
+    assert actual == expected
+
+
+def test_writer_restart(run, db_url):
+    async def check():
+        segments = _shuffled(_with_gaps(120, seed=3), swaps=12, seed=3)
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await db_manager.create_db()
+        await _fill(db_manager, segments[:60])
+        # новый процесс writer читает состояние интервалов из БД
+        Db._trackers.clear()
+        Db._sequencers.clear()
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await _fill(db_manager, segments[60:])
+        return await _compare(db_manager)
+
+    expected, actual = run(check())
+    assert actual == expected
+
+
+def test_sub_interval(run, db_url):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await db_manager.create_db()
+        await _fill(db_manager, _shuffled(_with_gaps(200, seed=1), swaps=20, seed=1))
+        results = []
+        rnd = random.Random(1)
+        for _ in range(30):
+            from_datetime = START + datetime.timedelta(seconds=rnd.randint(-50, 500))
+            to_datetime = from_datetime + datetime.timedelta(seconds=rnd.choice([0, 10, 60, 300]))
+            results.append(await _compare(db_manager, from_datetime, to_datetime))
+        return results
+
+    for expected, actual in run(check()):
+        assert actual == expected
+
+
+def test_retention(run, db_url):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=0)
+        await db_manager.create_db()
+        await _fill(db_manager, _shuffled(_with_gaps(200, seed=2), swaps=20, seed=2))
+        results = []
+        # удаление до середины интервала записи и до его конца
+        for seconds in (33, 150, 151, 280):
+            await db_manager.delete_segments(older_then=START + datetime.timedelta(seconds=seconds),
+                                             channel_name=CHANNEL)
+            results.append(await _compare(db_manager))
+        await db_manager.delete_segments(older_then=datetime.datetime.max, channel_name=CHANNEL)
+        results.append(await _compare(db_manager))
+        return results
+
+    results = run(check())
+    for expected, actual in results:
+        assert actual == expected
+    assert results[-1] == ([], [])
@@ -0,0 +1,192 @@
+import asyncio
+import datetime
+import random
+
+import pytest
+
+from streamer.Db import DbManager
+from streamer.HlsWriter import LAYOUT_FLAT, LAYOUT_HOURLY, LAYOUT_PACKED, get_segment_name
+from streamer.PlaylistGenerator import PlaylistGenerator
+from streamer.SegmentIndex import SegmentIndex
+from streamer.SegmentTail import SegmentTail
+
+CHANNEL = 'channel'
+START = datetime.datetime(2024, 6, 1)
+
+
+def _generate(layout: str, count: int, seed: int, start_datetime: datetime.datetime = START,
+              media_sequence: int = 0):
+    """Rows of segments with random durations, gaps and restarts of the source"""
+
+    rnd = random.Random(seed)
+    start = start_datetime
+    byte_offset = 0
+    rows = []
+    for i in range(count):
+        duration = rnd.choice([2.0, 2.002, 1.96])
+        if rnd.random() < 0.02:
+            start += datetime.timedelta(seconds=rnd.randint(5, 100))
+            media_sequence += 3
+        if layout == LAYOUT_PACKED and start.hour != (start - datetime.timedelta(seconds=duration)).hour:
+            byte_offset = 0
+        byte_range = dict(byte_offset=byte_offset, byte_length=1000) if layout == LAYOUT_PACKED else {}
+        rows.append(dict(filename=get_segment_name(start, layout), duration=duration, start_datetime=start,
+                         original_filename=f'{i}.ts', media_sequence=media_sequence, channel_name=CHANNEL,
+                         **byte_range))
+        start += datetime.timedelta(seconds=duration)
+        media_sequence += 1
+        byte_offset += 1000
+    return rows
+
+
+async def _add(db_manager: DbManager, rows) -> None:
+    """Inserts the rows by batches (db_manager with a long batch_interval)"""
+
+    for row in rows:
+        await db_manager.add_segment(**row)
+    await db_manager.flush()
+
+
+async def _read(playlist) -> str:
+    return None if playlist is None else ''.join([part async for part in playlist])
+
+
+async def _compare(db_manager: DbManager, segment_index: SegmentIndex, seed: int, count: int = 40):
+    """:return: pairs of db and index results for random intervals"""
+
+    rnd = random.Random(seed)
+    from_db = PlaylistGenerator(CHANNEL, db_manager=db_manager, chunk_prefix='')
+    from_index = PlaylistGenerator(CHANNEL, db_manager=db_manager, chunk_prefix='', segment_index=segment_index)
+    results = []
+    for _ in range(count):
+        from_datetime = START + datetime.timedelta(seconds=rnd.randint(-1000, 12000))
+        to_datetime = from_datetime + datetime.timedelta(seconds=rnd.choice([0, 60, 600, 3600, 86400]))
+        for encrypted_uri_prefix in (None, 'encrypted/1/'):
+            key_line = '#EXT-X-KEY:METHOD=AES-128,URI="key"' if encrypted_uri_prefix else None
+            results.append((
+                await _read(await from_db.stream_vod_playlist(from_datetime, to_datetime, key_line=key_line,
+                                                              encrypted_uri_prefix=encrypted_uri_prefix)),
+                await _read(await from_index.stream_vod_playlist(from_datetime, to_datetime, key_line=key_line,
+                                                                 encrypted_uri_prefix=encrypted_uri_prefix))))
+        results.append((await from_db.get_metadata_from_segments(from_datetime, to_datetime),
+                        await from_index.get_metadata_for_interval(from_datetime, to_datetime)))
+    return results
+
+
+async def _create_index(db_manager: DbManager, layout: str):
+    tail = SegmentTail(db_manager=db_manager)
+    await tail.start()
+    segment_index = SegmentIndex(db_manager=db_manager, tail=tail, layout=layout)
+    await segment_index.load(last_id=tail.last_id)
+    return tail, segment_index
+
+
+@pytest.mark.parametrize('layout', [LAYOUT_FLAT, LAYOUT_HOURLY, LAYOUT_PACKED])
+def test_index_matches_db(run, db_url, layout):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=60)
+        await db_manager.create_db()
+        rows = _generate(layout, 3000, seed=1)
+        # пропущенные чанки дают дыры, которые закроются при их вставке не по порядку
+        late_rows = [rows.pop(2200), rows.pop(1500), rows.pop(1499)]
+        # и отдельный чанк внутри дыры
+        late_rows += _generate(layout, 1, seed=3, start_datetime=START + datetime.timedelta(hours=2, minutes=30))
+        await _add(db_manager, rows)
+        tail, segment_index = await _create_index(db_manager, layout)
+        results = await _compare(db_manager, segment_index, seed=1)
+
+        # новые чанки из SegmentTail вперемешку с чанками из прошлого
+        rows = _generate(layout, 200, seed=2, start_datetime=START + datetime.timedelta(hours=3),
+                         media_sequence=10000)
+        for index, row in enumerate(late_rows):
+            rows.insert(50 * (index + 1), row)
+        await _add(db_manager, rows)
+        await tail.poll()
+        results += await _compare(db_manager, segment_index, seed=2)
+        return results
+
+    for expected, actual in run(check()):
+        assert actual == expected
+
+
+def test_layout_mismatch(run, db_url):
+    """Index of flat layout holds file names of other layouts (e.g. before archive migration)"""
+
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=60)
+        await db_manager.create_db()
+        await _add(db_manager, _generate(LAYOUT_PACKED, 1000, seed=4))
+        await _add(db_manager, _generate(LAYOUT_HOURLY, 1000, seed=5,
+                                         start_datetime=START + datetime.timedelta(hours=1)))
+        tail, segment_index = await _create_index(db_manager, LAYOUT_FLAT)
+        return await _compare(db_manager, segment_index, seed=4)
+
+    for expected, actual in run(check()):
+        assert actual == expected
+
+
+def test_segments_during_load(run, db_url):
+    """Segments received by SegmentTail while the index is loaded are added after the load"""
+
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=60)
+        await db_manager.create_db()
+        await _add(db_manager, _generate(LAYOUT_FLAT, 1000, seed=6))
+        tail = SegmentTail(db_manager=db_manager)
+        await tail.start()
+        await _add(db_manager, _generate(LAYOUT_FLAT, 100, seed=7, start_datetime=START + datetime.timedelta(hours=2)))
+        segment_index = SegmentIndex(db_manager=db_manager, tail=tail, layout=LAYOUT_FLAT, batch_size=300)
+        await asyncio.gather(segment_index.load(last_id=tail.last_id), tail.poll())
+        return await _compare(db_manager, segment_index, seed=6)
+
+    for expected, actual in run(check()):
+        assert actual == expected
+
+
+@pytest.mark.parametrize('layout', [LAYOUT_FLAT, LAYOUT_PACKED])
+def test_retention(run, db_url, layout):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=60)
+        await db_manager.create_db()
+        await _add(db_manager, _generate(layout, 5000, seed=8))
+        tail, segment_index = await _create_index(db_manager, layout)
+        results = []
+        for hours in (1, 2.5):
+            older_then = START + datetime.timedelta(hours=hours)
+            if layout == LAYOUT_PACKED:
+                # контейнеры удаляются целиком
+                filenames = [get_segment_name(START + datetime.timedelta(hours=hour), layout)
+                             for hour in range(int(hours))]
+                await db_manager.delete_segments_by_filenames(filenames, channel_name=CHANNEL)
+            else:
+                await db_manager.delete_segments(older_then=older_then, channel_name=CHANNEL)
+            assert await segment_index.trim() > 0
+            results += await _compare(db_manager, segment_index, seed=int(hours * 10))
+        await db_manager.delete_segments(older_then=datetime.datetime.max, channel_name=CHANNEL)
+        await segment_index.trim()
+        assert not len(segment_index.get_channel(CHANNEL))
+        results += await _compare(db_manager, segment_index, seed=9, count=10)
+        return results
+
+    for expected, actual in run(check()):
+        assert actual == expected
+
+
+def test_playlist_streamed_during_trim(run, db_url):
+    async def check():
+        db_manager = DbManager(url=db_url, batch_interval=60)
+        await db_manager.create_db()
+        await _add(db_manager, _generate(LAYOUT_FLAT, 5000, seed=10))
+        tail, segment_index = await _create_index(db_manager, LAYOUT_FLAT)
+        generator = PlaylistGenerator(CHANNEL, db_manager=db_manager, chunk_prefix='', segment_index=segment_index)
+        to_datetime = START + datetime.timedelta(days=1)
+        expected = await _read(await generator.stream_vod_playlist(START, to_datetime))
+        playlist = await generator.stream_vod_playlist(START, to_datetime)
+        parts = [await playlist.__anext__()]
+        await db_manager.delete_segments(older_then=START + datetime.timedelta(hours=2), channel_name=CHANNEL)
+        assert await segment_index.trim() > 0
+        parts += [part async for part in playlist]
+        return expected, ''.join(parts)
+
+    expected, actual = run(check())
+    assert actual == expected
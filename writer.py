@@ -4,54 +4,191 @@ import json
 import os
 import asyncio
 import configparser
+import signal
 from asyncio import sleep
 from typing import List
 
-from streamer import HlsWriter, HlsDeleter
+from streamer import HlsWriter, HlsDeleter, RetentionScheduler
+from streamer.Db import DbManager
+from streamer.HttpPool import HttpPool
+from streamer.MetricsServer import MetricsServer
+from streamer.ShardSupervisor import ShardSupervisor, get_channel_name
+from streamer.logs import configure_logging, logger, set_log_file
 
 PWD = os.getcwd()
+CONFIG_FILE = 'pvr.ini'
+CHANNELS_FILE = 'channels.json'
+
+
+def read_config() -> configparser.ConfigParser:
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    return config
 
 
 async def write(writer_: HlsWriter):
     sleep_time = 1
     while True:
-        target_duration = await writer_.check_for_new_segment_and_save()
+        target_duration = await writer_.check_for_new_segments_and_save()
         if target_duration is not None:
             sleep_time = target_duration / 2
         await sleep(sleep_time)
 
 
-async def clean(cleaner_: HlsDeleter):
-    sleep_time = 10
+async def report_load(writers: List[HlsWriter], stats_queue, shard: int, interval: float):
+    """Sends segments and bytes saved by every channel of the shard during interval to the supervisor"""
+
+    last = {writer_.channel_name: (writer_.saved_segments.value, writer_.saved_bytes.value) for writer_ in writers}
     while True:
-        await cleaner_.clear_storage_and_db()
-        await sleep(sleep_time)
+        await sleep(interval)
+        channels = {}
+        for writer_ in writers:
+            segments, saved_bytes = last[writer_.channel_name]
+            channels[writer_.channel_name] = (writer_.saved_segments.value - segments,
+                                              writer_.saved_bytes.value - saved_bytes)
+            last[writer_.channel_name] = (writer_.saved_segments.value, writer_.saved_bytes.value)
+        stats_queue.put({'shard': shard, 'pid': os.getpid(), 'interval': interval, 'channels': channels})
+
+
+async def start_metrics(config: configparser.ConfigParser, port_offset: int = 0) -> MetricsServer:
+    """
+    Metrics listener of the process if [metrics] section exists:
+    supervisor (or the only process) on port, shard N on port + 1 + N
+    """
+
+    server = MetricsServer.from_config(config['metrics'] if config.has_section('metrics') else None,
+                                       port_offset=port_offset)
+    if server is not None:
+        await server.start()
+    return server
 
 
-async def process_writing_and_cleaning(channels: List):
-    tasks = []
+async def stop_metrics(server: MetricsServer):
+    if server is not None:
+        await server.close()
+
+
+def create_deleters(channels: List, config: configparser.ConfigParser) -> List[HlsDeleter]:
+    storage = config['writer']['pvr_dir']
+    layout = config['writer'].get('layout', fallback='flat')
+    return [HlsDeleter(channel_name=get_channel_name(channel),
+                       storage=os.path.join(storage, get_channel_name(channel)),
+                       depth_in_hours=channel['depth_in_hours'], layout=layout)
+            for channel in channels]
+
+
+def create_retention(channels: List, config: configparser.ConfigParser) -> RetentionScheduler:
+    # одна очистка архива на все каналы
+    return RetentionScheduler.from_config(deleters=create_deleters(channels, config),
+                                          storage=config['writer']['pvr_dir'],
+                                          section=config['cleaner'] if config.has_section('cleaner') else None)
+
+
+async def process_writing(channels: List, config: configparser.ConfigParser, stats_queue=None, shard: int = 0):
+    storage = config['writer']['pvr_dir']
+    max_parallel_downloads = config['writer'].getint('max_parallel_downloads', fallback=4)
+    layout = config['writer'].get('layout', fallback='flat')
+    # общие keep-alive соединения для всех камер одного origin
+    http_pool = HttpPool.from_config(config['http'] if config.has_section('http') else None)
+    writers = []
     for channel in channels:
-        channel_name = channel['source'].split('/')[-1].split('.')[0]
+        channel_name = get_channel_name(channel)
         channel_storage = os.path.join(storage, channel_name)
         if not os.path.exists(channel_storage):
             os.makedirs(channel_storage)
 
-        writer = HlsWriter(channel_name=channel_name, storage=channel_storage, source_url=channel['source'])
-        cleaner = HlsDeleter(channel_name=channel_name, storage=channel_storage, depth_in_hours=channel['depth_in_hours'])
-        write_task = asyncio.create_task(write(writer))
-        clean_task = asyncio.create_task(clean(cleaner))
-        tasks.append(write_task)
-        tasks.append(clean_task)
+        writers.append(HlsWriter(channel_name=channel_name, storage=channel_storage, source_url=channel['source'],
+                                 http_pool=http_pool, max_parallel_downloads=max_parallel_downloads, layout=layout))
+    tasks = [asyncio.create_task(write(writer)) for writer in writers]
+    if stats_queue is not None:
+        tasks.append(asyncio.create_task(
+            report_load(writers, stats_queue=stats_queue, shard=shard,
+                        interval=config['writer'].getfloat('stats_interval', fallback=60))))
 
-    await asyncio.gather(*tasks)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await http_pool.close()
+        await DbManager().flush()
+
+
+async def process_writing_and_cleaning(channels: List, config: configparser.ConfigParser):
+    metrics = await start_metrics(config)
+    retention = create_retention(channels, config)
+    try:
+        await asyncio.gather(process_writing(channels, config), retention.run())
+    finally:
+        await stop_metrics(metrics)
+
+
+async def watch_supervisor(supervisor_pid: int, task: asyncio.Task):
+    # шард без супервизора (убит по SIGKILL) завершается, чтобы канал не писался дважды после его перезапуска
+    while os.getppid() == supervisor_pid:
+        await sleep(1)
+    logger.error(f'Supervisor (pid {supervisor_pid}) has gone, stopping the shard')
+    task.cancel()
+
+
+async def _run_shard(shard: int, channels: List, stats_queue):
+    task = asyncio.current_task()
+    # остановка супервизором: запись накопленных чанков в БД перед выходом
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+    watchdog = asyncio.create_task(watch_supervisor(os.getppid(), task))
+    config = read_config()
+    # у каждого процесса свой файл лога: процессы не ротируют файл друг под другом
+    set_log_file(f'streamer.shard{shard}.log')
+    configure_logging(config['logging'] if config.has_section('logging') else None)
+    metrics = await start_metrics(config, port_offset=1 + shard)
+    try:
+        await process_writing(channels, config, stats_queue=stats_queue, shard=shard)
+    finally:
+        watchdog.cancel()
+        await stop_metrics(metrics)
+
+
+def run_shard(shard: int, channels: List, stats_queue):
+    """Entry point of a writer worker process"""
+
+    try:
+        asyncio.run(_run_shard(shard, channels, stats_queue))
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
+
+
+async def supervise(config: configparser.ConfigParser, workers: int):
+    """Channels are written by worker processes, retention of all channels runs in the supervisor"""
+
+    # при остановке супервизора по SIGTERM шарды останавливаются вместе с ним
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    retention = create_retention([], config)
+
+    def on_channels_change(channels: List):
+        retention.deleters = create_deleters(channels, config)
+
+    supervisor = ShardSupervisor(channels_file=CHANNELS_FILE, workers=workers, target=run_shard,
+                                 on_channels_change=on_channels_change,
+                                 check_interval=config['writer'].getfloat('channels_check_interval', fallback=5),
+                                 rebalance_threshold=config['writer'].getfloat('rebalance_threshold', fallback=1.2))
+    metrics = await start_metrics(config)
+    try:
+        await asyncio.gather(supervisor.run(), retention.run())
+    finally:
+        await stop_metrics(metrics)
 
 
 if __name__ == '__main__':
-    config = configparser.ConfigParser()
-    config.read("pvr.ini")
-    storage = config['writer']['pvr_dir']
+    config_ = read_config()
+    # запись лога в файл в отдельном потоке, ограничение частоты сообщений по чанкам каналов
+    configure_logging(config_['logging'] if config_.has_section('logging') else None)
+    workers_ = config_['writer'].getint('workers', fallback=0)
 
-    with open('channels.json', encoding='utf-8') as f:
-        channels_ = json.load(f)
+    if workers_ > 0:
+        try:
+            asyncio.run(supervise(config_, workers=workers_))
+        except asyncio.CancelledError:
+            pass
+    else:
+        with open(CHANNELS_FILE, encoding='utf-8') as f:
+            channels_ = json.load(f)
 
-    asyncio.run(process_writing_and_cleaning(channels=channels_))
+        asyncio.run(process_writing_and_cleaning(channels=channels_, config=config_))